@@ -1,18 +1,25 @@
+import json
 import logging
 import os
+from dataclasses import dataclass, field
 from mimetypes import MimeTypes
-
-import httpx
-import requests
+from typing import Any, Iterator
 
 from configs import getBackendUrl
 from models.fileObject import FileObject
+from paths import fromListingKey, toLocalPath, toServerKey
+from presignCache import PresignedUrlCache
+from scheduler import bandwidthLimiter
+from transport import getClient
 
-client = httpx.Client(http2=True)
+presignedUrlCache = PresignedUrlCache()
+batchPresignSupported = True
+batchDeleteSupported = True
+multipartUploadSupported = True
 
 
 def checkHealth():
-    reponse = client.get(
+    reponse = getClient().get(
         "https://pb.blazedcloud.com/api/health",
         follow_redirects=True,
         headers={"User-Agent": "blazedcloud-sync"},
@@ -21,70 +28,346 @@ def checkHealth():
 
 
 def getUsage(token: str, uid: str):
-    logging.info(f"Getting usage for {token}")
+    logging.info("Getting usage for %s", uid)
     backendUrl = getBackendUrl()
     url = backendUrl + "data/usage/" + uid
     headers = {"Authorization": f"Bearer {token}", "User-Agent": "blazedcloud-sync"}
-    response = client.get(url, headers=headers)
+    response = getClient().get(url, headers=headers)
     return response.text
 
 
-def getFileList(token: str, uid: str) -> list[FileObject]:
-    logging.info(f"Getting file list for {uid}")
-    backendUrl = getBackendUrl()
-    url = backendUrl + "data/listall/" + uid
-    headers = {"Authorization": f"Bearer {token}", "User-Agent": "blazedcloud-sync"}
-    response = client.get(url, headers=headers)
+def iterJsonArray(chunks: Iterator[str]) -> Iterator[Any]:
+    """
+    Incrementally parses a top level json array, yielding each element as soon as it is complete
+    """
 
-    if response.status_code != 200:
-        logging.error(f"Failed to get file list: {response.text}")
-        return []
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    started = False
+    chunks = iter(chunks)
+    exhausted = False
 
-    # convert to array of FileObject
-    fileObjects: FileObject = []
+    while True:
+        # skip whitespace and separators
+        while position < len(buffer) and buffer[position] in " \t\r\n,":
+            position += 1
+
+        if position < len(buffer):
+            if not started:
+                if buffer[position] != "[":
+                    raise ValueError("Expected a json array")
+                started = True
+                position += 1
+                continue
+
+            if buffer[position] == "]":
+                return
+
+            try:
+                element, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if exhausted:
+                    raise
+            else:
+                # a number is only complete once a delimiter follows, "1" may be
+                # the start of "12" or "1.5" in the next chunk
+                if (
+                    buffer[position] in '{["'
+                    or exhausted
+                    or (end < len(buffer) and buffer[end] in " \t\r\n,]")
+                ):
+                    position = end
+                    yield element
+                    continue
+        elif exhausted:
+            raise ValueError("Unexpected end of json array")
+
+        # need more data, drop what was already consumed
+        buffer = buffer[position:]
+        position = 0
+        try:
+            buffer += next(chunks)
+        except StopIteration:
+            exhausted = True
+
+
+def _listingPages(
+    token: str, uid: str, params: dict, headers: dict | None = None, info: dict | None = None
+) -> Iterator[Any]:
+    """
+    Yields the raw entries of every page of the listing, following X-Next-Cursor until it is missing.
+
+    info, if given, gets the status and ETag of the first response, and the X-Listing-Cursor
+    and X-Listing-Delta of the last one. Nothing is yielded for a 304. Any other status than
+    200, on any page, raises ValueError, so a listing cut short never looks complete.
+    """
+
+    url = getBackendUrl() + "data/listall/" + uid
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "User-Agent": "blazedcloud-sync",
+        **(headers or {}),
+    }
+    params = dict(params)
+    first = True
+
+    while True:
+        with getClient().stream("GET", url, headers=headers, params=params) as response:
+            if info is not None:
+                if first:
+                    info["status"] = response.status_code
+                    info["etag"] = response.headers.get("ETag")
+                info["cursor"] = response.headers.get("X-Listing-Cursor")
+                info["delta"] = response.headers.get("X-Listing-Delta") == "true"
+            first = False
+
+            if response.status_code == 304:
+                return
+            if response.status_code != 200:
+                response.read()
+                raise ValueError(
+                    f"listing page returned {response.status_code}: {response.text}"
+                )
+
+            yield from iterJsonArray(response.iter_text())
+            cursor = response.headers.get("X-Next-Cursor")
+
+        if cursor is None or len(cursor) == 0:
+            return
+        params["cursor"] = cursor
+
+
+def getFileListStream(
+    token: str, uid: str, prefix: str | None = None, pageSize: int | None = None
+) -> Iterator[FileObject]:
+    """
+    Yields FileObjects while the listing is still downloading, without ever holding the whole response
+
+    prefix and pageSize are sent to the backend as query parameters. A backend that pages
+    returns the cursor for the next page in the X-Next-Cursor header, which is followed
+    until it is missing. A backend that ignores them returns everything in one response,
+    and prefix is then applied here instead.
+
+    Raises ValueError if any page fails, after yielding the files of the pages before it.
+    """
+
+    logging.info("Getting file list for %s", uid)
+    params = {}
+    if prefix is not None:
+        params["prefix"] = prefix
+    if pageSize is not None:
+        params["limit"] = pageSize
+    keyPrefix = toLocalPath(prefix) if prefix is not None else None
+
+    for file in _listingPages(token, uid, params):
+        file["Key"] = fromListingKey(str(file.get("Key")))
+        if keyPrefix is not None and not file["Key"].startswith(keyPrefix):
+            continue
+        yield FileObject.from_dict(file)
+
+
+@dataclass
+class RemoteListing:
+    objects: list[FileObject] | None = None  # None when unchanged since the etag
+    deletedKeys: list[str] = field(default_factory=list)
+    delta: bool = False  # objects and deletedKeys are only the changes since the cursor
+    etag: str | None = None
+    cursor: str | None = None
+
+
+def getFileListing(
+    token: str,
+    uid: str,
+    etag: str | None = None,
+    cursor: str | None = None,
+    onObject=None,
+) -> RemoteListing | None:
+    """
+    Lists the account conditionally, returns None if the listing failed.
+
+    With etag the request carries If-None-Match, and a 304 comes back as objects None.
+    With cursor the backend is asked for the changes since then (?since=), a backend that
+    supports it marks the response with X-Listing-Delta and lists deleted keys as entries
+    with "Deleted": true. A backend that supports neither returns the full listing.
+    onObject(object) is called for every object of a full listing as soon as it is parsed.
+    """
+
+    logging.info("Getting file list for %s", uid)
+    headers = {"If-None-Match": etag} if etag is not None else {}
+    params = {"since": cursor} if cursor is not None else {}
+    info: dict = {}
+
+    objects: list[FileObject] = []
+    deletedKeys: list[str] = []
     try:
-        for file in response.json():
-            object = FileObject.from_dict(file)
+        for file in _listingPages(token, uid, params, headers, info):
+            file["Key"] = fromListingKey(str(file.get("Key")))
+            if file.get("Deleted"):
+                deletedKeys.append(file["Key"])
+                continue
 
-            # remove string before first / and the slash itself
-            object.Key = object.Key[object.Key.find("/") + 1 :]
+            object = FileObject.from_dict(file)
+            objects.append(object)
+            if onObject is not None and not info["delta"]:
+                onObject(object)
+    except ValueError as e:
+        # a partial listing would look like deletions, and its etag would keep it
+        logging.error("Failed to get file list: %s", e)
+        return None
 
-            # if on windows, replace / with \
-            if "\\" not in object.Key:
-                object.Key = object.Key.replace("/", "\\")
+    if info.get("status") == 304:
+        return RemoteListing(etag=etag, cursor=cursor)
+    return RemoteListing(
+        objects, deletedKeys, info["delta"], info["etag"], info["cursor"]
+    )
 
-            # ensure no whitespace between slashes
-            object.Key = object.Key.replace(" \\", "\\")
-            object.Key = object.Key.replace("\\ ", "\\")
 
-            fileObjects.append(object)
+def getFileList(token: str, uid: str) -> list[FileObject]:
+    # convert to array of FileObject
+    try:
+        return list(getFileListStream(token, uid))
     except Exception as e:
-        logging.error(f"Failed to convert file list to FileObject: {e}")
+        logging.error("Failed to convert file list to FileObject: %s", e)
         return []
 
-    return fileObjects
-
 
 def getDownloadUrl(token: str, uid: str, key: str):
     """
-    this function will always replace \ with / in the key
+    key may be a local path, it is sent as a server key
+
+    urls are cached until shortly before they expire, so retries and resumes skip the request
     """
 
-    # replace \ with /
-    key = key.replace("\\", "/")
+    key = toServerKey(key)
+
+    cached = presignedUrlCache.get(key)
+    if cached is not None:
+        return cached
 
-    logging.info(f"Getting download url for {key}")
+    logging.debug("Getting download url for %s", key)
     backendUrl = getBackendUrl()
     url = backendUrl + "data/down/" + uid
     headers = {"Authorization": f"Bearer {token}", "User-Agent": "blazedcloud-sync"}
     payload = {"filename": key, "useShlink": False}
-    response = client.post(url, headers=headers, data=payload)
+    response = getClient().post(url, headers=headers, data=payload)
+    if response.status_code == 200:
+        presignedUrlCache.put(key, response.text)
     return response.text
 
 
+def getDownloadUrls(
+    token: str, uid: str, keys: list[str], fallback: bool = True
+) -> dict[str, str]:
+    """
+    Presigns many keys with one request, returning key -> url for the keys as passed in.
+
+    Cached urls are reused. When the backend has no batch endpoint every key is
+    presigned on its own, and the batch endpoint isn't tried again. Without fallback
+    those keys are left out instead, for callers that presign them in parallel.
+    """
+
+    global batchPresignSupported
+
+    urls: dict[str, str] = {}
+    missing: dict[str, str] = {}  # server key -> key as passed in
+    for key in keys:
+        normalized = toServerKey(key)
+        cached = presignedUrlCache.get(normalized)
+        if cached is not None:
+            urls[key] = cached
+        else:
+            missing[normalized] = key
+
+    if len(missing) == 0:
+        return urls
+
+    if batchPresignSupported:
+        logging.info("Getting download urls for %d files", len(missing))
+        backendUrl = getBackendUrl()
+        url = backendUrl + "data/down/batch/" + uid
+        headers = {"Authorization": f"Bearer {token}", "User-Agent": "blazedcloud-sync"}
+        payload = {"filenames": list(missing), "useShlink": False}
+        response = getClient().post(url, headers=headers, json=payload)
+
+        if response.status_code in (404, 405, 501):
+            logging.info("Batch presigning not supported, presigning one by one")
+            batchPresignSupported = False
+        elif response.status_code != 200:
+            logging.error("Failed to get download urls: %s", response.text)
+        else:
+            for normalized, presigned in response.json().items():
+                if normalized in missing:
+                    presignedUrlCache.put(normalized, presigned)
+                    urls[missing.pop(normalized)] = presigned
+
+    if not fallback:
+        return urls
+    for normalized, key in missing.items():
+        urls[key] = getDownloadUrl(token, uid, normalized)
+
+    return urls
+
+
+def deleteFile(token: str, uid: str, key: str) -> bool:
+    key = toServerKey(key)
+    logging.debug("Deleting %s", key)
+    backendUrl = getBackendUrl()
+    url = backendUrl + "data/delete/" + uid
+    headers = {"Authorization": f"Bearer {token}", "User-Agent": "blazedcloud-sync"}
+    response = getClient().post(url, headers=headers, data={"filename": key})
+    if response.status_code != 200:
+        logging.error("Failed to delete %s: %s", key, response.text)
+        return False
+    presignedUrlCache.invalidate(key)
+    return True
+
+
+def deleteFiles(token: str, uid: str, keys: list[str]) -> set[str]:
+    """
+    Deletes many keys with one request, returning the keys as passed in that are gone.
+
+    When the backend has no batch endpoint every key is deleted on its own, and the
+    batch endpoint isn't tried again.
+    """
+
+    global batchDeleteSupported
+
+    deleted: set[str] = set()
+    missing = {toServerKey(key): key for key in keys}  # server key -> key as passed in
+    if len(missing) == 0:
+        return deleted
+
+    if batchDeleteSupported:
+        logging.info("Deleting %d files", len(missing))
+        backendUrl = getBackendUrl()
+        url = backendUrl + "data/delete/batch/" + uid
+        headers = {"Authorization": f"Bearer {token}", "User-Agent": "blazedcloud-sync"}
+        response = getClient().post(url, headers=headers, json={"filenames": list(missing)})
+
+        if response.status_code in (404, 405, 501):
+            logging.info("Batch deleting not supported, deleting one by one")
+            batchDeleteSupported = False
+        elif response.status_code != 200:
+            logging.error("Failed to delete files: %s", response.text)
+            return deleted
+        else:
+            for normalized in response.json():
+                if normalized in missing:
+                    presignedUrlCache.invalidate(normalized)
+                    deleted.add(missing.pop(normalized))
+            return deleted
+
+    for normalized, key in missing.items():
+        if deleteFile(token, uid, normalized):
+            deleted.add(key)
+
+    return deleted
+
+
 def downloadFromUrl(url, headers, directory):
-    logging.info(f"Downloading from {url}")
-    response = client.get(url, headers=headers)
+    logging.debug("Downloading from %s", url)
+    response = getClient().get(url, headers=headers)
     with open(directory, "wb") as f:
         f.write(response.content)
     return response
@@ -97,39 +380,140 @@ def getUploadUrl(filePath: str, token: str, uid: str):
     mime = MimeTypes().guess_type(filename)[0]
     headers = {"Authorization": f"Bearer {token}", "User-Agent": "blazedcloud-sync"}
     payload = {"filename": filePath, "contentType": mime}
-    logging.info(f"Getting upload url for {payload}")
+    logging.debug("Getting upload url for %s", filePath)
 
-    response = client.post(url, headers=headers, data=payload)
+    response = getClient().post(url, headers=headers, data=payload)
     return response.text
 
 
 def uploadToUrl(url, file):
     # check if file exists
     if not os.path.exists(file):
-        logging.error(f"File {file} does not exist")
+        logging.error("File %s does not exist", file)
         return None
 
-    # multipart upload
-    logging.info(f"Uploading to {url}")
+    # presigned urls expect the raw file as the body, not a multipart form
+    logging.debug("Uploading to %s", url)
     with open(file, "rb") as f:
         filename = os.path.basename(file)
-        mime = MimeTypes().guess_type(filename)[0]
-        headers = {"Content-Type": mime, "User-Agent": "blazedcloud-sync"}
-        logging.info(f"Uploading {file}")
-        files = {"file": (filename, f, mime)}
-        response = client.put(url=url, headers=headers, files=files)
+        mime = MimeTypes().guess_type(filename)[0] or "application/octet-stream"
+        headers = {
+            "Content-Type": mime,
+            "Content-Length": str(os.path.getsize(file)),
+            "User-Agent": "blazedcloud-sync",
+        }
+        logging.debug("Uploading %s", file)
+        response = getClient().put(
+            url=url, headers=headers, content=bandwidthLimiter.throttledFile(f)
+        )
     return response
 
 
-async def get_latest_version():
+def startMultipartUpload(token: str, uid: str, key: str, size: int, partSize: int):
+    """
+    Returns the upload id of a new multipart upload, or None if the backend refused it.
+    A backend without multipart endpoints isn't asked again.
+    """
+
+    global multipartUploadSupported
+
+    backendUrl = getBackendUrl()
+    url = backendUrl + "data/up/multipart/" + uid
+    mime = MimeTypes().guess_type(os.path.basename(key))[0]
+    headers = {"Authorization": f"Bearer {token}", "User-Agent": "blazedcloud-sync"}
+    payload = {"filename": key, "contentType": mime, "size": size, "partSize": partSize}
+    logging.info("Starting multipart upload for %s", payload)
+
+    response = getClient().post(url, headers=headers, json=payload)
+    if response.status_code in (404, 405, 501):
+        logging.info("Multipart uploads not supported, uploading in one request")
+        multipartUploadSupported = False
+        return None
+    if response.status_code != 200:
+        logging.error("Failed to start multipart upload: %s", response.text)
+        return None
+    return response.json().get("uploadId")
+
+
+def getUploadPartUrl(token: str, uid: str, key: str, uploadId: str, partNumber: int):
+    backendUrl = getBackendUrl()
+    url = backendUrl + "data/up/multipart/" + uid + "/part"
+    headers = {"Authorization": f"Bearer {token}", "User-Agent": "blazedcloud-sync"}
+    payload = {"filename": key, "uploadId": uploadId, "partNumber": partNumber}
+
+    response = getClient().post(url, headers=headers, json=payload)
+    if response.status_code != 200:
+        logging.error(
+            "Failed to get upload url for part %d: %s", partNumber, response.text
+        )
+        return None
+    return response.text
+
+
+def uploadPartToUrl(url: str, data: bytes):
+    """
+    Returns the etag of the uploaded part, or None if the upload failed
+    """
+
+    headers = {
+        "Content-Type": "application/octet-stream",
+        "Content-Length": str(len(data)),
+        "User-Agent": "blazedcloud-sync",
+    }
+    response = getClient().put(
+        url=url, headers=headers, content=bandwidthLimiter.throttledChunks(data)
+    )
+    if response.status_code != 200:
+        logging.error(
+            "Failed to upload part: %d %s", response.status_code, response.text
+        )
+        return None
+    return response.headers.get("ETag")
+
+
+def completeMultipartUpload(
+    token: str, uid: str, key: str, uploadId: str, parts: list[tuple[int, str]]
+):
+    """
+    parts are (part number, etag) pairs. Returns the etag of the finished object, or None if it failed
+    """
+
+    backendUrl = getBackendUrl()
+    url = backendUrl + "data/up/multipart/" + uid + "/complete"
+    headers = {"Authorization": f"Bearer {token}", "User-Agent": "blazedcloud-sync"}
+    payload = {
+        "filename": key,
+        "uploadId": uploadId,
+        "parts": [{"PartNumber": number, "ETag": etag} for number, etag in parts],
+    }
+
+    response = getClient().post(url, headers=headers, json=payload)
+    if response.status_code != 200:
+        logging.error("Failed to complete multipart upload: %s", response.text)
+        return None
+    return response.json().get("ETag")
+
+
+def abortMultipartUpload(token: str, uid: str, key: str, uploadId: str):
+    backendUrl = getBackendUrl()
+    url = backendUrl + "data/up/multipart/" + uid + "/abort"
+    headers = {"Authorization": f"Bearer {token}", "User-Agent": "blazedcloud-sync"}
+    payload = {"filename": key, "uploadId": uploadId}
+
+    response = getClient().post(url, headers=headers, json=payload)
+    if response.status_code != 200:
+        logging.error("Failed to abort multipart upload: %s", response.text)
+
+
+def get_latest_version():
     url = "https://api.github.com/repos/TheRedSpy15/blazedcloud-sync/releases/latest"
-    response = requests.get(url)
+    response = getClient().get(url, follow_redirects=True)
 
     if response.status_code == 200:
         latest_version = response.json()["tag_name"]
         return latest_version
     else:
         logging.error(
-            f"Failed to fetch latest version. Status code: {response.status_code}"
+            "Failed to fetch latest version. Status code: %s", response.status_code
         )
         return None
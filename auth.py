@@ -1,16 +1,8 @@
 import logging
 
-import keyring as kr
-from rich.console import Console
-from rich.panel import Panel
-from rich.prompt import Prompt
-from tinydb import Query
-
-from api_service import client
-from configs import db, getBackendUrl
-
-userTable = db.table("user", cache_size=30)
-console = Console()
+from configs import getBackendUrl
+from stateStore import getStateStore
+from transport import getClient
 
 
 def initAuth():
@@ -43,11 +35,12 @@ def initAuth():
 def saveAuth(authModel, token):
     uid = authModel.get("id")
 
-    query = Query()
-    userTable.upsert(authModel, query.id == uid)
+    getStateStore().setSetting("user", authModel)
     logging.info("Saved auth record")
 
     # save email/password to keyring
+    import keyring as kr
+
     kr.set_password("blazedcloud", uid, token)
     logging.info("Saved keyring")
 
@@ -64,7 +57,7 @@ def authenticatePassword(email, password):
 
     payload = {"identity": email, "password": password}
 
-    response = client.post(
+    response = getClient().post(
         url, data=payload, headers={"User-Agent": "blazedcloud-sync"}
     )
 
@@ -82,10 +75,10 @@ def refreshAuth(token):
     backendUrl = getBackendUrl()
     url = backendUrl + "api/collections/users/auth-refresh"
     headers = {"Authorization": f"Bearer {token}", "User-Agent": "blazedcloud-sync"}
-    response = client.post(url, headers=headers)
+    response = getClient().post(url, headers=headers)
 
     if response.status_code != 200:
-        logging.error(f"Failed to refresh token {response.text}")
+        logging.error("Failed to refresh token %s", response.text)
         token = None
         return None
     token = response.json().get("token")
@@ -100,29 +93,31 @@ def getAuth():
 
     logging.info("Getting user")
 
-    query = Query()
-    user = userTable.search(query.id.exists())
+    user = getStateStore().getSetting("user")
 
-    if user is None or len(user) == 0:
+    if user is None or user.get("id") is None:
         logging.warning("No auth record found")
         return None
 
-    token = getSavedToken(user[0].get("id"))
+    token = getSavedToken(user.get("id"))
 
     if token is None:
         logging.warning("No token found")
         return None
 
-    return token, user[0]
+    return token, user
 
 
 def getSavedToken(uid):
     logging.info("Getting keyring")
+    import keyring as kr
+
     return kr.get_password("blazedcloud", uid)
 
 
 def promptForEmailPassword():
     logging.debug("Prompting for email/password")
+    from rich.prompt import Prompt
 
     email = Prompt.ask("Email")
     password = Prompt.ask("Password", password=True)
@@ -130,7 +125,10 @@ def promptForEmailPassword():
 
 
 def promptAuthFailed():
-    console.print(
+    from rich.console import Console
+    from rich.panel import Panel
+
+    Console().print(
         Panel.fit(
             "Failed to authenticate with email/password. Please try again.",
             title="Authentication Failed",
@@ -143,9 +141,11 @@ def clearSavedAuth():
     uid = getAuth()[1].get("id")
 
     logging.info("Clearing saved auth")
-    userTable.truncate()
+    getStateStore().deleteSettings(["user"])
     logging.info("Cleared saved auth")
 
     # clear keyring
+    import keyring as kr
+
     kr.delete_password("blazedcloud", uid)
     logging.info("Cleared keyring")
@@ -0,0 +1,347 @@
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from constants import TOOL_VERSION
+from fakeBackend import FAKE_TOKEN, FAKE_UID, FakeBackend
+
+"""
+End to end sync benchmark against the fake backend.
+
+Generates a synthetic tree, keeps a third of it remote only, a third local only and a
+third on both sides, then runs Sync() and reads how long each phase took (list, scan,
+diff, download, upload) from its phase_seconds metrics. A second Sync() of the now
+unchanged tree gives resync, relist and rescan, the listing only fetching what the uploads
+changed. Listing, scan and early downloads overlap, so the phases add up to more than
+"sync". The backend runs in its own process so peak RSS is the client's alone.
+
+    python benchmark.py tiny
+    python benchmark.py mixed --scale 0.1 --latency 0.02 --bandwidth 50000000
+
+Every run is appended to benchmark-results.jsonl. The run is compared with the last one
+of the same profile and exits with 1 if any phase got slower by more than --threshold.
+"""
+
+KiB = 1024
+MiB = 1024 * KiB
+
+# profile name: (file count, [(size, weight)], files per folder)
+PROFILES = {
+    "tiny": (10_000, [(1 * KiB, 1)], 500),
+    "mixed": (
+        100_000,
+        [(512, 70), (4 * KiB, 25), (64 * KiB, 4.9), (1 * MiB, 0.1)],
+        1_000,
+    ),
+    "large": (10, [(80 * MiB, 1)], 10),
+}
+
+REMOTE = "remote"
+LOCAL = "local"
+BOTH = "both"
+
+RESULTS_PATH = "benchmark-results.jsonl"
+BLOCK_SIZE = 1 * MiB
+
+
+def buildTree(profile: str, scale: float, seed: int) -> list[tuple[str, int, str]]:
+    """
+    Returns (key, size, side) for every file of a profile, the same for the same arguments
+    """
+
+    count, sizes, perFolder = PROFILES[profile]
+    count = max(1, int(count * scale))
+    rng = random.Random(seed)
+    choices = rng.choices(
+        [size for size, _ in sizes], weights=[weight for _, weight in sizes], k=count
+    )
+
+    tree = []
+    for i, size in enumerate(choices):
+        key = f"dir{i // perFolder:04d}/file{i:06d}.bin"
+        tree.append((key, size, (REMOTE, LOCAL, BOTH)[i % 3]))
+    return tree
+
+
+def fileData(key: str, size: int, block: bytes) -> bytes:
+    """
+    Deterministic content for a key, unique per key so no two files share an etag
+    """
+
+    prefix = key.encode()
+    offset = int(hashlib.md5(prefix).hexdigest()[:8], 16) % len(block)
+    data = bytearray(prefix)
+    while len(data) < size:
+        data += block[offset:]
+        offset = 0
+    return bytes(data[:size])
+
+
+def randomBlock(seed: int) -> bytes:
+    return random.Random(seed).randbytes(BLOCK_SIZE)
+
+
+def _serve(tree, seed: int, latency: float, bandwidth: int, connection):
+    block = randomBlock(seed)
+    backend = FakeBackend(latency=latency, bandwidth=bandwidth)
+    for key, size, side in tree:
+        if side != LOCAL:
+            backend.putObject(key, fileData(key, size, block))
+    backend.start()
+    connection.send(backend.url)
+
+    # block until the benchmark is done, then report what the client asked for
+    connection.recv()
+    connection.send(dict(backend.requestCounts))
+    backend.stop()
+
+
+def peakRss() -> int | None:
+    """
+    Peak resident set size of this process in bytes, None where it can't be measured
+    """
+
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def gitRevision() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def phaseTimes(snapshot: dict) -> dict[str, float]:
+    """
+    Seconds per phase from a metrics snapshot, the phase_seconds histograms summed and the
+    whole sync as "sync"
+    """
+
+    phases = {}
+    for histogram in snapshot["histograms"]:
+        if histogram["name"] == "phase_seconds":
+            phases[histogram["labels"]["phase"]] = histogram["sum"]
+        elif histogram["name"] == "sync_seconds":
+            phases["sync"] = histogram["sum"]
+    return phases
+
+
+def runBenchmark(
+    profile: str,
+    scale: float,
+    seed: int,
+    latency: float,
+    bandwidth: int,
+    maxConcurrent: int,
+    workDir: str,
+) -> dict:
+    tree = buildTree(profile, scale, seed)
+
+    # the backend child is started before anything heavy is loaded in this process
+    parentConnection, childConnection = multiprocessing.Pipe()
+    server = multiprocessing.Process(
+        target=_serve,
+        args=(tree, seed, latency, bandwidth, childConnection),
+        daemon=True,
+    )
+    server.start()
+    backendUrl = parentConnection.recv()
+
+    # the tool keeps its state.db in the working directory, give it a throwaway one
+    os.chdir(workDir)
+    folder = os.path.join(workDir, "tree")
+    block = randomBlock(seed)
+    for key, size, side in tree:
+        if side != REMOTE:
+            path = os.path.join(folder, key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(fileData(key, size, block))
+
+    import sync
+    from configs import config
+    from metrics import metrics
+    from models.syncSettings import SyncSettings
+
+    settings = SyncSettings()
+    settings.maxConcurrentTransfers = maxConcurrent
+    settings.metricsPath = ""
+    config.update("backendUrl", backendUrl)
+    config.update("offlineFolder", folder)
+    config.update("syncSettings", settings)
+    # the fake backend takes a fixed token, the keyring stays out of it
+    sync.getAuth = lambda: (FAKE_TOKEN, {"id": FAKE_UID})
+
+    try:
+        metrics.reset()
+        result = sync.Sync(assumeYes=True, headless=True)
+        if result is None:
+            raise RuntimeError("Sync failed, see the log with --verbose")
+        phases = phaseTimes(metrics.snapshot())
+
+        # the tree is unchanged now, a second sync only lists and scans
+        metrics.reset()
+        sync.Sync(assumeYes=True, headless=True)
+        again = phaseTimes(metrics.snapshot())
+        for name, phase in [("resync", "sync"), ("relist", "list"), ("rescan", "scan")]:
+            if phase in again:
+                phases[name] = again[phase]
+    finally:
+        parentConnection.send("stop")
+        requestCounts = parentConnection.recv()
+        server.join()
+
+    for name, seconds in phases.items():
+        logging.warning(f"{name}: {seconds:.3f}s")
+
+    def throughput(report, seconds):
+        if report is None:
+            return None
+        return {
+            "files": len(report.succeeded),
+            "failed": len(report.failed),
+            "bytes": report.bytesTransferred,
+            "bytesPerSecond": report.bytesTransferred / seconds if seconds > 0 else None,
+            "filesPerSecond": len(report.succeeded) / seconds if seconds > 0 else None,
+        }
+
+    plan = result.plan
+    return {
+        "profile": profile,
+        "scale": scale,
+        "seed": seed,
+        "latency": latency,
+        "bandwidth": bandwidth,
+        "maxConcurrent": maxConcurrent,
+        "files": len(tree),
+        "bytes": sum(size for _, size, _ in tree),
+        "phases": phases,
+        "download": throughput(result.downloads, phases.get("download", 0)),
+        "upload": throughput(result.uploads, phases.get("upload", 0)),
+        "plan": {
+            "download": len(plan.to_download),
+            "upload": len(plan.to_upload) + len(plan.to_update),
+            "markSynced": len(plan.to_mark_synced),
+        },
+        "requests": requestCounts,
+        "peakRss": peakRss(),
+    }
+
+
+def lastResult(path: str, result: dict) -> dict | None:
+    """
+    Returns the newest earlier run with the same profile and parameters
+    """
+
+    if not os.path.exists(path):
+        return None
+
+    fields = ["profile", "scale", "seed", "latency", "bandwidth", "maxConcurrent"]
+    previous = None
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                run = json.loads(line)
+            except ValueError:
+                continue
+            if all(run.get(name) == result[name] for name in fields):
+                previous = run
+    return previous
+
+
+def findRegressions(previous: dict, result: dict, threshold: float) -> list[str]:
+    regressions = []
+    for name, seconds in result["phases"].items():
+        before = previous.get("phases", {}).get(name)
+        # ignore phases too short to time reliably
+        if before is None or before < 0.05:
+            continue
+        if seconds > before * (1 + threshold):
+            regressions.append(
+                f"{name}: {before:.3f}s -> {seconds:.3f}s (+{(seconds / before - 1) * 100:.0f}%)"
+            )
+
+    before, after = previous.get("peakRss"), result.get("peakRss")
+    if before and after and after > before * (1 + threshold):
+        regressions.append(f"peak rss: {before} B -> {after} B")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark sync against a fake backend")
+    parser.add_argument("profile", choices=sorted(PROFILES))
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplier for the file count")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--bandwidth", type=int, default=0, help="bytes/s shared by all transfers, 0 is unlimited")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--output", default=RESULTS_PATH)
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown, 0.2 is 20%%")
+    parser.add_argument("--keep", action="store_true", help="keep the working directory")
+    parser.add_argument("--verbose", action="store_true", help="show the tool's own logging")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING, format="%(message)s"
+    )
+    output = os.path.abspath(args.output)
+    workDir = tempfile.mkdtemp(prefix="blazed-bench-")
+    try:
+        result = runBenchmark(
+            args.profile,
+            args.scale,
+            args.seed,
+            args.latency,
+            args.bandwidth,
+            args.concurrency,
+            workDir,
+        )
+    finally:
+        os.chdir(os.path.dirname(output))
+        if args.keep:
+            logging.info(f"Kept {workDir}")
+        else:
+            shutil.rmtree(workDir, ignore_errors=True)
+
+    result["time"] = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+    result["version"] = TOOL_VERSION
+    result["revision"] = gitRevision()
+
+    previous = lastResult(output, result)
+    with open(output, "a") as f:
+        f.write(json.dumps(result) + "\n")
+
+    print(json.dumps(result, indent=2))
+    if previous is None:
+        return 0
+
+    regressions = findRegressions(previous, result, args.threshold)
+    for regression in regressions:
+        logging.warning(f"Regression since {previous.get('revision')}: {regression}")
+    return 1 if len(regressions) > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
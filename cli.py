@@ -0,0 +1,336 @@
+import argparse
+import json
+import logging
+import sys
+import time
+
+from constants import DEFAULT_ROOT, LISTING_MAX_ROWS, MAX_PARALLEL_ROOTS
+from logs import setupLogging
+from utils import formatBytesToString
+
+"""
+Non-interactive entry point for scripts and cron jobs, used by main.py when it gets arguments.
+Never prompts, prints a summary instead of per-file tables and streams progress to stderr.
+
+    main.py sync --yes
+    main.py sync --dry-run --json --list-pending --page 2
+    main.py status --json
+    main.py watch
+    main.py sync --all --yes
+    main.py --root team-share sync --yes
+
+--root picks one of the roots registered with "roots add", see roots.py.
+
+Exit codes: 0 done, 1 the sync failed or some files failed, 2 not set up (no folder or not signed in).
+"""
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_NOT_SET_UP = 2
+
+# the SyncResult.summary() entries that report files acted on
+REPORTS = ["reused", "downloaded", "uploaded", "deletedLocal", "deletedRemote"]
+
+
+class ProgressPrinter:
+    """
+    Prints at most one progress line per interval to stderr, as JSON lines with asJson
+    """
+
+    def __init__(self, asJson: bool, interval: float = 1.0):
+        self.asJson = asJson
+        self.interval = interval
+        self.lastPrint = 0.0
+        self.failed = {"down": 0, "up": 0}
+
+    def __call__(self, direction: str, result, done: int, total: int):
+        if not result.success:
+            self.failed[direction] += 1
+
+        now = time.monotonic()
+        if done < total and now - self.lastPrint < self.interval:
+            return
+        self.lastPrint = now
+
+        if self.asJson:
+            line = json.dumps(
+                {
+                    "event": "progress",
+                    "direction": direction,
+                    "done": done,
+                    "total": total,
+                    "failed": self.failed[direction],
+                }
+            )
+        else:
+            verb = "Downloaded" if direction == "down" else "Uploaded"
+            line = f"{verb} {done}/{total} files, {self.failed[direction]} failed"
+        print(line, file=sys.stderr, flush=True)
+
+
+def _positiveInt(value: str) -> int:
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not a number: {value}")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
+
+def buildParser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="blazedcloud-sync", description="BlazedCloud Sync without the menu"
+    )
+    parser.add_argument("--verbose", action="store_true", help="also log to the terminal")
+    parser.add_argument("--root", help="run against this root instead of the default one")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    sync = commands.add_parser("sync", help="sync the offline folder once")
+    sync.add_argument("-y", "--yes", action="store_true", help="transfer without asking")
+    sync.add_argument("-n", "--dry-run", action="store_true", help="only show what would be transferred")
+    sync.add_argument("--json", action="store_true", help="print the summary as JSON")
+    sync.add_argument("--no-progress", action="store_true", help="don't report progress on stderr")
+    sync.add_argument("--list-pending", action="store_true", help="list pending files, one page at a time")
+    sync.add_argument("--page", type=_positiveInt, default=1)
+    sync.add_argument("--page-size", type=_positiveInt, default=LISTING_MAX_ROWS)
+    sync.add_argument("--all", action="store_true", help="sync every root in parallel")
+    sync.add_argument("--parallel", type=int, default=MAX_PARALLEL_ROOTS, help="roots synced at once with --all")
+    sync.add_argument("--max-transfers", type=int, default=0, help="transfers over all roots with --all, 0 is unlimited")
+    sync.add_argument("--max-download", type=int, default=0, help="bytes/s over all roots with --all, 0 is unlimited")
+    sync.add_argument("--max-upload", type=int, default=0, help="bytes/s over all roots with --all, 0 is unlimited")
+
+    status = commands.add_parser("status", help="show the folder, account and last sync")
+    status.add_argument("--json", action="store_true")
+
+    commands.add_parser("watch", help="keep the folder in sync until interrupted")
+    commands.add_parser("signin", help="sign in to the root's account, prompts for email and password")
+
+    roots = commands.add_parser("roots", help="list, add or remove sync roots")
+    rootCommands = roots.add_subparsers(dest="rootCommand", required=True)
+    rootList = rootCommands.add_parser("list", help="show every root")
+    rootList.add_argument("--json", action="store_true")
+    rootAdd = rootCommands.add_parser("add", help="add a root, then sign in with --root NAME signin")
+    rootAdd.add_argument("name")
+    rootAdd.add_argument("folder", help="the folder to keep synced")
+    rootAdd.add_argument("--backend", help="backend url, the default one if not given")
+    rootRemove = rootCommands.add_parser("remove", help="stop syncing a root, its state is kept")
+    rootRemove.add_argument("name")
+    return parser
+
+
+def _checkSetUp() -> bool:
+    from auth import getAuth
+    from configs import getOfflineFolder
+
+    if getOfflineFolder() is None:
+        logging.error("Offline folder not set, run without arguments to set it")
+        print("Offline folder not set", file=sys.stderr)
+        return False
+    if getAuth() is None:
+        logging.error("Not signed in, run without arguments to sign in")
+        print("Not signed in", file=sys.stderr)
+        return False
+    return True
+
+
+def runSync(args) -> int:
+    if args.all:
+        return runSyncAll(args)
+
+    from sync import Sync, pendingFiles, pendingPage
+
+    if not _checkSetUp():
+        return EXIT_NOT_SET_UP
+
+    onResult = None if args.no_progress else ProgressPrinter(args.json)
+    result = Sync(
+        assumeYes=args.yes, dryRun=args.dry_run, headless=True, onResult=onResult
+    )
+    if result is None:
+        print("Sync failed, see log.txt", file=sys.stderr)
+        return EXIT_FAILED
+
+    summary = result.summary()
+    if args.list_pending:
+        summary["pendingFiles"] = {
+            "page": args.page,
+            "pageSize": args.page_size,
+            "total": sum(1 for _ in pendingFiles(result.plan)),
+            "files": [
+                {"action": action, "path": path, "size": size}
+                for action, path, size in pendingPage(
+                    result.plan, args.page, args.page_size
+                )
+            ],
+        }
+
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        _printSummary(summary)
+        if not args.dry_run and not args.yes:
+            print("Nothing transferred, pass --yes to transfer", file=sys.stderr)
+
+    return EXIT_FAILED if _failedFiles(summary) > 0 else EXIT_OK
+
+
+def _failedFiles(summary: dict) -> int:
+    return sum(
+        summary[name]["failed"]
+        for name in REPORTS
+        if summary[name] is not None
+    )
+
+
+def runSyncAll(args) -> int:
+    from roots import syncRoots
+
+    def onDone(outcome: dict):
+        if args.no_progress:
+            return
+        if args.json:
+            line = json.dumps(
+                {"event": "root", "root": outcome["root"], "error": outcome.get("error")}
+            )
+        else:
+            line = f"Root {outcome['root']} " + ("failed" if "error" in outcome else "done")
+        print(line, file=sys.stderr, flush=True)
+
+    outcomes = syncRoots(
+        assumeYes=args.yes,
+        dryRun=args.dry_run,
+        maxParallel=args.parallel,
+        maxTransfers=args.max_transfers,
+        maxDownloadBytesPerSecond=args.max_download,
+        maxUploadBytesPerSecond=args.max_upload,
+        onDone=onDone,
+    )
+
+    if args.json:
+        print(json.dumps({"roots": outcomes}, indent=2))
+    else:
+        for name, outcome in outcomes.items():
+            print(f"[{name}]")
+            if "error" in outcome:
+                print(f"  {outcome['error']}")
+            else:
+                _printSummary(outcome["summary"])
+
+    failed = [
+        name
+        for name, outcome in outcomes.items()
+        if "error" in outcome or _failedFiles(outcome["summary"]) > 0
+    ]
+    return EXIT_FAILED if len(failed) > 0 else EXIT_OK
+
+
+def _printSummary(summary: dict):
+    for name, pending in summary["pending"].items():
+        if pending["files"] > 0:
+            print(
+                f"Pending {name}: {pending['files']} files, {formatBytesToString(pending['bytes'])}"
+            )
+    for name in REPORTS:
+        report = summary[name]
+        if report is not None:
+            print(
+                f"{name[0].upper() + name[1:]}: {report['succeeded']} files, "
+                f"{formatBytesToString(report['bytes'])}, {report['failed']} failed"
+            )
+            for error in report["errors"]:
+                print(f"  {error['path']}: {error['error']}")
+
+    listing = summary.get("pendingFiles")
+    if listing is not None:
+        print(
+            f"Pending files, page {listing['page']} of "
+            f"{max(1, -(-listing['total'] // listing['pageSize']))}:"
+        )
+        for file in listing["files"]:
+            print(f"  {file['action']:<8} {file['size']:>12}  {file['path']}")
+
+
+def runStatus(args) -> int:
+    from auth import getAuth
+    from configs import getLastSync, getOfflineFolder, getSyncSettings
+
+    auth = getAuth()
+    status = {
+        "root": args.root or DEFAULT_ROOT,
+        "offlineFolder": getOfflineFolder(),
+        "signedIn": auth is not None,
+        "email": auth[1].get("email") if auth is not None else None,
+        "lastSync": getLastSync(),
+        "syncSettings": vars(getSyncSettings()),
+    }
+    if args.json:
+        print(json.dumps(status, indent=2))
+    else:
+        for name, value in status.items():
+            print(f"{name}: {value}")
+    return EXIT_OK
+
+
+def runWatch(args) -> int:
+    from watcher import watch
+
+    if not _checkSetUp():
+        return EXIT_NOT_SET_UP
+    watch(headless=True)
+    return EXIT_OK
+
+
+def runSignIn(args) -> int:
+    from auth import initAuth
+
+    return EXIT_OK if initAuth() else EXIT_FAILED
+
+
+def runRoots(args) -> int:
+    from roots import addRoot, describeRoot, listRoots, removeRoot
+
+    try:
+        if args.rootCommand == "add":
+            stateDir = addRoot(args.name, args.folder, args.backend)
+            print(f"Added {args.name} in {stateDir}, sign in with: --root {args.name} signin")
+        elif args.rootCommand == "remove":
+            stateDir = removeRoot(args.name)
+            print(f"Removed {args.name}, its state is still in {stateDir}")
+        else:
+            roots = {name: describeRoot(stateDir) for name, stateDir in listRoots().items()}
+            if args.json:
+                print(json.dumps(roots, indent=2))
+            else:
+                for name, root in roots.items():
+                    print(
+                        f"{name}: {root['offlineFolder'] or 'no folder'}, "
+                        f"{root['email'] or 'not signed in'}, {root['stateDir']}"
+                    )
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return EXIT_FAILED
+    return EXIT_OK
+
+
+def main(argv: list[str]) -> int:
+    args = buildParser().parse_args(argv)
+    if args.root is not None:
+        from roots import useRoot
+
+        try:
+            useRoot(args.root)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            return EXIT_NOT_SET_UP
+    setupLogging(console=args.verbose)
+
+    if args.command == "sync":
+        return runSync(args)
+    if args.command == "status":
+        return runStatus(args)
+    if args.command == "signin":
+        return runSignIn(args)
+    if args.command == "roots":
+        return runRoots(args)
+    return runWatch(args)
@@ -1,100 +1,174 @@
 import logging
-
-from tinydb import Query, TinyDB
+import os
+import threading
 
 from constants import DEFAULT_BACKEND_URL
 from models.syncSettings import SyncSettings
+from stateStore import getStateStore
+from transport import configureTransport
 from utils import promptUserForOfflineFolder
 
-db = TinyDB("db.json", sort_keys=True)
+# keys that belong to other modules and survive clearSavedData
+PRESERVED_KEYS = ["user", "migratedTinyDb", "roots"]
 
 
-def getBackendUrl() -> str:
-    query = Query()
-    url = db.search(query.backendUrl.exists())
+class ConfigSnapshot:
+    """
+    Typed in-memory copy of the settings in the state store, loaded once.
 
-    if url is None or len(url) == 0:
-        db.insert({"backendUrl": DEFAULT_BACKEND_URL})
-        return DEFAULT_BACKEND_URL
+    Accessors read attributes from here instead of querying the store. Changes go
+    through update(), which writes them to the store first and then notifies subscribers.
+    load() notifies them too, so a reload for another root reaches them.
+    """
 
-    extractedUrl = url[0].get("backendUrl")
-    logging.info(f"Backend URL: {extractedUrl}")
-    return extractedUrl
+    NAMES = ["backendUrl", "offlineFolder", "syncSettings", "lastSync"]
 
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.listeners = []
+        self.load()
 
-def updateOfflineFolder() -> str:
-    """
-    Prompts the user for a folder to keep synced and saves it to the database
-    """
+    def load(self):
+        values = getStateStore().getSettings()
 
-    folder = promptUserForOfflineFolder()
-    logging.info(f"Updating offline folder to {folder}")
+        with self.lock:
+            self.backendUrl: str | None = values.get("backendUrl")
+            self.offlineFolder: str | None = self._normalizeFolder(
+                values.get("offlineFolder")
+            )
+            self.syncSettings: SyncSettings = self._toSyncSettings(
+                values.get("syncSettings")
+            )
+            self.lastSync: str | None = values.get("lastSync")
+            listeners = list(self.listeners)
 
-    query = Query()
-    db.upsert({"offlineFolder": folder}, query.offlineFolder.exists())
-    logging.info(f"Updated offline folder to {folder}")
+        # a reload, like entering another root, replaces every setting
+        for name in self.NAMES:
+            self._notify(listeners, name, getattr(self, name))
 
-    return folder
+    @staticmethod
+    def _normalizeFolder(folder: str | None) -> str | None:
+        if folder is None or len(folder) == 0:
+            return None
 
+        # if windows, replace / with \
+        if os.name == "nt" and "\\" not in folder:
+            folder = folder.replace("/", "\\")
 
-def getOfflineFolder() -> str | None:
-    query = Query()
-    folder = db.search(query.offlineFolder.exists())
+        return folder
+
+    @staticmethod
+    def _toSyncSettings(stored) -> SyncSettings:
+        settings = SyncSettings()
+        if isinstance(stored, SyncSettings):
+            return stored
+        if isinstance(stored, dict):
+            settings.__dict__.update(stored)
+        return settings
+
+    def update(self, name: str, value):
+        """
+        Saves a single setting to the store and the snapshot
+        """
+
+        stored = vars(value) if isinstance(value, SyncSettings) else value
+        getStateStore().setSetting(name, stored)
+
+        with self.lock:
+            if name == "offlineFolder":
+                value = self._normalizeFolder(value)
+            elif name == "syncSettings":
+                value = self._toSyncSettings(stored)
+            setattr(self, name, value)
+            listeners = list(self.listeners)
 
-    if folder is None or len(folder) == 0:
-        return None
+        self._notify(listeners, name, value)
 
-    extractedFolder = folder[0].get("offlineFolder")
-    if extractedFolder is None or len(extractedFolder) == 0:
-        return None
+    @staticmethod
+    def _notify(listeners, name: str, value):
+        for listener in listeners:
+            try:
+                listener(name, value)
+            except Exception as e:
+                logging.error("Config listener failed for %s: %s", name, e)
 
-    logging.info(f"Offline folder: {extractedFolder}")
+    def subscribe(self, listener):
+        """
+        Calls listener(name, value) with the current settings, and after every update or reload
+        """
 
-    # if windows, replace / with \
-    if "\\" not in extractedFolder:
-        extractedFolder = extractedFolder.replace("/", "\\")
+        with self.lock:
+            self.listeners.append(listener)
+            values = {name: getattr(self, name) for name in self.NAMES}
+        for name, value in values.items():
+            self._notify([listener], name, value)
 
-    return extractedFolder
 
+config = ConfigSnapshot()
 
-def getSyncSettings() -> SyncSettings | None:
-    query = Query()
-    settings = db.search(query.syncSettings.exists())
 
-    if settings is None or len(settings) == 0:
-        return SyncSettings()
+def _configureTransport(name: str, value):
+    if name == "syncSettings":
+        configureTransport(
+            maxConnections=value.httpMaxConnections,
+            readTimeout=value.httpReadTimeoutSeconds,
+        )
 
-    extractedSettings = settings[0].get("syncSettings")  # type: SyncSettings
-    logging.info(f"Sync settings: {extractedSettings}")
 
-    return extractedSettings
+config.subscribe(_configureTransport)
+
+
+def getBackendUrl() -> str:
+    if config.backendUrl is None:
+        config.update("backendUrl", DEFAULT_BACKEND_URL)
+        logging.info("Backend URL: %s", DEFAULT_BACKEND_URL)
+
+    return config.backendUrl
+
+
+def updateOfflineFolder() -> str:
+    """
+    Prompts the user for a folder to keep synced and saves it to the database
+    """
+
+    folder = promptUserForOfflineFolder()
+    logging.info("Updating offline folder to %s", folder)
+
+    config.update("offlineFolder", folder)
+    logging.info("Updated offline folder to %s", folder)
+
+    return folder
+
+
+def getOfflineFolder() -> str | None:
+    return config.offlineFolder
+
+
+def getSyncSettings() -> SyncSettings:
+    return config.syncSettings
 
 
 def updateSyncSettings(settings):
-    query = Query()
-    db.upsert({"syncSettings": settings}, query.syncSettings.exists())
-    logging.info(f"Updated sync settings to {settings}")
+    config.update("syncSettings", settings)
+    logging.info("Updated sync settings to %s", settings)
 
 
 def clearSavedData():
-    db.truncate()
+    store = getStateStore()
+    store.deleteSettings(
+        [key for key in store.getSettings() if key not in PRESERVED_KEYS]
+    )
+    config.load()
     logging.info("Cleared saved data")
 
 
 def updateLastSync():
-    query = Query()
-    db.upsert({"lastSync": "10/10/2021 10:00 AM"}, query.lastSync.exists())
+    config.update("lastSync", "10/10/2021 10:00 AM")
     logging.info("Updated last sync")
 
 
 def getLastSync() -> str:
-    query = Query()
-    lastSync = db.search(query.lastSync.exists())
-
-    if lastSync is None or len(lastSync) == 0:
+    if config.lastSync is None:
         return "Never"
 
-    extractedLastSync = lastSync[0].get("lastSync")
-    logging.info(f"Last sync: {extractedLastSync}")
-
-    return extractedLastSync
+    return config.lastSync
@@ -1,2 +1,32 @@
 TOOL_VERSION = "0.1.0"
 DEFAULT_BACKEND_URL = "https://pb.blazedcloud.com/"
+DEFAULT_MAX_CONCURRENT_TRANSFERS = 8
+MULTIPART_THRESHOLD = 64 * 1024 * 1024
+MULTIPART_PART_SIZE = 16 * 1024 * 1024
+MAX_PART_RETRIES = 3
+WATCH_DEBOUNCE_SECONDS = 2.0
+WATCH_MAX_DELAY_SECONDS = 30.0
+WATCH_REMOTE_POLL_SECONDS = 300.0
+PRESIGN_BATCH_SIZE = 100
+PRESIGN_DEFAULT_TTL_SECONDS = 15 * 60
+PRESIGN_CACHE_MAX_ENTRIES = 100_000
+HTTP_MAX_CONNECTIONS = 64
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 32
+HTTP_KEEPALIVE_EXPIRY_SECONDS = 30.0
+HTTP_CONNECT_TIMEOUT_SECONDS = 10.0
+HTTP_READ_TIMEOUT_SECONDS = 60.0
+BANDWIDTH_BURST_SECONDS = 1
+DEFAULT_TRANSFER_PRIORITY = "smallest"
+LOG_FILE = "log.txt"
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUP_COUNT = 3
+LOG_SAMPLE_LIMIT = 20
+LISTING_MAX_ROWS = 50
+UPDATE_CHECK_TTL_SECONDS = 24 * 60 * 60
+ROOTS_DIR = "roots"
+DEFAULT_ROOT = "default"
+MAX_PARALLEL_ROOTS = 4
+SCAN_WORKERS = 8
+PIPELINE_POLL_SECONDS = 0.2
+DELETE_BATCH_SIZE = 1000
+TRANSFER_JOURNAL_MAX_ROWS = 100_000
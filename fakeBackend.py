@@ -0,0 +1,397 @@
+import hashlib
+import json
+import logging
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, unquote, urlparse
+
+from scheduler import TokenBucket
+
+"""
+Local stand-in for the BlazedCloud backend and its object storage, so sync, download
+and upload can be exercised offline.
+
+Point the tool at it by setting the backend url to FakeBackend.url, or run it directly:
+
+    python fakeBackend.py 8090 [latency seconds] [bandwidth bytes/s]
+
+latency is added to every request, and bandwidth caps the object and part bodies sent
+and received across all connections together, like a shared uplink.
+
+The listing carries an ETag and an X-Listing-Cursor. If-None-Match is answered with 304
+while nothing changed, and ?since=<cursor> with only the changes since then, unless
+supportsConditionalListing is off.
+"""
+
+FAKE_UID = "fakeuser0000001"
+FAKE_TOKEN = "fake-token"
+LINK_CHUNK_SIZE = 64 * 1024
+
+
+class StoredObject:
+    def __init__(self, data: bytes, etag: str | None = None):
+        self.data = data
+        self.etag = etag or hashlib.md5(data).hexdigest()
+        self.lastModified = datetime.now(timezone.utc)
+
+    def toListing(self, uid: str, key: str) -> dict:
+        return {
+            "ChecksumAlgorithm": None,
+            "ETag": f'"{self.etag}"',
+            "Key": f"{uid}/{key}",
+            "LastModified": self.lastModified.strftime("%Y-%m-%dT%H:%M:%S.")
+            + f"{self.lastModified.microsecond // 1000:03d}Z",
+            "Owner": None,
+            "RestoreStatus": None,
+            "Size": len(self.data),
+            "StorageClass": "STANDARD",
+        }
+
+
+class FakeBackend:
+    """
+    Serves the auth, data/listall, data/down and data/delete (single and batch), data/up and
+    multipart endpoints, plus presigned object GET (with Range) and PUT, from memory
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        uid: str = FAKE_UID,
+        supportsBatchPresign: bool = True,
+        latency: float = 0.0,
+        bandwidth: int = 0,
+        supportsConditionalListing: bool = True,
+        supportsBatchDelete: bool = True,
+        supportsMultipart: bool = True,
+    ):
+        self.uid = uid
+        self.supportsBatchPresign = supportsBatchPresign
+        self.supportsConditionalListing = supportsConditionalListing
+        self.supportsBatchDelete = supportsBatchDelete
+        self.supportsMultipart = supportsMultipart
+        self.latency = latency
+        self.link = TokenBucket(bandwidth)
+        self.objects: dict[str, StoredObject] = {}
+        self.uploads: dict[str, dict[int, bytes]] = {}
+        self.requestCounts: dict[str, int] = {}
+        # listing version, bumped on every change, and the version each key last changed at
+        self.instance = uuid.uuid4().hex[:8]
+        self.version = 0
+        self.changedAt: dict[str, int] = {}
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._makeHandler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self) -> "FakeBackend":
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        logging.info(f"Fake backend listening on {self.url}")
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def putObject(self, key: str, data: bytes):
+        with self.lock:
+            self._store(key.replace("\\", "/"), StoredObject(data))
+
+    def deleteObject(self, key: str):
+        with self.lock:
+            self._store(key.replace("\\", "/"), None)
+
+    def _store(self, key: str, object: StoredObject | None):
+        """
+        Call with the lock held, object None deletes the key
+        """
+
+        if object is None:
+            self.objects.pop(key, None)
+        else:
+            self.objects[key] = object
+        self.version += 1
+        self.changedAt[key] = self.version
+
+    def _listing(self, since: str | None) -> tuple[list[dict], bool, str]:
+        """
+        Returns the listing entries, whether they are only the changes since the cursor, and the new cursor
+        """
+
+        with self.lock:
+            cursor = f"{self.instance}-{self.version}"
+            instance, _, version = (since or "").partition("-")
+            if instance != self.instance or not version.isdigit():
+                listing = [
+                    object.toListing(self.uid, key) for key, object in self.objects.items()
+                ]
+                return listing, False, cursor
+
+            listing = []
+            for key, changed in self.changedAt.items():
+                if changed <= int(version):
+                    continue
+                object = self.objects.get(key)
+                if object is None:
+                    listing.append({"Key": f"{self.uid}/{key}", "Deleted": True})
+                else:
+                    listing.append(object.toListing(self.uid, key))
+            return listing, True, cursor
+
+    def _count(self, endpoint: str):
+        with self.lock:
+            self.requestCounts[endpoint] = self.requestCounts.get(endpoint, 0) + 1
+
+    def _makeHandler(backend):
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                logging.debug("fake backend: " + format % args)
+
+            def parse_request(self):
+                if not super().parse_request():
+                    return False
+                if backend.latency > 0:
+                    time.sleep(backend.latency)
+                return True
+
+            def do_GET(self):
+                path = urlparse(self.path).path
+                if path == "/api/health":
+                    backend._count("health")
+                    self._sendJson({"code": 200, "message": "API is healthy."})
+                elif path.startswith("/data/listall/"):
+                    self._listAll()
+                elif path.startswith("/data/usage/"):
+                    backend._count("usage")
+                    with backend.lock:
+                        used = sum(len(o.data) for o in backend.objects.values())
+                    self._send(200, str(used).encode(), "text/plain")
+                elif path.startswith("/objects/"):
+                    backend._count("object_get")
+                    self._getObject(unquote(path[len("/objects/") :]))
+                else:
+                    self._send(404, b"not found", "text/plain")
+
+            def do_PUT(self):
+                path = urlparse(self.path).path
+                body = self._readBody()
+                if path.startswith("/objects/"):
+                    backend._count("object_put")
+                    object = StoredObject(body)
+                    with backend.lock:
+                        backend._store(unquote(path[len("/objects/") :]), object)
+                    self._send(200, b"", "text/plain", {"ETag": f'"{object.etag}"'})
+                elif path.startswith("/parts/"):
+                    backend._count("part_put")
+                    uploadId, number = path[len("/parts/") :].split("/")
+                    with backend.lock:
+                        if uploadId not in backend.uploads:
+                            self._send(404, b"no such upload", "text/plain")
+                            return
+                        backend.uploads[uploadId][int(number)] = body
+                    etag = hashlib.md5(body).hexdigest()
+                    self._send(200, b"", "text/plain", {"ETag": f'"{etag}"'})
+                else:
+                    self._send(404, b"not found", "text/plain")
+
+            def do_POST(self):
+                path = urlparse(self.path).path
+                body = self._readBody()
+                if path.startswith("/api/collections/users/auth-"):
+                    backend._count("auth")
+                    self._sendJson(
+                        {
+                            "token": FAKE_TOKEN,
+                            "record": {"id": backend.uid, "email": "fake@localhost"},
+                        }
+                    )
+                    return
+
+                if self.headers.get("Authorization") != f"Bearer {FAKE_TOKEN}":
+                    self._send(401, b"unauthorized", "text/plain")
+                    return
+
+                if path.startswith("/data/up/multipart/"):
+                    if not backend.supportsMultipart:
+                        self._send(404, b"not found", "text/plain")
+                        return
+                    self._multipart(path, json.loads(body or b"{}"))
+                elif path.startswith("/data/down/batch/"):
+                    if not backend.supportsBatchPresign:
+                        self._send(404, b"not found", "text/plain")
+                        return
+                    backend._count("down_batch")
+                    keys = json.loads(body or b"{}").get("filenames", [])
+                    self._sendJson({key: self._objectUrl(key) for key in keys})
+                elif path.startswith("/data/delete/batch/"):
+                    if not backend.supportsBatchDelete:
+                        self._send(404, b"not found", "text/plain")
+                        return
+                    backend._count("delete_batch")
+                    keys = json.loads(body or b"{}").get("filenames", [])
+                    with backend.lock:
+                        deleted = [key for key in keys if key in backend.objects]
+                        for key in deleted:
+                            backend._store(key, None)
+                    self._sendJson(keys)
+                elif path.startswith("/data/delete/"):
+                    backend._count("delete")
+                    key = parse_qs(body.decode()).get("filename", [""])[0]
+                    backend.deleteObject(key)
+                    self._send(200, b"", "text/plain")
+                elif path.startswith("/data/down/") or path.startswith("/data/up/"):
+                    backend._count("down" if "/down/" in path else "up")
+                    form = parse_qs(body.decode())
+                    key = form.get("filename", [""])[0].replace("\\", "/")
+                    self._send(200, self._objectUrl(key).encode(), "text/plain")
+                else:
+                    self._send(404, b"not found", "text/plain")
+
+            def _listAll(self):
+                if not backend.supportsConditionalListing:
+                    backend._count("listall")
+                    listing, _, _ = backend._listing(None)
+                    self._sendJson(listing)
+                    return
+
+                with backend.lock:
+                    etag = f'"{backend.instance}-{backend.version}"'
+                if self.headers.get("If-None-Match") == etag:
+                    backend._count("listall_not_modified")
+                    self._send(304, b"", "application/json", {"ETag": etag})
+                    return
+
+                query = parse_qs(urlparse(self.path).query)
+                since = query.get("since", [None])[0]
+                listing, delta, cursor = backend._listing(since)
+                backend._count("listall_delta" if delta else "listall")
+                headers = {"ETag": etag, "X-Listing-Cursor": cursor}
+                if delta:
+                    headers["X-Listing-Delta"] = "true"
+                self._send(200, json.dumps(listing).encode(), "application/json", headers)
+
+            def _multipart(self, path, payload):
+                key = str(payload.get("filename", "")).replace("\\", "/")
+                if path.endswith("/part"):
+                    backend._count("multipart_part")
+                    url = f"{backend.url}parts/{payload['uploadId']}/{payload['partNumber']}"
+                    self._send(200, url.encode(), "text/plain")
+                elif path.endswith("/complete"):
+                    backend._count("multipart_complete")
+                    with backend.lock:
+                        parts = backend.uploads.pop(payload["uploadId"], None)
+                    if parts is None:
+                        self._send(404, b"no such upload", "text/plain")
+                        return
+                    numbers = [part["PartNumber"] for part in payload["parts"]]
+                    data = b"".join(parts[number] for number in numbers)
+                    digests = b"".join(
+                        hashlib.md5(parts[number]).digest() for number in numbers
+                    )
+                    etag = f"{hashlib.md5(digests).hexdigest()}-{len(numbers)}"
+                    with backend.lock:
+                        backend._store(key, StoredObject(data, etag))
+                    self._sendJson({"ETag": f'"{etag}"'})
+                elif path.endswith("/abort"):
+                    backend._count("multipart_abort")
+                    with backend.lock:
+                        backend.uploads.pop(payload.get("uploadId"), None)
+                    self._sendJson({})
+                else:
+                    backend._count("multipart_start")
+                    uploadId = uuid.uuid4().hex
+                    with backend.lock:
+                        backend.uploads[uploadId] = {}
+                    self._sendJson({"uploadId": uploadId})
+
+            def _getObject(self, key):
+                with backend.lock:
+                    object = backend.objects.get(key)
+                if object is None:
+                    self._send(404, b"no such key", "text/plain")
+                    return
+
+                data = object.data
+                rangeHeader = self.headers.get("Range")
+                ifRange = self.headers.get("If-Range")
+                if rangeHeader and (ifRange is None or ifRange == f'"{object.etag}"'):
+                    start = int(rangeHeader.split("=")[1].split("-")[0])
+                    headers = {
+                        "Content-Range": f"bytes {start}-{len(data) - 1}/{len(data)}",
+                        "ETag": f'"{object.etag}"',
+                    }
+                    self._send(206, data[start:], "application/octet-stream", headers)
+                    return
+
+                self._send(
+                    200, data, "application/octet-stream", {"ETag": f'"{object.etag}"'}
+                )
+
+            def _objectUrl(self, key):
+                expires = int(time.time()) + 3600
+                return f"{backend.url}objects/{quote(key)}?X-Amz-Expires=3600&expires={expires}"
+
+            def _readBody(self) -> bytes:
+                if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+                    chunks = []
+                    while True:
+                        size = int(self.rfile.readline().strip(), 16)
+                        if size == 0:
+                            self.rfile.readline()
+                            return b"".join(chunks)
+                        backend.link.consume(size)
+                        chunks.append(self.rfile.read(size))
+                        self.rfile.readline()
+                length = int(self.headers.get("Content-Length", 0))
+                chunks = []
+                while length > 0:
+                    chunk = self.rfile.read(min(length, LINK_CHUNK_SIZE))
+                    if not chunk:
+                        break
+                    backend.link.consume(len(chunk))
+                    chunks.append(chunk)
+                    length -= len(chunk)
+                return b"".join(chunks)
+
+            def _sendJson(self, data):
+                self._send(200, json.dumps(data).encode(), "application/json")
+
+            def _send(self, status, body: bytes, contentType, headers=None):
+                self.send_response(status)
+                self.send_header("Content-Type", contentType)
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                view = memoryview(body)
+                for start in range(0, len(body), LINK_CHUNK_SIZE):
+                    chunk = view[start : start + LINK_CHUNK_SIZE]
+                    backend.link.consume(len(chunk))
+                    self.wfile.write(chunk)
+
+        return Handler
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8090
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+    bandwidth = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+    backend = FakeBackend(port=port, latency=latency, bandwidth=bandwidth).start()
+    try:
+        backend.thread.join()
+    except KeyboardInterrupt:
+        backend.stop()
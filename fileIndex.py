@@ -0,0 +1,435 @@
+import json
+import logging
+import os
+from dataclasses import astuple, dataclass
+
+from constants import SCAN_WORKERS
+from paths import normalizePath
+from scanner import DirListing, ScanRecord, joinRel, listDir, statRecord, walkParallel
+from stateStore import StateStore, getStateStore
+
+
+@dataclass
+class FileState:
+    relPath: str
+    size: int
+    mtime_ns: int
+    inode: int
+    etag: str | None = None  # etag of the server object when this file was last synced
+    syncedSize: int | None = None
+    syncedMtime_ns: int | None = None
+
+    def isUnchangedSinceSync(self) -> bool:
+        return (
+            self.etag is not None
+            and self.size == self.syncedSize
+            and self.mtime_ns == self.syncedMtime_ns
+        )
+
+
+@dataclass
+class DirState:
+    mtime_ns: int
+    files: list[str]
+    subdirs: list[str]
+
+
+class FileIndex:
+    """
+    Persistent record of every local file's stat result and the etag it was last synced at.
+
+    scan() only lists directories whose mtime changed since the previous run,
+    and reuses the stored stat results of everything else. Directories are read on
+    workers scanner threads. save() only writes the entries that changed since they
+    were loaded.
+    """
+
+    def __init__(
+        self, folder: str, store: StateStore | None = None, workers: int = SCAN_WORKERS
+    ):
+        self.folder = folder
+        self.store = store if store is not None else getStateStore()
+        self.workers = workers
+        self.files: dict[str, FileState] = {}
+        self.dirs: dict[str, DirState] = {}
+        self.deleted: dict[str, str] = {}  # synced files that are gone locally, key -> etag
+        self.touchedFiles: set[str] = set()
+        self.touchedDirs: set[str] = set()
+        self.touchedDeleted: set[str] = set()
+        # (inode, size, mtime_ns) of file versions replaced or forgotten since the last save
+        self.droppedStats: set[tuple[int, int, int]] = set()
+        # directories the last scan or refresh couldn't read, nothing below them is forgotten
+        self.failedDirs: set[str] = set()
+        self.load()
+
+    def load(self):
+        rows = self.store.query(
+            "SELECT key, rel_path, size, mtime_ns, inode, etag, synced_size, synced_mtime_ns"
+            " FROM local_manifest WHERE root = ?",
+            (self.folder,),
+        )
+        self.files = {row[0]: FileState(*row[1:]) for row in rows}
+
+        rows = self.store.query(
+            "SELECT rel_dir, mtime_ns, files, subdirs FROM local_dirs WHERE root = ?",
+            (self.folder,),
+        )
+        self.dirs = {
+            relDir: DirState(mtime_ns, json.loads(files), json.loads(subdirs))
+            for relDir, mtime_ns, files, subdirs in rows
+        }
+
+        rows = self.store.query(
+            "SELECT key, etag FROM local_deleted WHERE root = ?", (self.folder,)
+        )
+        self.deleted = dict(rows)
+        logging.info("Loaded file index with %d files", len(self.files))
+
+    def save(self):
+        root = self.folder
+        with self.store.transaction() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO local_manifest (root, key, rel_path, size, mtime_ns,"
+                " inode, etag, synced_size, synced_mtime_ns) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (root, key, *astuple(self.files[key]))
+                    for key in self.touchedFiles
+                    if key in self.files
+                ],
+            )
+            connection.executemany(
+                "DELETE FROM local_manifest WHERE root = ? AND key = ?",
+                [(root, key) for key in self.touchedFiles if key not in self.files],
+            )
+            connection.executemany(
+                "INSERT OR REPLACE INTO local_dirs (root, rel_dir, mtime_ns, files, subdirs)"
+                " VALUES (?, ?, ?, ?, ?)",
+                [
+                    (
+                        root,
+                        relDir,
+                        self.dirs[relDir].mtime_ns,
+                        json.dumps(self.dirs[relDir].files),
+                        json.dumps(self.dirs[relDir].subdirs),
+                    )
+                    for relDir in self.touchedDirs
+                    if relDir in self.dirs
+                ],
+            )
+            connection.executemany(
+                "DELETE FROM local_dirs WHERE root = ? AND rel_dir = ?",
+                [(root, relDir) for relDir in self.touchedDirs if relDir not in self.dirs],
+            )
+            connection.executemany(
+                "INSERT OR REPLACE INTO local_deleted (root, key, etag) VALUES (?, ?, ?)",
+                [
+                    (root, key, self.deleted[key])
+                    for key in self.touchedDeleted
+                    if key in self.deleted
+                ],
+            )
+            connection.executemany(
+                "DELETE FROM local_deleted WHERE root = ? AND key = ?",
+                [(root, key) for key in self.touchedDeleted if key not in self.deleted],
+            )
+
+        logging.info(
+            "Saved file index, %d of %d files changed",
+            len(self.touchedFiles),
+            len(self.files),
+        )
+        self.touchedFiles.clear()
+        self.touchedDirs.clear()
+        self.touchedDeleted.clear()
+        self.droppedStats.clear()
+
+    def scan(self, verifyFiles: bool = True, onDir=None):
+        """
+        Returns [0] the relative paths of all files in the folder, and [1] the absolute paths of all files in the folder,
+        the same as utils.getAllFilesFromFolder
+
+        Directories whose mtime is unchanged are not listed again. Their files are still
+        stat'ed when verifyFiles is True, because editing a file in place doesn't change
+        the mtime of its directory. With verifyFiles False those edits go unnoticed
+        until something is added, removed or renamed in the same directory.
+
+        onDir(relDir) is called once the files of a directory are in the index. Files that
+        vanished are only forgotten when the whole scan is done.
+        """
+
+        self.failedDirs.clear()
+        relativePaths, absolutePaths = self._walk("", verifyFiles, onDir)
+        return relativePaths, absolutePaths
+
+    def refresh(self, relPaths):
+        """
+        Updates only the given paths, which may be files or directories that were created,
+        changed or deleted, without walking the rest of the folder
+        """
+
+        parents: set[str] = set()
+        walkDirs: set[str] = set()
+        for relPath in relPaths:
+            relPath = relPath.strip(os.sep)
+            absPath = os.path.join(self.folder, relPath)
+            if os.path.isdir(absPath):
+                walkDirs.add(relPath)
+            elif os.path.isfile(absPath):
+                key = normalizePath(relPath)
+                self._applyRecord(key, statRecord(self.folder, relPath), self.files.get(key))
+            if relPath:
+                parents.add(os.path.dirname(relPath))
+
+        # relist each parent to pick up additions and removals
+        for relDir in parents:
+            old = self.dirs.get(relDir)
+            try:
+                listing = listDir(self.folder, relDir)
+            except FileNotFoundError:
+                # the parent itself is gone, relisting its own parent handles it
+                continue
+            except OSError as e:
+                logging.error("Failed to scan %s: %s", relDir or ".", e)
+                self.failedDirs.add(relDir)
+                continue
+            new = self._storeListing(listing)
+
+            oldFiles = set(old.files) if old is not None else set()
+            oldSubdirs = set(old.subdirs) if old is not None else set()
+            for name in oldFiles - set(new.files):
+                self._forgetFile(normalizePath(joinRel(relDir, name)))
+            # the listing stat'ed every file anyway
+            for record in listing.files:
+                key = normalizePath(record.relPath)
+                self._applyRecord(key, record, self.files.get(key))
+            for name in oldSubdirs - set(new.subdirs):
+                self._forgetTree(joinRel(relDir, name))
+            for name in set(new.subdirs) - oldSubdirs:
+                walkDirs.add(joinRel(relDir, name))
+
+        for relDir in walkDirs:
+            self._walk(relDir, True)
+
+    def listed(self):
+        """
+        Returns the same lists as scan() from the index alone, without touching the disk
+        """
+
+        relativePaths = [state.relPath for state in self.files.values()]
+        absolutePaths = [os.path.join(self.folder, relPath) for relPath in relativePaths]
+        return relativePaths, absolutePaths
+
+    def _walk(self, startDir: str, verifyFiles: bool, onDir=None):
+        relativePaths: list[str] = []
+        absolutePaths: list[str] = []
+        seenFiles: set[str] = set()
+        seenDirs: set[str] = set()
+
+        def visit(relDir: str):
+            read = self._readDir(relDir, verifyFiles)
+            return read, read[1].subdirs
+
+        # the threads only read the index, every change is made here
+        for relDir, (changed, listing) in walkParallel(
+            visit, startDir, self.workers, self.failedDirs
+        ):
+            seenDirs.add(relDir)
+            if changed:
+                self._storeListing(listing)
+
+            records = {record.relPath: record for record in listing.files}
+            for name in self.dirs[relDir].files:
+                relPath = joinRel(relDir, name)
+                key = normalizePath(relPath)
+
+                state = self.files.get(key)
+                record = records.get(relPath)
+                if record is not None:
+                    state = self._applyRecord(key, record, state)
+                elif changed or verifyFiles or state is None:
+                    # gone before it could be stat'ed
+                    self._forgetFile(key)
+                    continue
+
+                seenFiles.add(key)
+                relativePaths.append(relPath)
+                absolutePaths.append(os.path.join(self.folder, relPath))
+
+            if onDir is not None:
+                onDir(relDir)
+
+        # forget anything under startDir that disappeared, but not what couldn't be read
+        prefix = normalizePath(startDir) + "/" if startDir else ""
+        for key in [key for key in self.files if key.startswith(prefix)]:
+            if key not in seenFiles and not self._isFailed(self.files[key].relPath):
+                self._forgetFile(key)
+        for relDir in [relDir for relDir in self.dirs if self._isUnder(relDir, startDir)]:
+            if relDir not in seenDirs and not self._isFailed(relDir):
+                self._forgetDir(relDir)
+
+        return relativePaths, absolutePaths
+
+    def _isFailed(self, relPath: str) -> bool:
+        return any(self._isUnder(relPath, relDir) for relDir in self.failedDirs)
+
+    @staticmethod
+    def _isUnder(relPath: str, relDir: str) -> bool:
+        return relDir == "" or relPath == relDir or relPath.startswith(relDir + os.sep)
+
+    def _forgetFile(self, key: str):
+        state = self.files.get(key)
+        if state is None:
+            return
+
+        # recorded as deleted before it leaves files, the pipeline reads both while scanning
+        if state.etag is not None:
+            self.deleted[key] = state.etag
+            self.touchedDeleted.add(key)
+        del self.files[key]
+        self.droppedStats.add((state.inode, state.size, state.mtime_ns))
+        self.touchedFiles.add(key)
+
+    def _forgetDir(self, relDir: str):
+        del self.dirs[relDir]
+        self.touchedDirs.add(relDir)
+
+    def _forgetTree(self, relDir: str):
+        prefix = normalizePath(relDir) + "/"
+        for key in [key for key in self.files if key.startswith(prefix)]:
+            self._forgetFile(key)
+        for known in [known for known in self.dirs if self._isUnder(known, relDir)]:
+            self._forgetDir(known)
+
+    def _readDir(self, relDir: str, verifyFiles: bool) -> tuple[bool, DirListing]:
+        """
+        Runs on a scanner thread. Lists relDir again if its mtime changed, otherwise
+        stats the files the index has for it, only the unknown ones without verifyFiles.
+        Returns whether it was listed again, and the listing.
+        """
+
+        absDir = os.path.join(self.folder, relDir) if relDir else self.folder
+        known = self.dirs.get(relDir)
+        if known is None or known.mtime_ns != os.stat(absDir).st_mtime_ns:
+            return True, listDir(self.folder, relDir)
+
+        records = []
+        for name in known.files:
+            relPath = joinRel(relDir, name)
+            if verifyFiles or normalizePath(relPath) not in self.files:
+                record = statRecord(self.folder, relPath)
+                if record is not None:
+                    records.append(record)
+        return False, DirListing(relDir, known.mtime_ns, records, known.subdirs)
+
+    def _storeListing(self, listing: DirListing) -> DirState:
+        state = DirState(
+            listing.mtime_ns,
+            [os.path.basename(record.relPath) for record in listing.files],
+            listing.subdirs,
+        )
+        self.dirs[listing.relDir] = state
+        self.touchedDirs.add(listing.relDir)
+        return state
+
+    def _statFile(self, key, relPath, absPath, state: FileState | None):
+        try:
+            stats = os.stat(absPath)
+        except OSError:
+            return self._applyRecord(key, None, state)
+
+        record = ScanRecord(relPath, stats.st_size, stats.st_mtime_ns, stats.st_ino)
+        return self._applyRecord(key, record, state)
+
+    def _applyRecord(self, key, record: ScanRecord | None, state: FileState | None):
+        if record is None:
+            self._forgetFile(key)
+            return None
+
+        if self.deleted.pop(key, None) is not None:
+            self.touchedDeleted.add(key)
+
+        if state is None:
+            state = FileState(*record)
+            self.files[key] = state
+            self.touchedFiles.add(key)
+        elif (state.relPath, state.size, state.mtime_ns, state.inode) != record:
+            self.droppedStats.add((state.inode, state.size, state.mtime_ns))
+            state.relPath, state.size, state.mtime_ns, state.inode = record
+            self.touchedFiles.add(key)
+        return state
+
+    def replacedStats(self) -> set[tuple[int, int, int]]:
+        """
+        Returns the (inode, size, mtime_ns) of file versions replaced or forgotten since the
+        last save that no file has anymore, a renamed file keeps its own
+        """
+
+        current = set()
+        for key in self.touchedFiles:
+            state = self.files.get(key)
+            if state is not None:
+                current.add((state.inode, state.size, state.mtime_ns))
+        return self.droppedStats - current
+
+    def get(self, relPath: str) -> FileState | None:
+        return self.files.get(normalizePath(relPath))
+
+    def markSynced(self, relPath: str, etag: str, absPath: str | None = None):
+        """
+        Records that the local file matches the server object with the given etag.
+
+        Pass absPath after writing the file so its new stat result is recorded first.
+        """
+
+        key = normalizePath(relPath)
+        state = self.files.get(key)
+        if absPath is not None:
+            state = self._statFile(key, relPath, absPath, state)
+        if state is None:
+            return
+
+        state.etag = etag
+        state.syncedSize = state.size
+        state.syncedMtime_ns = state.mtime_ns
+        self.touchedFiles.add(key)
+
+    def forget(self, relPath: str):
+        """
+        Drops a file that was deleted on purpose, without recording it as deleted locally
+        """
+
+        key = normalizePath(relPath)
+        if self.files.pop(key, None) is not None:
+            self.touchedFiles.add(key)
+        if self.deleted.pop(key, None) is not None:
+            self.touchedDeleted.add(key)
+
+    def contentIndex(self) -> dict[tuple[str, int], str]:
+        """
+        Returns (etag, size) -> key for the files whose content still matches the etag they were synced at
+        """
+
+        index = {}
+        for key, state in self.files.items():
+            if state.isUnchangedSinceSync():
+                index.setdefault((state.etag, state.size), key)
+        return index
+
+    def syncedKeys(self) -> set[str]:
+        """
+        Returns the normalized keys that were in sync after a previous run,
+        including the ones deleted locally since then
+        """
+
+        keys = {key for key, state in self.files.items() if state.etag is not None}
+        keys.update(self.deleted)
+        return keys
+
+    def pruneDeleted(self, serverKeys: set[str]):
+        """
+        Forgets local deletions that the server no longer has either
+        """
+
+        for key in [key for key in self.deleted if key not in serverKeys]:
+            del self.deleted[key]
+            self.touchedDeleted.add(key)
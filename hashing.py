@@ -0,0 +1,208 @@
+import hashlib
+import json
+import logging
+import mmap
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from constants import MULTIPART_PART_SIZE
+from stateStore import StateStore, getStateStore
+
+MIB = 1024 * 1024
+
+# part sizes commonly used by S3 clients, tried when a multipart etag has to be reproduced
+COMMON_PART_SIZES = [MULTIPART_PART_SIZE, 5 * MIB, 8 * MIB, 16 * MIB, 64 * MIB]
+
+
+def candidatePartSizes(size: int, partCount: int) -> list[int]:
+    """
+    Returns the part sizes that split a file of size bytes into exactly partCount parts
+    """
+
+    candidates = set(COMMON_PART_SIZES)
+
+    # most clients use a whole number of MiB
+    if partCount > 0:
+        perPart = -(-size // partCount)
+        candidates.add(-(-perPart // MIB) * MIB)
+
+    return sorted(
+        partSize
+        for partSize in candidates
+        if partSize > 0 and -(-size // partSize) == partCount
+    )
+
+
+def hashFile(path: str, partSizes: list[int]) -> tuple[str, dict[int, str]]:
+    """
+    Reads the file once through mmap and returns its md5, and the multipart etag for each part size
+    """
+
+    md5 = hashlib.md5()
+    partDigests = {partSize: [] for partSize in partSizes}
+
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return md5.hexdigest(), {
+                partSize: _multipartEtag([hashlib.md5().digest()]) for partSize in partSizes
+            }
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                md5.update(view)
+                for partSize in partSizes:
+                    for start in range(0, size, partSize):
+                        partDigests[partSize].append(
+                            hashlib.md5(view[start : start + partSize]).digest()
+                        )
+            finally:
+                view.release()
+
+    return md5.hexdigest(), {
+        partSize: _multipartEtag(digests) for partSize, digests in partDigests.items()
+    }
+
+
+def _multipartEtag(digests: list[bytes]) -> str:
+    return f"{hashlib.md5(b''.join(digests)).hexdigest()}-{len(digests)}"
+
+
+def _hashWorker(args):
+    path, partSizes = args
+    try:
+        return hashFile(path, partSizes)
+    except OSError as e:
+        logging.error("Failed to hash %s: %s", path, e)
+        return None
+
+
+class HashCache:
+    """
+    Persistent md5 and multipart etags of local files, keyed by (inode, size, mtime_ns)
+    so a file is only hashed again after it changed
+    """
+
+    def __init__(self, store: StateStore | None = None):
+        self.store = store if store is not None else getStateStore()
+        self.entries: dict[str, dict] = {}  # entries loaded or hashed in this run
+        self.dirty: set[str] = set()
+
+    def save(self):
+        with self.store.transaction() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO hash_cache (cache_key, md5, parts) VALUES (?, ?, ?)",
+                [
+                    (key, self.entries[key]["md5"], json.dumps(self.entries[key]["parts"]))
+                    for key in self.dirty
+                ],
+            )
+        self.dirty.clear()
+
+    def _entry(self, cacheKey: str) -> dict | None:
+        entry = self.entries.get(cacheKey)
+        if entry is None:
+            rows = self.store.query(
+                "SELECT md5, parts FROM hash_cache WHERE cache_key = ?", (cacheKey,)
+            )
+            if len(rows) == 0:
+                return None
+            entry = {"md5": rows[0][0], "parts": json.loads(rows[0][1])}
+            self.entries[cacheKey] = entry
+        return entry
+
+    @staticmethod
+    def _cacheKey(inode: int, size: int, mtime_ns: int) -> str:
+        return f"{inode}:{size}:{mtime_ns}"
+
+    @staticmethod
+    def _partSizesFor(size: int, etag: str) -> list[int]:
+        if "-" not in etag:
+            return []
+        try:
+            partCount = int(etag.rsplit("-", 1)[1])
+        except ValueError:
+            return []
+        return candidatePartSizes(size, partCount)
+
+    def _missing(self, stats, etag) -> list[int] | None:
+        """
+        Returns the part sizes still to hash for this file, or None if nothing is missing
+        """
+
+        entry = self._entry(self._cacheKey(*stats))
+        partSizes = self._partSizesFor(stats[1], etag)
+        if entry is None:
+            return partSizes
+
+        missingParts = [
+            partSize for partSize in partSizes if str(partSize) not in entry["parts"]
+        ]
+        return missingParts if len(missingParts) > 0 else None
+
+    def precompute(self, files: list[tuple[str, tuple[int, int, int], str]], maxWorkers=None):
+        """
+        Hashes every (absolute path, (inode, size, mtime_ns), server etag) not cached yet,
+        across a process pool when there is more than one
+        """
+
+        work = []
+        for absPath, stats, etag in files:
+            partSizes = self._missing(stats, etag)
+            if partSizes is not None:
+                work.append((absPath, stats, partSizes))
+        if len(work) == 0:
+            return
+
+        logging.info("Hashing %d files", len(work))
+        args = [(absPath, partSizes) for absPath, _, partSizes in work]
+        if len(work) == 1:
+            results = map(_hashWorker, args)
+        else:
+            executor = ProcessPoolExecutor(max_workers=maxWorkers)
+            results = executor.map(_hashWorker, args, chunksize=16)
+
+        try:
+            for (absPath, stats, _), result in zip(work, results):
+                if result is None:
+                    continue
+                md5, parts = result
+                cacheKey = self._cacheKey(*stats)
+                entry = self._entry(cacheKey) or {"md5": md5, "parts": {}}
+                entry["md5"] = md5
+                for partSize, partEtag in parts.items():
+                    entry["parts"][str(partSize)] = partEtag
+                self.entries[cacheKey] = entry
+                self.dirty.add(cacheKey)
+        finally:
+            if len(work) > 1:
+                executor.shutdown()
+
+    def prune(self, staleStats: set[tuple[int, int, int]]):
+        """
+        Forgets the hashes of file versions that no longer exist, see FileIndex.replacedStats
+        """
+
+        stale = [(self._cacheKey(*stats),) for stats in staleStats]
+        with self.store.transaction() as connection:
+            connection.executemany("DELETE FROM hash_cache WHERE cache_key = ?", stale)
+        for (key,) in stale:
+            self.entries.pop(key, None)
+            self.dirty.discard(key)
+
+    def matchesEtag(self, absPath: str, stats: tuple[int, int, int], etag: str) -> bool:
+        """
+        Checks if the local file has the content of the server object with this etag,
+        including multipart etags in the md5-N format
+        """
+
+        etag = etag.strip('"')
+        self.precompute([(absPath, stats, etag)])
+        entry = self._entry(self._cacheKey(*stats))
+        if entry is None:
+            return False
+
+        if "-" not in etag:
+            return entry["md5"] == etag
+        return etag in entry["parts"].values()
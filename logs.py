@@ -0,0 +1,114 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+
+from constants import LOG_BACKUP_COUNT, LOG_FILE, LOG_MAX_BYTES, LOG_SAMPLE_LIMIT
+
+"""
+Logging goes through a queue: the calling thread only creates the record and puts it on
+the queue, and a single listener thread writes it to the rotating log file and renders it
+on the terminal. Transfer threads never wait on disk or on rich.
+"""
+
+_listener: logging.handlers.QueueListener | None = None
+
+# libraries that log every request at INFO
+NOISY_LOGGERS = ["httpx", "httpcore", "hpack"]
+
+
+def setupLogging(
+    level: int = logging.INFO,
+    logFile: str | None = LOG_FILE,
+    console: bool = True,
+) -> logging.handlers.QueueListener:
+    """
+    Routes the root logger through a queue to a rotating file and, if console, a RichHandler
+    """
+
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+
+    handlers = []
+    if logFile is not None:
+        fileHandler = logging.handlers.RotatingFileHandler(
+            logFile, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
+        )
+        fileHandler.setFormatter(
+            logging.Formatter("%(asctime)s %(levelname)s %(threadName)s %(message)s")
+        )
+        handlers.append(fileHandler)
+    if console:
+        from rich.logging import RichHandler
+
+        handlers.append(RichHandler())
+
+    logQueue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(logQueue))
+    root.setLevel(level)
+    for name in NOISY_LOGGERS:
+        logging.getLogger(name).setLevel(max(level, logging.WARNING))
+
+    _listener = logging.handlers.QueueListener(
+        logQueue, *handlers, respect_handler_level=True
+    )
+    _listener.start()
+    return _listener
+
+
+@atexit.register
+def stopLogging():
+    """
+    Flushes the queue, call before exiting so the last records reach the file
+    """
+
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+class LogSampler:
+    """
+    Logs the first limit per-file messages and only counts the rest,
+    flush() then logs one line with how many were left out
+    """
+
+    def __init__(
+        self,
+        level: int,
+        label: str,
+        limit: int = LOG_SAMPLE_LIMIT,
+        logger: logging.Logger | None = None,
+    ):
+        self.level = level
+        self.label = label
+        self.limit = limit
+        self.logger = logger or logging.getLogger()
+        # decided once, so a disabled level costs nothing per file
+        self.enabled = self.logger.isEnabledFor(level)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def log(self, msg: str, *args):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.count += 1
+            sampled = self.count <= self.limit
+        if sampled:
+            self.logger.log(self.level, msg, *args, stacklevel=2)
+
+    def flush(self):
+        with self.lock:
+            skipped = self.count - self.limit
+            self.count = 0
+        if skipped > 0:
+            self.logger.log(
+                self.level, "... and %d more %s", skipped, self.label, stacklevel=2
+            )
@@ -1,20 +1,11 @@
 import logging
-
-from rich.columns import Columns
-from rich.console import Console
-from rich.logging import RichHandler
-from rich.panel import Panel
-from rich.prompt import Prompt
-from rich.table import Table
+import multiprocessing
+import sys
 
 from auth import clearSavedAuth, initAuth
-from configs import getLastSync, updateOfflineFolder
-from sync import Sync, getOfflineFolder
-from utils import (
-    checkIfUpdateAvailable,
-    deleteOtherReleaseExecutables,
-    runUpdate,
-)
+from configs import getLastSync, getOfflineFolder, updateOfflineFolder
+from logs import setupLogging
+from utils import checkIfUpdateAvailable, runUpdate, startBackgroundUpdateCheck
 
 banner = """
 ▄▄▄▄▄▄▄▄▄▄▄▄▄▄▄▄▄▄▄▄▄▄▄▄▄▄▄▄▄▄▄▄▄▄▄▄▄▄▄▄▄▄▄▄▄▄▄▄▄▄▄▄▄
@@ -23,16 +14,17 @@ banner = """
 ██░▀▀░█▄▄█▄██▄█▄▄▄█▄▄▄█▄▄█████░▀▀▄█▄▄██▄▄███▄▄▄█▄▄███
 ▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀
 """
-console = Console()
-
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(message)s",
-    handlers=[logging.FileHandler("log.txt"), RichHandler()],
-)
 
 
 def showMenu():
+    # rich is only loaded for the menu, the headless cli doesn't need it
+    from rich.columns import Columns
+    from rich.console import Console
+    from rich.panel import Panel
+    from rich.prompt import Prompt
+    from rich.table import Table
+
+    console = Console()
     optionTable = Table(
         title="BlazedCloud Sync",
         header_style="bold magenta",
@@ -69,6 +61,7 @@ def showMenu():
         "(3) Update",
         "(4) Sign out",
         "(5) Exit",
+        "(6) Watch",
     ]
     for option in options:
         optionTable.add_row(option)
@@ -83,6 +76,8 @@ def showMenu():
             console.print("[red]Offline folder not set")
         else:
             console.print("[green]Syncing")
+            from sync import Sync
+
             Sync()
     elif choice == "2":
         console.print("[green]Setting Offline Folder")
@@ -97,6 +92,14 @@ def showMenu():
     elif choice == "5":
         console.print("[green]Exiting")
         return
+    elif choice == "6":
+        if getOfflineFolder() is None or len(getOfflineFolder()) == 0:
+            console.print("[red]Offline folder not set")
+        else:
+            console.print("[green]Watching for changes, press Ctrl+C to stop")
+            from watcher import watch
+
+            watch()
     else:
         console.print("[red]Invalid Option")
 
@@ -105,16 +108,25 @@ def showMenu():
 
 
 if __name__ == "__main__":
-    try:
-        deleteOtherReleaseExecutables()
-    except Exception as e:
-        logging.error("Failed to delete other release executables: " + str(e))
+    # a frozen exe starts worker processes by running itself, hand those to the worker
+    multiprocessing.freeze_support()
+    if len(sys.argv) > 1:
+        from cli import main
+
+        sys.exit(main(sys.argv[1:]))
+
+    setupLogging()
+    from rich.console import Console
+
+    console = Console()
     console.print(banner, style="bold red", justify="center")
 
+    # announce a known update right away, refresh the check without blocking the menu
     try:
-        checkIfUpdateAvailable()
+        checkIfUpdateAvailable(allowNetwork=False)
     except Exception as e:
-        logging.error("Failed to check for updates: " + str(e))
+        logging.error("Failed to check for updates: %s", e)
+    startBackgroundUpdateCheck()
 
     if initAuth():
         showMenu()
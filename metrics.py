@@ -0,0 +1,200 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+"""
+Process wide counters, gauges and histograms, exported after every sync as a JSON
+snapshot or a Prometheus textfile (pick the node exporter's textfile directory as the
+path and give it a .prom extension).
+
+    metrics.increment("retries_total", operation="upload_part")
+    with metrics.timer("phase_seconds", phase="scan"):
+        ...
+"""
+
+PREFIX = "blazedcloud_sync_"
+
+# seconds, wide enough for single requests and whole sync phases
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def cumulative(self) -> list[tuple[str, int]]:
+        total = 0
+        buckets = []
+        for bound, count in zip(BUCKETS, self.counts):
+            total += count
+            buckets.append((str(bound), total))
+        buckets.append(("+Inf", self.count))
+        return buckets
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters: dict[tuple[str, tuple], float] = {}
+            self.gauges: dict[tuple[str, tuple], float] = {}
+            self.histograms: dict[tuple[str, tuple], Histogram] = {}
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple[str, tuple]:
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def increment(self, name: str, amount: float = 1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set(self, name: str, value: float, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """
+        Observes the seconds spent inside the block, also when it raises
+        """
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                "time": time.time(),
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in sorted(self.counters.items())
+                ],
+                "gauges": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in sorted(self.gauges.items())
+                ],
+                "histograms": [
+                    {
+                        "name": name,
+                        "labels": dict(labels),
+                        "count": histogram.count,
+                        "sum": histogram.sum,
+                        "buckets": dict(histogram.cumulative()),
+                    }
+                    for (name, labels), histogram in sorted(
+                        self.histograms.items(), key=lambda item: item[0]
+                    )
+                ],
+            }
+
+    def toPrometheus(self) -> str:
+        snapshot = self.snapshot()
+        lines = []
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {PREFIX}{name} {kind}")
+
+        for kind in ["counters", "gauges"]:
+            for entry in snapshot[kind]:
+                declare(entry["name"], "counter" if kind == "counters" else "gauge")
+                lines.append(
+                    f"{PREFIX}{entry['name']}{_labels(entry['labels'])} {entry['value']}"
+                )
+        for entry in snapshot["histograms"]:
+            name = entry["name"]
+            declare(name, "histogram")
+            for bound, count in entry["buckets"].items():
+                labels = _labels(dict(entry["labels"], le=bound))
+                lines.append(f"{PREFIX}{name}_bucket{labels} {count}")
+            lines.append(f"{PREFIX}{name}_sum{_labels(entry['labels'])} {entry['sum']}")
+            lines.append(f"{PREFIX}{name}_count{_labels(entry['labels'])} {entry['count']}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, path: str):
+        """
+        Writes the metrics to path, as a Prometheus textfile if it ends with .prom and JSON otherwise.
+        The file is replaced atomically so a collector never reads half of it.
+        """
+
+        if path.endswith(".prom"):
+            content = self.toPrometheus()
+        else:
+            content = json.dumps(self.snapshot(), indent=2)
+
+        tempPath = path + ".tmp"
+        try:
+            with open(tempPath, "w") as f:
+                f.write(content)
+            os.replace(tempPath, path)
+        except Exception as e:
+            logging.error("Failed to export metrics to %s: %s", path, e)
+
+
+def _labels(labels: dict) -> str:
+    if len(labels) == 0:
+        return ""
+    pairs = []
+    for key, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{key}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def endpointLabel(url) -> str:
+    """
+    Names a request url without the ids in it, e.g. data/listall, data/up/multipart/part or object
+    """
+
+    parsed = urlparse(str(url))
+    segments = [segment for segment in parsed.path.split("/") if segment]
+    if "github.com" in parsed.netloc:
+        return "github"
+    if len(segments) == 0:
+        return "root"
+    if segments[0] == "api":
+        return "/".join(segments)
+    if segments[0] == "data" and len(segments) > 1:
+        label = "data/" + segments[1]
+        if len(segments) > 2 and segments[2] in ("batch", "multipart"):
+            label += "/" + segments[2]
+        if segments[-1] in ("part", "complete", "abort"):
+            label += "/" + segments[-1]
+        return label
+    # presigned urls to object storage
+    return "object"
+
+
+metrics = Metrics()
@@ -1,4 +1,7 @@
+import calendar
+import sys
 from dataclasses import dataclass
+from datetime import datetime, timezone
 from typing import Any
 
 """ Example json:
@@ -15,19 +18,37 @@ from typing import Any
 }
  """
 
-@dataclass
+
+def parseTimestampNs(value: str) -> int:
+    """
+    Converts a server timestamp like 2023-12-08T07:01:00.495Z (always UTC) to epoch nanoseconds
+    """
+
+    format = "%Y-%m-%dT%H:%M:%S.%fZ" if "." in value else "%Y-%m-%dT%H:%M:%SZ"
+    parsed = datetime.strptime(value, format)
+    seconds = calendar.timegm(parsed.timetuple())
+    return seconds * 1_000_000_000 + parsed.microsecond * 1_000
+
+
+@dataclass(slots=True)
 class FileObject:
-    ETag: str
+    ETag: str  # without the surrounding quotes
     Key: str
-    LastModified: str
+    LastModifiedNs: int  # epoch nanoseconds
     Size: int
     StorageClass: str
 
+    @property
+    def LastModified(self) -> str:
+        seconds, nanoseconds = divmod(self.LastModifiedNs, 1_000_000_000)
+        parsed = datetime.fromtimestamp(seconds, timezone.utc)
+        return parsed.strftime("%Y-%m-%dT%H:%M:%S") + f".{nanoseconds // 1_000_000:03d}Z"
+
     @staticmethod
     def from_dict(obj: Any) -> 'FileObject':
-        _ETag = str(obj.get("ETag"))
-        _Key = str(obj.get("Key"))
-        _LastModified = str(obj.get("LastModified"))
+        _ETag = str(obj.get("ETag")).strip('"')
+        _Key = sys.intern(str(obj.get("Key")))
+        _LastModifiedNs = parseTimestampNs(str(obj.get("LastModified")))
         _Size = int(obj.get("Size"))
-        _StorageClass = str(obj.get("StorageClass"))
-        return FileObject(_ETag, _Key, _LastModified, _Size, _StorageClass)
\ No newline at end of file
+        _StorageClass = sys.intern(str(obj.get("StorageClass")))
+        return FileObject(_ETag, _Key, _LastModifiedNs, _Size, _StorageClass)
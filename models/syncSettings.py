@@ -1,11 +1,28 @@
+from constants import (
+    DEFAULT_MAX_CONCURRENT_TRANSFERS,
+    DEFAULT_TRANSFER_PRIORITY,
+    HTTP_MAX_CONNECTIONS,
+    HTTP_READ_TIMEOUT_SECONDS,
+)
+
+
 class SyncSettings:
     def __init__(self):
         self.downloadMissingFiles = True
         self.uploadUnsyncedFiles = True
-        self.deleteUnsyncedFiles = True
-        self.deleteMissingFiles = True
-        self.deletePlaceholderFiles = True
-        self.deleteEmptyFolders = True
+        self.deleteUnsyncedFiles = True  # delete local files that were synced and are gone from the server
+        self.deleteMissingFiles = True  # delete server files that were synced and are gone locally
+        self.deletePlaceholderFiles = True  # delete local copies of .blazed-placeholder files
+        self.deleteEmptyFolders = True  # remove local folders a sync leaves empty
+        self.maxConcurrentTransfers = DEFAULT_MAX_CONCURRENT_TRANSFERS
+        self.maxDownloadBytesPerSecond = 0  # 0 is unlimited
+        self.maxUploadBytesPerSecond = 0  # 0 is unlimited
+        self.transferPriority = DEFAULT_TRANSFER_PRIORITY  # none, smallest, newest or pattern
+        self.priorityPatterns = []  # globs, earlier ones transfer first
+        self.metricsPath = "metrics.json"  # .prom for a prometheus textfile, empty to disable
+        self.localReuse = "reflink"  # reflink, copy, hardlink or off, for downloads already present locally
+        self.httpMaxConnections = HTTP_MAX_CONNECTIONS  # open connections over all hosts
+        self.httpReadTimeoutSeconds = HTTP_READ_TIMEOUT_SECONDS
     
     def __str__(self):
-        return f"downloadMissingFiles: {self.downloadMissingFiles}, uploadUnsyncedFiles: {self.uploadUnsyncedFiles}, deleteUnsyncedFiles: {self.deleteUnsyncedFiles}, deleteMissingFiles: {self.deleteMissingFiles}, deletePlaceholderFiles: {self.deletePlaceholderFiles}, deleteEmptyFolders: {self.deleteEmptyFolders}"
+        return f"downloadMissingFiles: {self.downloadMissingFiles}, uploadUnsyncedFiles: {self.uploadUnsyncedFiles}, deleteUnsyncedFiles: {self.deleteUnsyncedFiles}, deleteMissingFiles: {self.deleteMissingFiles}, deletePlaceholderFiles: {self.deletePlaceholderFiles}, deleteEmptyFolders: {self.deleteEmptyFolders}, maxConcurrentTransfers: {self.maxConcurrentTransfers}, maxDownloadBytesPerSecond: {self.maxDownloadBytesPerSecond}, maxUploadBytesPerSecond: {self.maxUploadBytesPerSecond}, transferPriority: {self.transferPriority}, priorityPatterns: {self.priorityPatterns}, metricsPath: {self.metricsPath}, localReuse: {self.localReuse}, httpMaxConnections: {self.httpMaxConnections}, httpReadTimeoutSeconds: {self.httpReadTimeoutSeconds}"
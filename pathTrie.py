@@ -0,0 +1,256 @@
+import logging
+import os
+from typing import NamedTuple
+
+from paths import isPlaceholder, normalizePath, parentKey, toLocalPath
+
+"""
+Directory trie over one side of a sync, the local folder or the server, keyed by index keys.
+
+Every directory node keeps the number of files, their bytes, the files changed since they
+were synced and the placeholders in its whole subtree, updated on every insert and remove.
+Asking about a folder costs the walk down to it, listing its files costs its subtree, and
+neither touches the disk.
+
+    local = localTrie(fileIndex)
+    local.count("photos/2023"), local.size("photos"), local.hasChanges("photos")
+"""
+
+
+class TrieEntry(NamedTuple):
+    size: int
+    changed: bool
+    value: object = None  # the FileState or FileObject it was built from
+
+
+class TrieNode:
+    __slots__ = ("parent", "dirs", "files", "count", "size", "changed", "placeholders")
+
+    def __init__(self, parent: "TrieNode | None"):
+        self.parent = parent
+        self.dirs: dict[str, TrieNode] = {}
+        self.files: dict[str, TrieEntry] = {}
+        self.count = 0
+        self.size = 0
+        self.changed = 0
+        self.placeholders = 0
+
+
+class PathTrie:
+    def __init__(self):
+        self.root = TrieNode(None)
+
+    def insert(self, key: str, size: int, changed: bool = False, value=None):
+        """
+        Adds or replaces a file. A placeholder only marks its directory, it isn't counted as a file.
+        """
+
+        key = normalizePath(key)
+        node = self._node(parentKey(key), create=True)
+        name = key.rpartition("/")[2]
+
+        if isPlaceholder(key):
+            if name not in node.files:
+                node.files[name] = TrieEntry(0, False, value)
+                self._adjust(node, 0, 0, 0, 1)
+            return
+
+        old = node.files.get(name)
+        if old is not None:
+            self._adjust(node, -1, -old.size, -int(old.changed), 0)
+        node.files[name] = TrieEntry(size, changed, value)
+        self._adjust(node, 1, size, int(changed), 0)
+
+    def remove(self, key: str) -> TrieEntry | None:
+        """
+        Removes a file, its directories stay until removeDir
+        """
+
+        key = normalizePath(key)
+        node = self._node(parentKey(key))
+        if node is None:
+            return None
+        entry = node.files.pop(key.rpartition("/")[2], None)
+        if entry is None:
+            return None
+
+        if isPlaceholder(key):
+            self._adjust(node, 0, 0, 0, -1)
+        else:
+            self._adjust(node, -1, -entry.size, -int(entry.changed), 0)
+        return entry
+
+    def addDir(self, key: str) -> TrieNode:
+        return self._node(normalizePath(key), create=True)
+
+    def removeDir(self, key: str):
+        """
+        Removes a directory and everything below it
+        """
+
+        key = normalizePath(key)
+        node = self._node(key)
+        if node is None or node is self.root:
+            return
+        self._adjust(node.parent, -node.count, -node.size, -node.changed, -node.placeholders)
+        del node.parent.dirs[key.rpartition("/")[2]]
+
+    def node(self, key: str = "") -> TrieNode | None:
+        return self._node(normalizePath(key))
+
+    def count(self, key: str = "") -> int:
+        node = self.node(key)
+        return 0 if node is None else node.count
+
+    def size(self, key: str = "") -> int:
+        node = self.node(key)
+        return 0 if node is None else node.size
+
+    def hasChanges(self, key: str = "") -> bool:
+        node = self.node(key)
+        return node is not None and node.changed > 0
+
+    def isEmpty(self, key: str = "") -> bool:
+        """
+        Whether the directory holds no files and no placeholder anywhere below it
+        """
+
+        node = self.node(key)
+        return node is None or node.count + node.placeholders == 0
+
+    def files(self, key: str = ""):
+        """
+        Yields (key, entry) for every file below the directory, placeholders left out, one directory at a time
+        """
+
+        prefix = normalizePath(key)
+        node = self._node(prefix)
+        if node is None:
+            return
+        pending = [(prefix, node)]
+        while len(pending) > 0:
+            dirKey, node = pending.pop()
+            for name, entry in node.files.items():
+                if not isPlaceholder(name):
+                    yield (f"{dirKey}/{name}" if dirKey else name), entry
+            pending.extend(
+                (f"{dirKey}/{name}" if dirKey else name, child)
+                for name, child in node.dirs.items()
+            )
+
+    def collapse(self, whole: "PathTrie"):
+        """
+        Yields (key, count, size) for the files of this trie, grouped into one row per
+        directory when they are all of whole's files below it, more than one, and none
+        of them changed.
+        For showing a deletion that takes a whole folder with it as that folder.
+        """
+
+        pending = [("", self.root)]
+        while len(pending) > 0:
+            dirKey, node = pending.pop()
+            for name, entry in node.files.items():
+                if not isPlaceholder(name):
+                    yield (f"{dirKey}/{name}" if dirKey else name), 1, entry.size
+            for name, child in node.dirs.items():
+                key = f"{dirKey}/{name}" if dirKey else name
+                other = whole.node(key)
+                if (
+                    child.count > 1
+                    and other is not None
+                    and other.count == child.count
+                    and other.changed == 0
+                    and other.placeholders == 0
+                ):
+                    yield key + "/", child.count, child.size
+                else:
+                    pending.append((key, child))
+
+    def _node(self, key: str, create: bool = False) -> TrieNode | None:
+        node = self.root
+        if key == "":
+            return node
+        for name in key.split("/"):
+            child = node.dirs.get(name)
+            if child is None:
+                if not create:
+                    return None
+                child = TrieNode(node)
+                node.dirs[name] = child
+            node = child
+        return node
+
+    @staticmethod
+    def _adjust(node: TrieNode | None, count: int, size: int, changed: int, placeholders: int):
+        while node is not None:
+            node.count += count
+            node.size += size
+            node.changed += changed
+            node.placeholders += placeholders
+            node = node.parent
+
+
+def localTrie(fileIndex) -> PathTrie:
+    """
+    Builds the trie of a fileIndex.FileIndex, directories without files included
+    """
+
+    trie = PathTrie()
+    for relDir in fileIndex.dirs:
+        trie.addDir(relDir)
+    for key, state in fileIndex.files.items():
+        trie.insert(key, state.size, not state.isUnchangedSinceSync(), state)
+    return trie
+
+
+def remoteTrie(objects) -> PathTrie:
+    trie = PathTrie()
+    for object in objects:
+        trie.insert(object.Key, object.Size or 0, False, object)
+    return trie
+
+
+def pruneEmptyFolders(
+    folder: str, relDirs, local: PathTrie, remote: PathTrie | None = None
+) -> list[str]:
+    """
+    Removes the local directories in relDirs, and their parents, that are left without files.
+
+    Works bottom-up, so a folder emptied by removing its last subfolder goes too. Directories
+    that local knows files in, or that local or remote keep with a placeholder, stay. os.rmdir
+    never removes a directory with something in it that the trie doesn't know about.
+
+    Returns the directories removed, as local paths.
+    """
+
+    candidates: set[str] = set()
+    for relDir in relDirs:
+        key = normalizePath(relDir)
+        while key != "" and key not in candidates:
+            candidates.add(key)
+            key = parentKey(key)
+
+    removed: list[str] = []
+    # deepest first, every child is decided before its parent
+    for key in sorted(candidates, key=lambda key: key.count("/"), reverse=True):
+        if not local.isEmpty(key) or (remote is not None and not remote.isEmpty(key)):
+            continue
+        node = local.node(key)
+        if node is not None and len(node.dirs) > 0:
+            continue
+
+        relDir = toLocalPath(key)
+        try:
+            os.rmdir(os.path.join(folder, relDir))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.debug("Keeping folder %s: %s", relDir, e)
+            continue
+
+        local.removeDir(key)
+        removed.append(relDir)
+
+    if len(removed) > 0:
+        logging.info("Removed %d empty folders", len(removed))
+    return removed
@@ -0,0 +1,63 @@
+import os
+
+"""
+The forms a synced path takes, and the only place that converts between them:
+
+    listing key     "vcx33oy8b86eg02/photos/a.png"  as the server lists it, prefixed with the uid
+    server key      "photos/a.png"                  / separated, what the api is sent
+    local path      "photos\\a.png" on windows      os.sep separated, relative to the offline folder,
+                                                    what FileObject.Key and LocalFile.relPath hold
+    index key       "photos/a.png"                  separator independent, what both sides are matched on
+
+Server keys and index keys share one form, so any of them goes through normalizePath to
+be compared, toServerKey to be sent, and toLocalPath to be opened.
+"""
+
+PLACEHOLDER_NAME = ".blazed-placeholder"
+
+
+def normalizePath(path: str) -> str:
+    """
+    Returns a separator independent key for a local relative path or a server key,
+    so both sides can be matched with a single dict lookup
+    """
+
+    path = path.replace("\\", "/")
+
+    # ensure no whitespace between slashes
+    path = path.replace(" /", "/").replace("/ ", "/")
+
+    return path.strip("/")
+
+
+def toServerKey(path: str) -> str:
+    return normalizePath(path)
+
+
+def toLocalPath(path: str) -> str:
+    return normalizePath(path).replace("/", os.sep)
+
+
+def fromListingKey(key: str) -> str:
+    """
+    Returns the local path of a key as listed by the server, without the uid before the first /
+    """
+
+    return toLocalPath(key[key.find("/") + 1 :])
+
+
+def parentKey(key: str) -> str:
+    """
+    Returns the index key of the directory holding key, "" for the top level
+    """
+
+    return normalizePath(key).rpartition("/")[0]
+
+
+def isPlaceholder(path: str) -> bool:
+    """
+    Whether path is a .blazed-placeholder, the empty object the web app puts in a folder
+    so the folder exists while it has no files
+    """
+
+    return normalizePath(path).rpartition("/")[2] == PLACEHOLDER_NAME
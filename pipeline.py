@@ -0,0 +1,210 @@
+import logging
+import os
+import queue
+import threading
+
+from constants import PIPELINE_POLL_SECONDS, PRESIGN_BATCH_SIZE
+from fileIndex import FileIndex
+from metrics import metrics
+from models.fileObject import FileObject
+from paths import isPlaceholder, normalizePath
+from remoteManifest import RemoteManifest
+from transfer import TransferEngine, TransferReport
+
+"""
+Enumeration stages of a sync, run at the same time instead of one after the other.
+
+The server listing and the local scan run on their own threads and report to the calling
+thread through one queue: every server file as soon as it is known to exist, and every
+local directory as soon as its files are in the index. The calling thread diffs both
+streams and hands server files that are certainly downloads to EarlyDownloads, which
+starts transferring them while enumeration is still running.
+
+A server file is certainly a download once the local directories it would land in are
+scanned (or known not to exist), and the index has neither the file nor a record of it
+being synced and deleted. Files whose content might be reused locally, and everything
+that depends on the complete listing (uploads, updates, deletions), are left to the plan.
+"""
+
+_DONE = None
+
+
+class EarlyDownloads:
+    """
+    Queue between the streaming diff and TransferEngine.downloadStream on its own thread
+    """
+
+    def __init__(self, engine: TransferEngine):
+        self.engine = engine
+        self.queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.objects: list[FileObject] = []
+        self.report = TransferReport()
+        self.thread = threading.Thread(target=self._run, name="early-downloads", daemon=True)
+        self.thread.start()
+
+    def put(self, object: FileObject):
+        self.objects.append(object)
+        self.queue.put(object)
+
+    def finish(self) -> TransferReport:
+        """
+        Waits for every download put so far and returns the report
+        """
+
+        self.queue.put(_DONE)
+        self.thread.join()
+        return self.report
+
+    def _run(self):
+        try:
+            self.report = self.engine.downloadStream(self._batches())
+        except Exception as e:
+            logging.error("Early downloads failed: %s", e)
+
+    def _batches(self):
+        while True:
+            try:
+                object = self.queue.get(timeout=PIPELINE_POLL_SECONDS)
+            except queue.Empty:
+                yield []
+                continue
+
+            # take whatever else is already waiting, up to one presign batch
+            batch = []
+            while object is not _DONE:
+                batch.append(object)
+                if len(batch) == PRESIGN_BATCH_SIZE:
+                    break
+                try:
+                    object = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            yield batch
+            if object is _DONE:
+                return
+
+
+class _Stage(threading.Thread):
+    """
+    Runs work() and puts (name, result) or ("error", exception) on events when it is done
+    """
+
+    def __init__(self, name: str, events: queue.SimpleQueue, work):
+        super().__init__(name=name, daemon=True)
+        self.events = events
+        self.work = work
+
+    def run(self):
+        try:
+            result = self.work()
+        except Exception as e:
+            self.events.put(("error", e))
+            return
+        self.events.put((self.name, result))
+
+
+def listAndScan(
+    token: str,
+    uid: str,
+    fileIndex: FileIndex,
+    paths: set[str] | None = None,
+    onDownload=None,
+    reuseLocal: bool = True,
+) -> list[FileObject] | None:
+    """
+    Lists the server and scans fileIndex's folder (only paths, if given) at the same time.
+
+    onDownload(object) is called from this thread for every server file that is certainly
+    a download, as soon as that is known. Returns every server file, or None if the server
+    couldn't be listed. Errors of the scan are raised here.
+    """
+
+    events: queue.SimpleQueue = queue.SimpleQueue()
+
+    def listing():
+        with metrics.timer("phase_seconds", phase="list"):
+            return RemoteManifest(uid).fetch(
+                token, uid, lambda object: events.put(("object", object))
+            )
+
+    def scan():
+        with metrics.timer("phase_seconds", phase="scan"):
+            if paths is None:
+                fileIndex.scan(onDir=lambda relDir: events.put(("dir", relDir)))
+            else:
+                fileIndex.refresh(paths)
+
+    # decided before the scan changes the index, these are left to the plan
+    reusable = fileIndex.contentIndex() if reuseLocal else {}
+    scannedDirs: set[str] = set()
+    scanned = False
+
+    def blockingDir(object: FileObject) -> str | None:
+        """
+        Returns the first local directory that must be scanned before deciding on object, None if there is none
+        """
+
+        if scanned:
+            return None
+        # where the download lands, which is also where the same key may already exist locally
+        relDir = ""
+        for name in os.path.dirname(object.Key).split(os.sep):
+            if relDir not in scannedDirs:
+                return relDir
+            known = fileIndex.dirs.get(relDir)
+            if name == "" or known is None or name not in known.subdirs:
+                return None
+            relDir = os.path.join(relDir, name) if relDir else name
+        return None if relDir in scannedDirs else relDir
+
+    def isDownload(object: FileObject) -> bool:
+        key = normalizePath(object.Key)
+        return (
+            not isPlaceholder(key)
+            and key not in fileIndex.files
+            and key not in fileIndex.deleted
+            and (object.ETag, object.Size or 0) not in reusable
+        )
+
+    waiting: dict[str, list[FileObject]] = {}
+
+    def decide(object: FileObject):
+        relDir = blockingDir(object)
+        if relDir is not None:
+            waiting.setdefault(relDir, []).append(object)
+        elif isDownload(object):
+            onDownload(object)
+
+    stages = [_Stage("listed", events, listing), _Stage("scanned", events, scan)]
+    for stage in stages:
+        stage.start()
+
+    server_files = None
+    running = len(stages)
+    error = None
+    while running > 0:
+        event, value = events.get()
+        if event == "object":
+            if onDownload is not None and error is None:
+                decide(value)
+        elif event == "dir":
+            scannedDirs.add(value)
+            for object in waiting.pop(value, []):
+                decide(object)
+        elif event == "scanned":
+            running -= 1
+            scanned = True
+            for objects in list(waiting.values()):
+                for object in objects:
+                    decide(object)
+            waiting.clear()
+        elif event == "listed":
+            running -= 1
+            server_files = value
+        elif event == "error":
+            running -= 1
+            error = value
+
+    if error is not None:
+        raise error
+    return server_files
@@ -0,0 +1,232 @@
+import logging
+import os
+from dataclasses import dataclass, field
+
+from models.fileObject import FileObject
+from paths import isPlaceholder, normalizePath, parentKey, toLocalPath
+from utils import isLocalNewer
+
+
+@dataclass
+class LocalFile:
+    relPath: str
+    absPath: str
+    size: int
+
+
+@dataclass
+class SyncPlan:
+    to_download: list[FileObject] = field(default_factory=list)
+    to_upload: list[LocalFile] = field(default_factory=list)
+    to_update: list[LocalFile] = field(default_factory=list)
+    to_delete_local: list[LocalFile] = field(default_factory=list)
+    to_delete_remote: list[FileObject] = field(default_factory=list)
+    # (relative path, etag) of files already in sync that the file index hasn't recorded yet
+    to_mark_synced: list[tuple[str, str]] = field(default_factory=list)
+    # downloads whose content already exists locally, (object, absolute path of the local copy)
+    to_copy: list[tuple[FileObject, str]] = field(default_factory=list)
+    # downloads that are a local file the server moved, (object, the file at its old path)
+    to_move: list[tuple[FileObject, LocalFile]] = field(default_factory=list)
+    # local folders the server keeps with a placeholder that don't exist locally yet
+    to_create_dirs: list[str] = field(default_factory=list)
+    # local copies of placeholders, never uploaded
+    placeholders: list[LocalFile] = field(default_factory=list)
+
+    @property
+    def downloadBytes(self) -> int:
+        return sum(object.Size or 0 for object in self.to_download)
+
+    @property
+    def uploadBytes(self) -> int:
+        return sum(local.size for local in self.to_upload)
+
+    @property
+    def updateBytes(self) -> int:
+        return sum(local.size for local in self.to_update)
+
+    @property
+    def deleteLocalBytes(self) -> int:
+        return sum(local.size for local in self.to_delete_local)
+
+    @property
+    def deleteRemoteBytes(self) -> int:
+        return sum(object.Size or 0 for object in self.to_delete_remote)
+
+    @property
+    def reuseBytes(self) -> int:
+        return sum(object.Size or 0 for object, _ in self.to_copy + self.to_move)
+
+    def __str__(self):
+        return f"download: {len(self.to_download)}, copy: {len(self.to_copy)}, move: {len(self.to_move)}, upload: {len(self.to_upload)}, update: {len(self.to_update)}, delete local: {len(self.to_delete_local)}, delete remote: {len(self.to_delete_remote)}, create folders: {len(self.to_create_dirs)}, placeholders: {len(self.placeholders)}"
+
+
+def buildSyncPlan(
+    server_files: list[FileObject],
+    local_files: list[str],
+    local_files_abs: list[str],
+    previouslySynced: set[str] | None = None,
+    fileIndex=None,
+    hashCache=None,
+    reuseLocal: bool = True,
+    deleteLocal: bool = True,
+) -> SyncPlan:
+    """
+    Compares the server listing with the local scan using hash indexes keyed on the
+    normalized path, so the whole diff is O(N + M)
+
+    previouslySynced holds normalized keys that existed on both sides after the last sync.
+    A file missing on one side that was previously synced was deleted on that side,
+    so it is planned as a delete instead of a transfer. Without it nothing is deleted.
+    A file changed on the other side since then is transferred instead, the change wins.
+
+    Placeholders are never transferred. The server's become folders to create, and
+    local copies of them end up in placeholders.
+
+    When a fileIndex.FileIndex is given, its stored stat results are used instead of
+    stat'ing again, previouslySynced defaults to its synced keys, and files unchanged
+    since they were synced at the server's current etag are skipped without comparing.
+
+    A file on both sides that only changed on the server since it was synced is downloaded,
+    one that only changed locally is updated, even with an older mtime. When both changed,
+    or there is no sync record, the newer side wins. When a hashing.HashCache is given,
+    same size files are hashed first and only transferred if the content differs from the
+    server etag, so touching a file or restoring its mtime doesn't cause a transfer. Only a
+    matching hash records a file as synced.
+
+    With a fileIndex and reuseLocal, downloads whose etag and size match a local file are planned as
+    local copies instead, or as a move when that file is about to be deleted because the
+    server object was renamed and deleteLocal allows deleting it. See planLocalReuse.
+    """
+
+    if previouslySynced is None:
+        previouslySynced = set() if fileIndex is None else fileIndex.syncedKeys()
+
+    plan = SyncPlan()
+
+    serverIndex: dict[str, FileObject] = {}
+    for object in server_files:
+        serverIndex[normalizePath(object.Key)] = object
+
+    localIndex: dict[str, int] = {}
+    for i, local_file in enumerate(local_files):
+        localIndex[normalizePath(local_file)] = i
+
+    for key, object in serverIndex.items():
+        if isPlaceholder(key):
+            folder = toLocalPath(parentKey(key))
+            if folder and fileIndex is not None and folder not in fileIndex.dirs:
+                plan.to_create_dirs.append(folder)
+            continue
+        if key in localIndex:
+            continue
+        # deleted locally, unless the server changed it since it was synced
+        deletedEtag = None if fileIndex is None else fileIndex.deleted.get(key)
+        if key in previouslySynced and deletedEtag in (None, object.ETag):
+            plan.to_delete_remote.append(object)
+        else:
+            plan.to_download.append(object)
+
+    compareCandidates: list[tuple[LocalFile, FileObject, tuple[int, int, int], bool]] = []
+    for key, i in localIndex.items():
+        object = serverIndex.get(key)
+        state = None if fileIndex is None else fileIndex.files.get(key)
+
+        if isPlaceholder(key):
+            size = state.size if state is not None else os.path.getsize(local_files_abs[i])
+            plan.placeholders.append(LocalFile(local_files[i], local_files_abs[i], size))
+            continue
+
+        if object is not None and state is not None and state.isUnchangedSinceSync():
+            if state.etag != object.ETag:
+                # only the server changed since the last sync
+                plan.to_download.append(object)
+            continue
+
+        if state is not None:
+            stats = (state.inode, state.size, state.mtime_ns)
+        else:
+            fileStats = os.stat(local_files_abs[i])
+            stats = (fileStats.st_ino, fileStats.st_size, fileStats.st_mtime_ns)
+        local = LocalFile(local_files[i], local_files_abs[i], stats[1])
+        if object is not None:
+            if state is not None and state.etag == object.ETag:
+                # only the local file changed since the last sync, whatever its mtime
+                newer = True
+            else:
+                newer = isLocalNewer(local_files_abs[i], object, stats[2])
+            if hashCache is not None and object.Size == local.size:
+                compareCandidates.append((local, object, stats, newer))
+            elif newer:
+                plan.to_update.append(local)
+            else:
+                plan.to_download.append(object)
+        elif key in previouslySynced and (state is None or state.isUnchangedSinceSync()):
+            plan.to_delete_local.append(local)
+        else:
+            plan.to_upload.append(local)
+
+    # only same size files can have the same content, hash all of them in one batch.
+    # a file is only recorded as synced when its content is the server's, otherwise
+    # the side that changed wins, the newer one if both did
+    if len(compareCandidates) > 0:
+        hashCache.precompute(
+            [
+                (local.absPath, stats, object.ETag)
+                for local, object, stats, _ in compareCandidates
+            ]
+        )
+        for local, object, stats, newer in compareCandidates:
+            if hashCache.matchesEtag(local.absPath, stats, object.ETag):
+                plan.to_mark_synced.append((local.relPath, object.ETag))
+            elif newer:
+                plan.to_update.append(local)
+            else:
+                plan.to_download.append(object)
+
+    if reuseLocal and fileIndex is not None and len(plan.to_download) > 0:
+        planLocalReuse(plan, fileIndex, deleteLocal)
+
+    logging.info("Sync plan: %s", plan)
+    return plan
+
+
+def planLocalReuse(plan: SyncPlan, fileIndex, deleteLocal: bool = True):
+    """
+    Moves downloads that can be satisfied from local content into to_copy and to_move.
+
+    Only files whose content is known to equal a server etag are used as sources: files
+    unchanged since they were synced, and the ones this plan just found in sync.
+    A source that is planned for local deletion (its server object is gone) is moved to
+    the first download that needs it instead of being deleted, the rest copy it first.
+    Without deleteLocal the source stays where it is and every download copies it.
+    """
+
+    contentIndex = fileIndex.contentIndex()
+    for relPath, etag in plan.to_mark_synced:
+        key = normalizePath(relPath)
+        state = fileIndex.files.get(key)
+        if state is not None:
+            contentIndex.setdefault((etag, state.size), key)
+    if len(contentIndex) == 0:
+        return
+
+    deleting = {normalizePath(local.relPath): local for local in plan.to_delete_local}
+    moved: set[str] = set()
+    downloads = []
+    for object in plan.to_download:
+        key = contentIndex.get((object.ETag, object.Size or 0))
+        if key is None:
+            downloads.append(object)
+        elif deleteLocal and key in deleting and key not in moved:
+            moved.add(key)
+            plan.to_move.append((object, deleting[key]))
+        else:
+            source = os.path.join(fileIndex.folder, fileIndex.files[key].relPath)
+            plan.to_copy.append((object, source))
+
+    plan.to_download = downloads
+    plan.to_delete_local = [
+        local
+        for local in plan.to_delete_local
+        if normalizePath(local.relPath) not in moved
+    ]
@@ -0,0 +1,85 @@
+import threading
+import time
+from datetime import datetime, timezone
+from urllib.parse import parse_qs, urlparse
+
+from constants import PRESIGN_CACHE_MAX_ENTRIES, PRESIGN_DEFAULT_TTL_SECONDS
+from metrics import metrics
+
+# don't hand out urls that expire before a transfer can reasonably start
+EXPIRY_MARGIN_SECONDS = 60
+
+
+def presignedUrlExpiry(url: str, now: float) -> float:
+    """
+    Returns the unix time a presigned url stops working, read from its
+    SigV4 (X-Amz-Date + X-Amz-Expires) or SigV2 (Expires) query parameters
+    """
+
+    query = parse_qs(urlparse(url).query)
+    try:
+        if "X-Amz-Date" in query and "X-Amz-Expires" in query:
+            signed = datetime.strptime(query["X-Amz-Date"][0], "%Y%m%dT%H%M%SZ")
+            signedAt = signed.replace(tzinfo=timezone.utc).timestamp()
+            return signedAt + int(query["X-Amz-Expires"][0])
+        if "X-Amz-Expires" in query:
+            return now + int(query["X-Amz-Expires"][0])
+        if "Expires" in query:
+            return float(query["Expires"][0])
+    except ValueError:
+        pass
+
+    return now + PRESIGN_DEFAULT_TTL_SECONDS
+
+
+class PresignedUrlCache:
+    """
+    Thread safe map of object key -> presigned url, dropping urls that are about to expire
+    """
+
+    def __init__(self, maxEntries: int = PRESIGN_CACHE_MAX_ENTRIES):
+        self.maxEntries = maxEntries
+        self.entries: dict[str, tuple[str, float]] = {}
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> str | None:
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] - EXPIRY_MARGIN_SECONDS <= now:
+                del self.entries[key]
+                entry = None
+
+        metrics.increment("presign_cache_total", result="miss" if entry is None else "hit")
+        return None if entry is None else entry[0]
+
+    def put(self, key: str, url: str):
+        now = time.time()
+        expiresAt = presignedUrlExpiry(url, now)
+        if expiresAt - EXPIRY_MARGIN_SECONDS <= now:
+            return
+
+        with self.lock:
+            if len(self.entries) >= self.maxEntries:
+                self._evict(now)
+            self.entries[key] = (url, expiresAt)
+
+    def invalidate(self, key: str):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def _evict(self, now: float):
+        expired = [
+            key
+            for key, (_, expiresAt) in self.entries.items()
+            if expiresAt - EXPIRY_MARGIN_SECONDS <= now
+        ]
+        for key in expired:
+            del self.entries[key]
+
+        # still full, drop the ones expiring soonest
+        overflow = len(self.entries) - self.maxEntries + 1
+        if overflow > 0:
+            soonest = sorted(self.entries.items(), key=lambda entry: entry[1][1])
+            for key, _ in soonest[:overflow]:
+                del self.entries[key]
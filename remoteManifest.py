@@ -0,0 +1,139 @@
+import json
+import logging
+
+from api_service import getFileListing
+from metrics import metrics
+from models.fileObject import FileObject
+from paths import toLocalPath
+from stateStore import StateStore, getStateStore
+
+"""
+The server listing as of the previous sync, kept in the remote_manifest table together
+with the listing's ETag and change cursor.
+
+An unchanged account costs one request answered with 304. A backend that keeps a change
+log only sends what changed since the cursor. Otherwise the full listing is diffed against
+the manifest, and only the rows that changed are written.
+"""
+
+VALIDATORS_SETTING = "remoteManifest"
+
+
+class RemoteManifest:
+    def __init__(self, account: str, store: StateStore | None = None):
+        self.account = account
+        self.store = store if store is not None else getStateStore()
+        self.objects: dict[str, FileObject] = {}
+        self.etag: str | None = None
+        self.cursor: str | None = None
+        self.load()
+
+    def load(self):
+        rows = self.store.query(
+            "SELECT key, etag, size, last_modified_ns, storage_class"
+            " FROM remote_manifest WHERE account = ?",
+            (self.account,),
+        )
+        self.objects = {
+            key: FileObject(etag, key, lastModifiedNs, size, storageClass)
+            for key, etag, size, lastModifiedNs, storageClass in rows
+        }
+
+        validators = self.store.getSetting(VALIDATORS_SETTING, {}).get(self.account, {})
+        self.etag = validators.get("etag")
+        self.cursor = validators.get("cursor")
+
+        # keys stored in another form than this platform's local paths are dropped,
+        # and the server listed in full again
+        stale = {key for key in self.objects if toLocalPath(key) != key}
+        if len(stale) > 0:
+            logging.info("Relisting the server, %d manifest keys are stale", len(stale))
+            self._apply({}, stale, None, None)
+        logging.info("Loaded remote manifest with %d files", len(self.objects))
+
+    def fetch(self, token: str, uid: str, onObject=None) -> list[FileObject] | None:
+        """
+        Brings the manifest up to date with the server and returns every server file,
+        or None if the server couldn't be listed.
+
+        onObject(object) is called for every server file as soon as it is certain to exist:
+        while a full listing streams in, otherwise once the manifest is up to date.
+        """
+
+        # the validators are saved in the same transaction as the manifest they describe
+        try:
+            listing = getFileListing(token, uid, self.etag, self.cursor, onObject)
+        except Exception as e:
+            logging.error("Failed to get file list: %s", e)
+            return None
+        if listing is None:
+            return None
+
+        if listing.objects is None:
+            metrics.increment("listings_total", result="unchanged")
+            logging.info("Server files unchanged since the last listing")
+            return self._announce(onObject)
+
+        if listing.delta:
+            changed = {object.Key: object for object in listing.objects}
+            removed = {key for key in listing.deletedKeys if key in self.objects}
+            metrics.increment("listings_total", result="delta")
+            announce = onObject
+        else:
+            current = {object.Key: object for object in listing.objects}
+            changed = {
+                key: object
+                for key, object in current.items()
+                if self.objects.get(key) != object
+            }
+            removed = self.objects.keys() - current.keys()
+            metrics.increment("listings_total", result="full")
+            # already announced while streaming
+            announce = None
+
+        self._apply(changed, removed, listing.etag, listing.cursor)
+        logging.info(
+            "Server files: %d added or changed, %d removed", len(changed), len(removed)
+        )
+        return self._announce(announce)
+
+    def _announce(self, onObject) -> list[FileObject]:
+        objects = list(self.objects.values())
+        if onObject is not None:
+            for object in objects:
+                onObject(object)
+        return objects
+
+    def _apply(self, changed: dict[str, FileObject], removed: set[str], etag, cursor):
+        for key in removed:
+            self.objects.pop(key, None)
+        self.objects.update(changed)
+        self.etag = etag
+        self.cursor = cursor
+
+        validators = self.store.getSetting(VALIDATORS_SETTING, {})
+        validators[self.account] = {"etag": etag, "cursor": cursor}
+        with self.store.transaction() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO remote_manifest (account, key, etag, size,"
+                " last_modified_ns, storage_class) VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        self.account,
+                        key,
+                        object.ETag,
+                        object.Size,
+                        object.LastModifiedNs,
+                        object.StorageClass,
+                    )
+                    for key, object in changed.items()
+                ],
+            )
+            connection.executemany(
+                "DELETE FROM remote_manifest WHERE account = ? AND key = ?",
+                [(self.account, key) for key in removed],
+            )
+            connection.execute(
+                "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                (VALIDATORS_SETTING, json.dumps(validators)),
+            )
@@ -0,0 +1,253 @@
+import logging
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from constants import DEFAULT_ROOT, MAX_PARALLEL_ROOTS, ROOTS_DIR
+from stateStore import STATE_DB_PATH, StateStore, getStateStore, resetStateStore
+
+"""
+Several sync roots in one install. A root is a directory holding its own state.db, log.txt
+and metrics, so it has its own offline folder, account, backend url and sync settings.
+The default root is the working directory itself, single root installs don't change.
+
+Extra roots are registered in the default root's state.db and live in roots/<name>.
+syncRoots() runs every root in its own worker process, at most maxParallel at a time,
+and splits the overall transfer and bandwidth caps between the roots running together.
+
+    main.py roots add team-share /mnt/team --backend https://pb.example.com/
+    main.py --root team-share signin
+    main.py sync --all --yes --max-download 50000000
+"""
+
+ROOTS_SETTING = "roots"
+ROOT_NAME = re.compile(r"^[A-Za-z0-9._-]+$")
+
+
+def listRoots() -> dict[str, str]:
+    """
+    Returns root name -> state directory, the default root first
+    """
+
+    roots = {DEFAULT_ROOT: os.getcwd()}
+    roots.update(getStateStore().getSetting(ROOTS_SETTING, {}))
+    return roots
+
+
+def addRoot(name: str, folder: str, backendUrl: str | None = None) -> str:
+    """
+    Registers a root syncing folder and returns its state directory.
+    Sign in afterwards with the root selected, every root has its own account.
+    """
+
+    if not ROOT_NAME.match(name) or name == DEFAULT_ROOT:
+        raise ValueError(f"Invalid root name: {name}")
+    roots = getStateStore().getSetting(ROOTS_SETTING, {})
+    if name in roots:
+        raise ValueError(f"Root {name} already exists")
+
+    stateDir = os.path.abspath(os.path.join(ROOTS_DIR, name))
+    os.makedirs(stateDir, exist_ok=True)
+
+    store = StateStore(os.path.join(stateDir, STATE_DB_PATH))
+    try:
+        store.setSetting("offlineFolder", os.path.abspath(folder))
+        if backendUrl is not None:
+            store.setSetting("backendUrl", backendUrl)
+    finally:
+        store.close()
+
+    roots[name] = stateDir
+    getStateStore().setSetting(ROOTS_SETTING, roots)
+    logging.info("Added root %s for %s in %s", name, folder, stateDir)
+    return stateDir
+
+
+def removeRoot(name: str) -> str:
+    """
+    Unregisters a root and returns its state directory, which is left on disk
+    """
+
+    roots = getStateStore().getSetting(ROOTS_SETTING, {})
+    if name not in roots:
+        raise ValueError(f"No root named {name}")
+
+    stateDir = roots.pop(name)
+    getStateStore().setSetting(ROOTS_SETTING, roots)
+    logging.info("Removed root %s, its state stays in %s", name, stateDir)
+    return stateDir
+
+
+def describeRoot(stateDir: str) -> dict:
+    """
+    Reads a root's folder, backend and account without loading it
+    """
+
+    store = StateStore(os.path.join(stateDir, STATE_DB_PATH))
+    try:
+        settings = store.getSettings()
+    finally:
+        store.close()
+
+    user = settings.get("user") or {}
+    return {
+        "stateDir": stateDir,
+        "offlineFolder": settings.get("offlineFolder"),
+        "backendUrl": settings.get("backendUrl"),
+        "email": user.get("email"),
+    }
+
+
+def useRoot(name: str):
+    """
+    Switches this process to a root, see _enterRoot
+    """
+
+    roots = listRoots()
+    if name not in roots:
+        raise ValueError(f"No root named {name}")
+
+    _enterRoot(roots[name])
+
+
+def _enterRoot(stateDir: str):
+    """
+    Changes into a root's state directory and reloads the settings from its state.db.
+    Call before anything syncs, modules holding on to the old settings won't notice.
+    """
+
+    os.chdir(stateDir)
+    resetStateStore()
+
+    from configs import config
+
+    config.load()
+
+
+def _share(total: int, running: int) -> int:
+    # 0 is unlimited, otherwise every running root gets an equal part of at least 1
+    return 0 if total <= 0 else max(1, total // running)
+
+
+def _capped(own: int, share: int) -> int:
+    if share == 0:
+        return own
+    if own <= 0:
+        return share
+    return min(own, share)
+
+
+def _syncRoot(
+    name: str,
+    stateDir: str,
+    assumeYes: bool,
+    dryRun: bool,
+    maxTransfers: int,
+    maxDownloadBytesPerSecond: int,
+    maxUploadBytesPerSecond: int,
+) -> dict:
+    """
+    Runs one headless sync inside a fresh worker process
+    """
+
+    _enterRoot(stateDir)
+    from logs import setupLogging
+
+    setupLogging(console=False)
+
+    from auth import getAuth
+    from configs import getOfflineFolder, getSyncSettings
+    from sync import Sync
+
+    if getOfflineFolder() is None:
+        return {"root": name, "error": "Offline folder not set"}
+    if getAuth() is None:
+        return {"root": name, "error": "Not signed in"}
+
+    # the caps only apply to this run, they are not saved to the root's settings
+    settings = getSyncSettings()
+    settings.maxConcurrentTransfers = _capped(settings.maxConcurrentTransfers, maxTransfers)
+    settings.maxDownloadBytesPerSecond = _capped(
+        settings.maxDownloadBytesPerSecond, maxDownloadBytesPerSecond
+    )
+    settings.maxUploadBytesPerSecond = _capped(
+        settings.maxUploadBytesPerSecond, maxUploadBytesPerSecond
+    )
+
+    result = Sync(assumeYes=assumeYes, dryRun=dryRun, headless=True)
+    if result is None:
+        return {"root": name, "error": "Sync failed, see log.txt in " + stateDir}
+    return {"root": name, "summary": result.summary()}
+
+
+def _inNewProcess(*args) -> dict:
+    """
+    Runs _syncRoot in a spawned process of its own, every root needs its own freshly
+    imported modules. A pool worker would carry one root's module state into the next.
+    """
+
+    with ProcessPoolExecutor(
+        max_workers=1, mp_context=multiprocessing.get_context("spawn")
+    ) as process:
+        return process.submit(_syncRoot, *args).result()
+
+
+def syncRoots(
+    names: list[str] | None = None,
+    assumeYes: bool = False,
+    dryRun: bool = False,
+    maxParallel: int = MAX_PARALLEL_ROOTS,
+    maxTransfers: int = 0,
+    maxDownloadBytesPerSecond: int = 0,
+    maxUploadBytesPerSecond: int = 0,
+    onDone=None,
+) -> dict[str, dict]:
+    """
+    Syncs the named roots (all by default) in parallel worker processes.
+
+    At most maxParallel roots run at once, each in a process of its own so a slow root
+    only holds its own slot. maxTransfers and the bandwidth limits are totals over the
+    running roots, 0 is unlimited. onDone(outcome) is called as each root finishes.
+
+    Returns root name -> {"summary": ...} or {"error": ...}
+    """
+
+    roots = listRoots()
+    if names is not None:
+        roots = {name: roots[name] for name in names}
+    elif describeRoot(roots[DEFAULT_ROOT])["offlineFolder"] is None:
+        # installs that only use named roots
+        del roots[DEFAULT_ROOT]
+    if len(roots) == 0:
+        return {}
+
+    running = max(1, min(maxParallel, len(roots)))
+    outcomes: dict[str, dict] = {}
+
+    with ThreadPoolExecutor(max_workers=running) as pool:
+        futures = {
+            pool.submit(
+                _inNewProcess,
+                name,
+                stateDir,
+                assumeYes,
+                dryRun,
+                _share(maxTransfers, running),
+                _share(maxDownloadBytesPerSecond, running),
+                _share(maxUploadBytesPerSecond, running),
+            ): name
+            for name, stateDir in roots.items()
+        }
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                outcome = future.result()
+            except Exception as e:
+                logging.error("Root %s failed: %s", name, e)
+                outcome = {"root": name, "error": str(e)}
+            outcomes[name] = outcome
+            if onDone is not None:
+                onDone(outcome)
+
+    return {name: outcomes[name] for name in roots}
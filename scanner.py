@@ -0,0 +1,169 @@
+import logging
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import NamedTuple
+
+from constants import SCAN_WORKERS
+from utils import isPartialDownload, removeOrphanedPartials
+
+"""
+Local folder scanner built on os.scandir. Every file costs one stat, taken from its
+directory entry, and comes back as a compact ScanRecord so nobody has to stat it again.
+
+Directories are listed on a thread pool, each subdirectory as its own task, so wide or
+deep trees on network shares and NVMe drives are listed concurrently. Results stream
+out of generators as directories finish, in no particular order.
+
+    for record in scanFolder(folder):
+        ...
+"""
+
+
+class ScanRecord(NamedTuple):
+    relPath: str
+    size: int
+    mtime_ns: int
+    inode: int
+
+
+class DirListing(NamedTuple):
+    relDir: str
+    mtime_ns: int
+    files: list[ScanRecord]
+    subdirs: list[str]
+
+
+def joinRel(relDir: str, name: str) -> str:
+    return os.path.join(relDir, name) if relDir else name
+
+
+def listDir(folder: str, relDir: str = "", removePartials: bool = True) -> DirListing:
+    """
+    Lists one directory of folder in a single scandir pass, skipping unfinished downloads.
+    removePartials also deletes the orphaned ones, see utils.removeOrphanedPartials.
+
+    The mtime is read before listing, so a change made while listing shows up next time.
+    """
+
+    absDir = os.path.join(folder, relDir) if relDir else folder
+    mtime_ns = os.stat(absDir).st_mtime_ns
+
+    files: list[ScanRecord] = []
+    subdirs: list[str] = []
+    partials: list[str] = []
+    with os.scandir(absDir) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+                    continue
+                if not entry.is_file():
+                    continue
+                if isPartialDownload(entry.name):
+                    partials.append(entry.name)
+                    continue
+                stats = entry.stat()
+            except OSError:
+                # removed between listing and stat
+                continue
+
+            files.append(
+                ScanRecord(
+                    joinRel(relDir, entry.name),
+                    stats.st_size,
+                    stats.st_mtime_ns,
+                    # windows leaves st_ino empty on directory entries
+                    stats.st_ino or entry.inode(),
+                )
+            )
+
+    # deleting an orphaned partial changes the directory mtime, so read it again
+    if removePartials and removeOrphanedPartials(absDir, partials):
+        mtime_ns = os.stat(absDir).st_mtime_ns
+
+    return DirListing(relDir, mtime_ns, files, subdirs)
+
+
+def statRecord(folder: str, relPath: str) -> ScanRecord | None:
+    """
+    Stats a single file, None if it is gone
+    """
+
+    try:
+        stats = os.stat(os.path.join(folder, relPath))
+    except OSError:
+        return None
+    return ScanRecord(relPath, stats.st_size, stats.st_mtime_ns, stats.st_ino)
+
+
+def walkParallel(
+    visit, startDir: str = "", workers: int = SCAN_WORKERS, failed: set | None = None
+):
+    """
+    Calls visit(relDir) -> (result, subdirs) for startDir and every subdirectory it
+    reports, on workers threads, and yields (relDir, result) as each one finishes.
+
+    Directories that fail with an OSError are logged and skipped along with their
+    subtree, and added to failed if given. Closing the generator early cancels the
+    directories not started yet.
+    """
+
+    if workers <= 1:
+        pending = [startDir]
+        while len(pending) > 0:
+            relDir = pending.pop()
+            try:
+                result, subdirs = visit(relDir)
+            except OSError as e:
+                logging.error("Failed to scan %s: %s", relDir or ".", e)
+                if failed is not None:
+                    failed.add(relDir)
+                continue
+            pending.extend(joinRel(relDir, name) for name in subdirs)
+            yield relDir, result
+        return
+
+    with ThreadPoolExecutor(workers, thread_name_prefix="scan") as pool:
+        running = {pool.submit(visit, startDir): startDir}
+        try:
+            while len(running) > 0:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    relDir = running.pop(future)
+                    try:
+                        result, subdirs = future.result()
+                    except OSError as e:
+                        logging.error("Failed to scan %s: %s", relDir or ".", e)
+                        if failed is not None:
+                            failed.add(relDir)
+                        continue
+
+                    for name in subdirs:
+                        child = joinRel(relDir, name)
+                        running[pool.submit(visit, child)] = child
+                    yield relDir, result
+        finally:
+            for future in running:
+                future.cancel()
+
+
+def scanDirs(folder: str, startDir: str = "", workers: int = SCAN_WORKERS):
+    """
+    Yields a DirListing for startDir and every directory below it
+    """
+
+    def visit(relDir: str):
+        listing = listDir(folder, relDir)
+        return listing, listing.subdirs
+
+    for _, listing in walkParallel(visit, startDir, workers):
+        yield listing
+
+
+def scanFolder(folder: str, workers: int = SCAN_WORKERS):
+    """
+    Yields a ScanRecord for every file in folder, relative paths included
+    """
+
+    for listing in scanDirs(folder, workers=workers):
+        yield from listing.files
@@ -0,0 +1,149 @@
+import fnmatch
+import os
+import threading
+import time
+
+from constants import BANDWIDTH_BURST_SECONDS
+from paths import toServerKey
+
+PRIORITY_NONE = "none"
+PRIORITY_SMALLEST = "smallest"
+PRIORITY_NEWEST = "newest"
+PRIORITY_PATTERN = "pattern"
+
+
+class TokenBucket:
+    """
+    Caps throughput at rate bytes per second across every thread that consumes from it,
+    allowing bursts of up to BANDWIDTH_BURST_SECONDS worth of bytes.
+    A rate of 0 means unlimited.
+    """
+
+    def __init__(self, rate: int = 0):
+        self.lock = threading.Lock()
+        self.configure(rate)
+
+    def configure(self, rate: int):
+        with self.lock:
+            self.rate = max(0, int(rate or 0))
+            self.capacity = self.rate * BANDWIDTH_BURST_SECONDS
+            self.tokens = self.capacity
+            self.updated = time.monotonic()
+
+    def consume(self, amount: int):
+        """
+        Takes amount bytes from the bucket, sleeping until the rate allows them
+        """
+
+        if self.rate == 0:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            # going into debt keeps large chunks fair between threads
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait > 0:
+            time.sleep(wait)
+
+
+class BandwidthLimiter:
+    """
+    Separate global caps for downloads and uploads
+    """
+
+    def __init__(self):
+        self.download = TokenBucket()
+        self.upload = TokenBucket()
+
+    def configure(self, maxDownloadBytesPerSecond: int, maxUploadBytesPerSecond: int):
+        self.download.configure(maxDownloadBytesPerSecond)
+        self.upload.configure(maxUploadBytesPerSecond)
+
+    def throttledChunks(self, data: bytes, chunkSize: int = 64 * 1024):
+        """
+        Yields data in chunks, at the upload rate
+        """
+
+        view = memoryview(data)
+        for start in range(0, len(data), chunkSize):
+            chunk = view[start : start + chunkSize]
+            self.upload.consume(len(chunk))
+            yield bytes(chunk)
+
+    def throttledFile(self, file, chunkSize: int = 64 * 1024):
+        """
+        Yields the rest of an open file in chunks, at the upload rate
+        """
+
+        while True:
+            chunk = file.read(chunkSize)
+            if not chunk:
+                return
+            self.upload.consume(len(chunk))
+            yield chunk
+
+
+bandwidthLimiter = BandwidthLimiter()
+
+
+def _patternRank(path: str, patterns: list[str]) -> int:
+    path = toServerKey(path)
+    for rank, pattern in enumerate(patterns):
+        if fnmatch.fnmatch(path, pattern):
+            return rank
+    return len(patterns)
+
+
+def _localMtime(local) -> int:
+    try:
+        return os.stat(local.absPath).st_mtime_ns
+    except OSError:
+        return 0
+
+
+def downloadKey(policy: str, patterns: list[str] | None = None):
+    """
+    Returns the sort key that orders FileObjects by the policy, smallest first, or None
+    to keep the order they come in
+    """
+
+    if policy == PRIORITY_SMALLEST:
+        return lambda object: object.Size or 0
+    if policy == PRIORITY_NEWEST:
+        return lambda object: -object.LastModifiedNs
+    if policy == PRIORITY_PATTERN:
+        patterns = patterns or []
+        return lambda object: (_patternRank(object.Key, patterns), object.Size or 0)
+    return None
+
+
+def orderDownloads(objects: list, policy: str, patterns: list[str] | None = None) -> list:
+    """
+    Orders FileObjects so the most useful ones transfer first
+    """
+
+    key = downloadKey(policy, patterns)
+    return list(objects) if key is None else sorted(objects, key=key)
+
+
+def orderUploads(localFiles: list, policy: str, patterns: list[str] | None = None) -> list:
+    """
+    Orders planner.LocalFiles so the most useful ones transfer first
+    """
+
+    if policy == PRIORITY_SMALLEST:
+        return sorted(localFiles, key=lambda local: local.size)
+    if policy == PRIORITY_NEWEST:
+        return sorted(localFiles, key=_localMtime, reverse=True)
+    if policy == PRIORITY_PATTERN:
+        patterns = patterns or []
+        return sorted(
+            localFiles,
+            key=lambda local: (_patternRank(local.relPath, patterns), local.size),
+        )
+    return list(localFiles)
@@ -0,0 +1,228 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from constants import TRANSFER_JOURNAL_MAX_ROWS
+
+STATE_DB_PATH = "state.db"
+TINYDB_PATH = "db.json"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS local_manifest (
+    root TEXT NOT NULL,
+    key TEXT NOT NULL,
+    rel_path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    etag TEXT,
+    synced_size INTEGER,
+    synced_mtime_ns INTEGER,
+    PRIMARY KEY (root, key)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS local_deleted (
+    root TEXT NOT NULL,
+    key TEXT NOT NULL,
+    etag TEXT NOT NULL,
+    PRIMARY KEY (root, key)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS local_dirs (
+    root TEXT NOT NULL,
+    rel_dir TEXT NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    files TEXT NOT NULL,
+    subdirs TEXT NOT NULL,
+    PRIMARY KEY (root, rel_dir)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS remote_manifest (
+    account TEXT NOT NULL,
+    key TEXT NOT NULL,
+    etag TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_modified_ns INTEGER NOT NULL,
+    storage_class TEXT NOT NULL,
+    PRIMARY KEY (account, key)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS hash_cache (
+    cache_key TEXT PRIMARY KEY,
+    md5 TEXT NOT NULL,
+    parts TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS transfer_journal (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    direction TEXT NOT NULL,
+    key TEXT NOT NULL,
+    state TEXT NOT NULL,
+    bytes INTEGER NOT NULL,
+    error TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS transfer_journal_key ON transfer_journal (key);
+CREATE INDEX IF NOT EXISTS transfer_journal_state ON transfer_journal (state);
+"""
+
+
+class StateStore:
+    """
+    SQLite database in WAL mode holding settings and all per-file sync state.
+
+    Writers only touch the rows that changed, grouped into one transaction,
+    so saving after a sync costs O(changed) instead of rewriting everything.
+    """
+
+    def __init__(self, path: str = STATE_DB_PATH):
+        self.path = path
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Runs everything inside the block as one transaction, rolled back on error
+        """
+
+        with self.lock:
+            self.connection.execute("BEGIN")
+            try:
+                yield self.connection
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+
+    def query(self, sql: str, parameters=()) -> list[tuple]:
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    # settings
+
+    def getSettings(self) -> dict:
+        rows = self.query("SELECT key, value FROM settings")
+        return {key: json.loads(value) for key, value in rows}
+
+    def getSetting(self, key: str, default=None):
+        rows = self.query("SELECT value FROM settings WHERE key = ?", (key,))
+        return json.loads(rows[0][0]) if len(rows) > 0 else default
+
+    def setSetting(self, key: str, value):
+        with self.transaction() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                (key, json.dumps(value)),
+            )
+
+    def deleteSettings(self, keys: list[str]):
+        with self.transaction() as connection:
+            connection.executemany(
+                "DELETE FROM settings WHERE key = ?", [(key,) for key in keys]
+            )
+
+    # transfer journal
+
+    def journalTransfers(
+        self,
+        entries: list[tuple[str, str, str, int, str | None]],
+        maxRows: int = TRANSFER_JOURNAL_MAX_ROWS,
+    ):
+        """
+        Appends (direction, key, state, bytes, error) rows in one transaction, and drops
+        the oldest rows beyond the newest maxRows
+        """
+
+        now = time.time()
+        with self.transaction() as connection:
+            connection.executemany(
+                "INSERT INTO transfer_journal (direction, key, state, bytes, error, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                [entry + (now,) for entry in entries],
+            )
+            # ids only grow, so this is a range delete on the primary key
+            connection.execute(
+                "DELETE FROM transfer_journal"
+                " WHERE id <= (SELECT MAX(id) FROM transfer_journal) - ?",
+                (maxRows,),
+            )
+
+    # migration
+
+    def migrateTinyDb(self, path: str = TINYDB_PATH):
+        """
+        Copies the settings and user record from an old db.json, once
+        """
+
+        if not os.path.exists(path) or self.getSetting("migratedTinyDb", False):
+            return
+
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+        except Exception as e:
+            logging.error("Failed to read %s for migration: %s", path, e)
+            return
+
+        with self.transaction() as connection:
+            for document in data.get("_default", {}).values():
+                for key, value in document.items():
+                    connection.execute(
+                        "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                        (key, json.dumps(value)),
+                    )
+            users = list(data.get("user", {}).values())
+            if len(users) > 0:
+                connection.execute(
+                    "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                    ("user", json.dumps(users[0])),
+                )
+            connection.execute(
+                "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                ("migratedTinyDb", "true"),
+            )
+        logging.info("Migrated settings from %s", path)
+
+
+_store: StateStore | None = None
+_storeLock = threading.Lock()
+
+
+def getStateStore() -> StateStore:
+    """
+    Returns the shared store, creating it and migrating old data on first use
+    """
+
+    global _store
+    if _store is None:
+        with _storeLock:
+            if _store is None:
+                store = StateStore()
+                store.migrateTinyDb()
+                _store = store
+    return _store
+
+
+def resetStateStore():
+    """
+    Closes the shared store, the next getStateStore() opens the state.db of the current working directory
+    """
+
+    global _store
+    with _storeLock:
+        if _store is not None:
+            _store.close()
+            _store = None
@@ -1,19 +1,27 @@
+import itertools
 import logging
+import os
+import time
+from dataclasses import dataclass
 
 from rich.console import Console
 from rich.prompt import Confirm
 from rich.table import Table
 
-from api_service import getDownloadUrl, getFileList
 from auth import getAuth
 from configs import getOfflineFolder, getSyncSettings, updateLastSync
-from models.fileObject import FileObject
-from utils import (
-    downloadUrlToFile,
-    formatBytesToString,
-    getAllFilesFromFolder,
-    isLocalNewer,
-)
+from constants import LISTING_MAX_ROWS
+from fileIndex import FileIndex
+from hashing import HashCache
+from logs import LogSampler
+from metrics import metrics
+from pathTrie import PathTrie, localTrie, pruneEmptyFolders, remoteTrie
+from paths import normalizePath
+from pipeline import EarlyDownloads, listAndScan
+from planner import SyncPlan, buildSyncPlan
+from scheduler import bandwidthLimiter
+from transfer import TransferEngine, TransferReport
+from utils import REUSE_OFF, formatBytesToString
 
 sync_status = "Folder not selected"
 is_syncing = False
@@ -24,11 +32,116 @@ def getSyncStatus():
     return sync_status
 
 
-def Sync():
+@dataclass
+class SyncResult:
+    plan: SyncPlan
+    dryRun: bool = False
+    reused: TransferReport | None = None
+    downloads: TransferReport | None = None
+    uploads: TransferReport | None = None
+    deletedLocal: TransferReport | None = None
+    deletedRemote: TransferReport | None = None
+
+    def summary(self) -> dict:
+        plan = self.plan
+
+        def pending(items, bytes):
+            return {"files": len(items), "bytes": bytes}
+
+        def transferred(report):
+            if report is None:
+                return None
+            return {
+                "succeeded": len(report.succeeded),
+                "failed": len(report.failed),
+                "bytes": report.bytesTransferred,
+                "errors": [
+                    {"path": result.key, "error": result.error}
+                    for result in report.failed[:LISTING_MAX_ROWS]
+                ],
+            }
+
+        return {
+            "dryRun": self.dryRun,
+            "pending": {
+                "download": pending(plan.to_download, plan.downloadBytes),
+                "reuse": pending(plan.to_copy + plan.to_move, plan.reuseBytes),
+                "upload": pending(plan.to_upload, plan.uploadBytes),
+                "update": pending(plan.to_update, plan.updateBytes),
+                "deleteLocal": pending(plan.to_delete_local, plan.deleteLocalBytes),
+                "deleteRemote": pending(plan.to_delete_remote, plan.deleteRemoteBytes),
+            },
+            "reused": transferred(self.reused),
+            "downloaded": transferred(self.downloads),
+            "uploaded": transferred(self.uploads),
+            "deletedLocal": transferred(self.deletedLocal),
+            "deletedRemote": transferred(self.deletedRemote),
+        }
+
+
+def pendingFiles(plan: SyncPlan):
+    """
+    Yields (action, path, size) for everything the plan would transfer or delete, without copying the lists
+    """
+
+    for object in plan.to_download:
+        yield "download", object.Key, object.Size or 0
+    for object, _ in plan.to_copy:
+        yield "copy", object.Key, object.Size or 0
+    for object, _ in plan.to_move:
+        yield "move", object.Key, object.Size or 0
+    for local in plan.to_upload:
+        yield "upload", local.relPath, local.size
+    for local in plan.to_update:
+        yield "update", local.relPath, local.size
+    for local in plan.to_delete_local:
+        yield "delete-local", local.relPath, local.size
+    for object in plan.to_delete_remote:
+        yield "delete-remote", object.Key, object.Size or 0
+
+
+def pendingPage(plan: SyncPlan, page: int, pageSize: int = LISTING_MAX_ROWS) -> list:
+    """
+    Returns page (starting at 1) of pendingFiles
+    """
+
+    start = (max(1, page) - 1) * pageSize
+    return list(itertools.islice(pendingFiles(plan), start, start + pageSize))
+
+
+def Sync(
+    assumeYes: bool = False,
+    paths: set[str] | None = None,
+    dryRun: bool = False,
+    headless: bool = False,
+    onResult=None,
+) -> SyncResult | None:
+    """
+    Syncs the offline folder with the server
+
+    assumeYes skips the confirmation prompts. paths limits the local scan to those
+    paths relative to the offline folder, as reported by the watcher
+
+    dryRun only plans, nothing is transferred. headless never prompts or prints, without
+    assumeYes it is a dry run, and onResult(direction, result, done, total) is called as
+    each file finishes so the caller can report progress itself
+
+    Returns what was planned and transferred, or None if the sync couldn't run.
+    Metrics are exported to syncSettings.metricsPath after every attempt
+    """
+
     global is_syncing
     global sync_status
-    if getOfflineFolder() is None or len(getOfflineFolder()) == 0:
-        logging.error("Invalid folder for sync: " + getOfflineFolder())
+    # nobody to confirm anything, so nothing is transferred and the last sync stays as it was
+    if headless and not assumeYes:
+        dryRun = True
+    # an unmounted drive or share must not look like every file was deleted
+    if (
+        getOfflineFolder() is None
+        or len(getOfflineFolder()) == 0
+        or not os.path.isdir(getOfflineFolder())
+    ):
+        logging.error("Invalid folder for sync: %s", getOfflineFolder())
         return
     if is_syncing:
         return
@@ -36,121 +149,352 @@ def Sync():
     sync_status = "Syncing"
     logging.info("Syncing...")
 
-    console = Console()
+    console = Console(quiet=headless)
+    started = time.perf_counter()
+    result = None
+    try:
+        result = _sync(console, assumeYes, paths, dryRun, headless, onResult)
+    finally:
+        is_syncing = False
+        metrics.observe("sync_seconds", time.perf_counter() - started)
+        metrics.increment(
+            "syncs_total", result="failed" if result is None else "done"
+        )
+        if result is not None and not dryRun:
+            metrics.set("last_sync_timestamp_seconds", time.time())
+
+        metricsPath = getSyncSettings().metricsPath
+        if metricsPath:
+            metrics.export(metricsPath)
+
+    if result is None:
+        sync_status = "Sync failed"
+        return None
+    if dryRun:
+        sync_status = "Planned"
+        return result
+
+    sync_status = "Synced"
+    console.print("Synced", style="bold green")
+    updateLastSync()
+    return result
+
+
+def _logFailures(console: Console, report: TransferReport, action: str):
+    if len(report.failed) == 0:
+        return
+    console.print(f"Failed to {action} {len(report.failed)} files", style="bold red")
+    sampler = LogSampler(logging.ERROR, f"failed {action}s")
+    for failure in report.failed:
+        sampler.log("Failed to %s %s: %s", action, failure.key, failure.error)
+    sampler.flush()
+
+
+def _printPending(console: Console, title: str, style: str, rows, count: int, total: int):
+    """
+    Prints at most LISTING_MAX_ROWS (path, size) rows, so huge plans stay cheap to show
+    """
+
+    table = Table(title=title)
+    table.add_column("File", style=style, no_wrap=True)
+    table.add_column("Size", style="magenta")
+    for path, size in itertools.islice(rows, LISTING_MAX_ROWS):
+        table.add_row(path, str(size) + " B")
+    if count > LISTING_MAX_ROWS:
+        table.add_row(f"... and {count - LISTING_MAX_ROWS} more", "")
+    table.add_row("Total", formatBytesToString(total))
+    console.print(table, justify="center")
+
+
+def _printDeletions(console: Console, title: str, files, whole: PathTrie):
+    """
+    Prints (path, size) files like _printPending, a folder that is deleted with everything in it as one row
+    """
+
+    deleting = PathTrie()
+    for path, size in files:
+        deleting.insert(path, size)
+    rows = [
+        (f"{key} ({count} files)" if key.endswith("/") else key, size)
+        for key, count, size in deleting.collapse(whole)
+    ]
+    _printPending(console, title, "red", iter(rows), len(rows), deleting.size())
+
+
+def _sync(
+    console: Console,
+    assumeYes: bool,
+    paths: set[str] | None,
+    dryRun: bool,
+    headless: bool,
+    onResult,
+) -> SyncResult | None:
+    """
+    Returns the result if the sync ran to the end, None otherwise
+    """
 
     auth = getAuth()
     if auth is None:
         logging.error("Auth not saved for sync")
-        return
+        return None
 
     token = auth[0]
     uid = auth[1].get("id")
     syncSettings = getSyncSettings()
 
-    # get server file list
-    server_files: list[FileObject] = getFileList(token, uid)
+    engine = TransferEngine(
+        token,
+        uid,
+        getOfflineFolder(),
+        syncSettings.maxConcurrentTransfers,
+        syncSettings.transferPriority,
+        syncSettings.priorityPatterns,
+        showProgress=not headless,
+        onResult=onResult,
+    )
+    bandwidthLimiter.configure(
+        syncSettings.maxDownloadBytesPerSecond, syncSettings.maxUploadBytesPerSecond
+    )
+    reuseLocal = syncSettings.localReuse != REUSE_OFF
+
+    # list the server and scan the folder together, downloads that need no
+    # confirmation start as soon as they are certain
+    early = None
+    if assumeYes and not dryRun and syncSettings.downloadMissingFiles:
+        early = EarlyDownloads(engine)
+    fileIndex = FileIndex(getOfflineFolder())
+    try:
+        server_files = listAndScan(
+            token,
+            uid,
+            fileIndex,
+            paths,
+            None if early is None else early.put,
+            reuseLocal,
+        )
+    except Exception:
+        if early is not None:
+            early.finish()
+        raise
     if server_files is None:
+        if early is not None:
+            early.finish()
         logging.error("No server files found")
-        return
+        return None
+    local_files, local_files_abs = fileIndex.listed()
+    # files below them may look deleted locally, so nothing is deleted on the server
+    scanFailed = len(fileIndex.failedDirs) > 0
+    if scanFailed:
+        logging.error(
+            "Failed to scan %d folders, skipping server deletions",
+            len(fileIndex.failedDirs),
+        )
 
-    logging.debug(server_files)
-    server_keys: list[str] = []
     logging.debug("---------- Loading Server files ----------")
+    sampler = LogSampler(logging.DEBUG, "server files")
     for server_file in server_files:
-        logging.debug(server_file.Key)
-        server_keys.append(server_file.Key)
+        sampler.log("%s", server_file.Key)
+    sampler.flush()
 
-    # get local file list
-    local_files, local_files_abs = getAllFilesFromFolder(getOfflineFolder())
     logging.debug("---------- Loading Local files ----------")
+    sampler = LogSampler(logging.DEBUG, "local files")
     for local_file in local_files:
-        logging.debug(local_file)
+        sampler.log("%s", local_file)
+    sampler.flush()
+
+    # compare, what is already downloading is left out
+    earlyKeys = set() if early is None else {object.Key for object in early.objects}
+    with metrics.timer("phase_seconds", phase="diff"):
+        hashCache = HashCache()
+        plan = buildSyncPlan(
+            [object for object in server_files if object.Key not in earlyKeys],
+            local_files,
+            local_files_abs,
+            fileIndex=fileIndex,
+            hashCache=hashCache,
+            reuseLocal=reuseLocal,
+            deleteLocal=syncSettings.deleteUnsyncedFiles,
+        )
+    hashCache.prune(fileIndex.replacedStats())
+    hashCache.save()
+    fileIndex.pruneDeleted({normalizePath(object.Key) for object in server_files})
+    for relPath, etag in plan.to_mark_synced:
+        fileIndex.markSynced(relPath, etag)
 
-    # compare
-    totalNotDownloaded = 0
-    totalNotUploaded = 0
+    earlyReport = TransferReport()
+    if early is not None:
+        earlyReport = early.finish()
+        # shown and reported with the rest, but already transferred
+        plan.to_download = early.objects + plan.to_download
 
-    missingTable = Table(title="Files not downloaded")
-    missingTable.add_column("File", style="cyan", no_wrap=True)
-    missingTable.add_column("Size", style="magenta")
     logging.debug("---------- Finding missing files (not downloaded) ----------")
-    missing_keys: list[FileObject] = []
-    for object in server_files:
-        if object.Key not in local_files and ".blazed-placeholder" not in object.Key:
-            logging.debug(object.Key)
-            missing_keys.append(object.Key)
-            missingTable.add_row(object.Key, str(object.Size or "0") + " B")
-            totalNotDownloaded += object.Size or 0
-    missingTable.add_row("Total", formatBytesToString(totalNotDownloaded))
-    console.print(missingTable, justify="center")
-
-    import os
-
-    unsyncedTable = Table(title="Files not uploaded or updated")
-    unsyncedTable.add_column("File", style="yellow", no_wrap=True)
-    unsyncedTable.add_column("Size", style="magenta")
+    sampler = LogSampler(logging.DEBUG, "missing files")
+    for object in plan.to_download:
+        sampler.log("%s", object.Key)
+    sampler.flush()
     logging.debug(
         "---------- Finding unsynced files (not uploaded or updated) ----------"
     )
-    unsynced_files: list[str] = []
-    for i, local_file in enumerate(local_files):
-        if local_file not in server_keys:
-            logging.debug(local_file)
-            unsynced_files.append(local_files_abs[i])
-            unsyncedTable.add_row(
-                local_file, str(os.path.getsize(local_files_abs[i])) + " B"
+    sampler = LogSampler(logging.DEBUG, "unsynced files")
+    for local in plan.to_upload + plan.to_update:
+        sampler.log("%s", local.relPath)
+    sampler.flush()
+
+    if not headless:
+        _printPending(
+            console,
+            "Files not downloaded",
+            "cyan",
+            ((object.Key, object.Size or 0) for object in plan.to_download),
+            len(plan.to_download),
+            plan.downloadBytes,
+        )
+        _printPending(
+            console,
+            "Files not uploaded or updated",
+            "yellow",
+            (
+                (local.relPath, local.size)
+                for local in itertools.chain(plan.to_upload, plan.to_update)
+            ),
+            len(plan.to_upload) + len(plan.to_update),
+            plan.uploadBytes + plan.updateBytes,
+        )
+        if len(plan.to_delete_local) > 0:
+            _printDeletions(
+                console,
+                "Files removed from the server",
+                ((local.relPath, local.size) for local in plan.to_delete_local),
+                localTrie(fileIndex),
             )
-            totalNotUploaded += os.path.getsize(local_files_abs[i])
-        elif local_file in server_keys:
-            if isLocalNewer(
-                local_files_abs[i],
-                server_files[server_keys.index(local_file)],
-            ):
-                logging.debug("SERVER outdated", local_file)
-                unsynced_files.append(local_files_abs[i])
-                unsyncedTable.add_row(
-                    local_file, str(os.path.getsize(local_files_abs[i])) + " B"
-                )
-                totalNotUploaded += os.path.getsize(local_files_abs[i])
-    unsyncedTable.add_row("Total", formatBytesToString(totalNotUploaded))
-    console.print(unsyncedTable, justify="center")
+        if len(plan.to_delete_remote) > 0:
+            _printDeletions(
+                console,
+                "Files deleted locally",
+                ((object.Key, object.Size or 0) for object in plan.to_delete_remote),
+                remoteTrie(server_files),
+            )
+
+    result = SyncResult(plan, dryRun)
+    if dryRun:
+        fileIndex.save()
+        return result
+
+    def confirm(question: str) -> bool:
+        return assumeYes or Confirm.ask(question)
 
     # download missing
-    confirmDownload = Confirm.ask(
-        "Download missing " + formatBytesToString(totalNotDownloaded) + "? y/n"
+    confirmDownload = confirm(
+        "Download missing " + formatBytesToString(plan.downloadBytes) + "? y/n"
     )
 
+    emptiedDirs: set[str] = set()
     if syncSettings.downloadMissingFiles and confirmDownload:
+        # folders the server keeps with a placeholder exist locally too, even while empty
+        for relDir in plan.to_create_dirs:
+            os.makedirs(os.path.join(getOfflineFolder(), relDir), exist_ok=True)
+
+        logging.debug("---------- Copying and moving local content ----------")
+        reuse = plan.to_copy + plan.to_move
+        report = engine.reuseAll(plan.to_copy, plan.to_move, syncSettings.localReuse)
+        result.reused = report
+        reused = {result.key for result in report.succeeded}
+        for object, _ in reuse:
+            if object.Key in reused:
+                fileIndex.markSynced(
+                    object.Key,
+                    object.ETag,
+                    os.path.join(getOfflineFolder(), object.Key),
+                )
+        movedFrom = {local.relPath for object, local in plan.to_move if object.Key in reused}
+        fileIndex.refresh(movedFrom)
+        emptiedDirs.update(os.path.dirname(relPath) for relPath in movedFrom)
+        # whatever couldn't be reused locally is downloaded after all
+        fallback = [object for object, _ in reuse if object.Key not in reused]
+
         logging.debug("---------- Downloading missing files ----------")
-        for missing_file in missing_keys:
-            logging.debug(missing_file)
-            down_url = getDownloadUrl(token, uid, missing_file)
-            logging.debug(down_url)
-
-            # download file
-            downloadUrlToFile(
-                down_url,
-                missing_file,
-                getOfflineFolder(),
-                server_files[server_keys.index(missing_file)],
-            )
+        remaining = [object for object in plan.to_download if object.Key not in earlyKeys]
+        report = engine.downloadAll(remaining + fallback)
+        report = TransferReport(earlyReport.results + report.results)
+        result.downloads = report
+        _logFailures(console, report, "download")
+
+        downloaded = {result.key for result in report.succeeded}
+        for object in plan.to_download + fallback:
+            if object.Key in downloaded:
+                fileIndex.markSynced(
+                    object.Key,
+                    object.ETag,
+                    os.path.join(getOfflineFolder(), object.Key),
+                )
 
-    console.print("Uploaded is not supported currently", style="bold yellow")
     # upload unsynced
-    # if syncSettings.uploadUnsyncedFiles:
-    #    logging.debug("---------- Uploading unsynced files ----------")
-    #    for unsynced_file in unsynced_files:
-    #        # remove offline folder from path and first slash
-    #        key = unsynced_file.replace(getOfflineFolder() + "\\", "")
-    #
-    #        # replace \\ with /
-    #        key = key.replace("\\", "/")
-    #
-    #        logging.debug("UPLOADING unsynced", unsynced_file, unsynced_file)
-    #        up_url = getUploadUrl(key, token, uid)
-    #        uploadToUrl(up_url, unsynced_file)
-
-    is_syncing = False
-    sync_status = "Synced"
-    console.print("Synced", style="bold green")
-    updateLastSync()
+    unsynced = plan.to_upload + plan.to_update
+    if syncSettings.uploadUnsyncedFiles and len(unsynced) > 0:
+        confirmUpload = confirm(
+            "Upload unsynced "
+            + formatBytesToString(plan.uploadBytes + plan.updateBytes)
+            + "? y/n"
+        )
+        if confirmUpload:
+            logging.debug("---------- Uploading unsynced files ----------")
+            report = engine.uploadAll(unsynced)
+            result.uploads = report
+            _logFailures(console, report, "upload")
+
+            # without an etag the file isn't recorded as synced, the next sync
+            # compares it with the listing instead of downloading it again
+            uploaded = {
+                result.key: result.etag for result in report.succeeded if result.etag
+            }
+            for local in unsynced:
+                if local.relPath in uploaded:
+                    fileIndex.markSynced(
+                        local.relPath, uploaded[local.relPath], local.absPath
+                    )
+
+    # propagate deletions
+    deleteLocal = plan.to_delete_local if syncSettings.deleteUnsyncedFiles else []
+    if syncSettings.deletePlaceholderFiles:
+        deleteLocal = deleteLocal + plan.placeholders
+    if len(deleteLocal) > 0 and confirm(
+        f"Delete {len(deleteLocal)} local files removed from the server? y/n"
+    ):
+        logging.debug("---------- Deleting local files ----------")
+        report = engine.deleteLocalAll(deleteLocal)
+        result.deletedLocal = report
+        _logFailures(console, report, "delete")
+        for deleted in report.succeeded:
+            fileIndex.forget(deleted.key)
+            emptiedDirs.add(os.path.dirname(deleted.key))
+
+    deletedRemote: set[str] = set()
+    if (
+        syncSettings.deleteMissingFiles
+        and not scanFailed
+        and len(plan.to_delete_remote) > 0
+        and confirm(
+            f"Delete {len(plan.to_delete_remote)} server files deleted locally? y/n"
+        )
+    ):
+        logging.debug("---------- Deleting server files ----------")
+        report = engine.deleteRemoteAll(plan.to_delete_remote)
+        result.deletedRemote = report
+        _logFailures(console, report, "delete")
+        for deleted in report.succeeded:
+            fileIndex.forget(deleted.key)
+            deletedRemote.add(deleted.key)
+
+    if syncSettings.deleteEmptyFolders and len(emptiedDirs) > 0:
+        removed = pruneEmptyFolders(
+            getOfflineFolder(),
+            emptiedDirs,
+            localTrie(fileIndex),
+            remoteTrie(
+                object for object in server_files if object.Key not in deletedRemote
+            ),
+        )
+        fileIndex.refresh(removed)
+
+    fileIndex.save()
+    return result
@@ -0,0 +1,427 @@
+import heapq
+import logging
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from dataclasses import dataclass, field
+
+import rich.progress
+from rich.console import Console
+
+from api_service import deleteFiles, getDownloadUrl, getDownloadUrls, presignedUrlCache
+from constants import (
+    DEFAULT_MAX_CONCURRENT_TRANSFERS,
+    DEFAULT_TRANSFER_PRIORITY,
+    DELETE_BATCH_SIZE,
+    PRESIGN_BATCH_SIZE,
+)
+from metrics import metrics
+from models.fileObject import FileObject
+from paths import normalizePath, toServerKey
+from planner import LocalFile
+from scheduler import downloadKey, orderDownloads, orderUploads
+from stateStore import getStateStore
+from upload import MultipartUploader
+from utils import REUSE_REFLINK, cloneLocalFile, downloadUrlToFile
+
+
+@dataclass
+class TransferResult:
+    key: str
+    size: int
+    success: bool
+    error: str | None = None
+    etag: str | None = None
+
+
+@dataclass
+class TransferReport:
+    results: list[TransferResult] = field(default_factory=list)
+
+    @property
+    def succeeded(self) -> list[TransferResult]:
+        return [result for result in self.results if result.success]
+
+    @property
+    def failed(self) -> list[TransferResult]:
+        return [result for result in self.results if not result.success]
+
+    @property
+    def bytesTransferred(self) -> int:
+        return sum(result.size for result in self.succeeded)
+
+    def __str__(self):
+        return f"{len(self.succeeded)} succeeded, {len(self.failed)} failed, {self.bytesTransferred} B transferred"
+
+
+class TransferEngine:
+    """
+    Presigns and transfers many files at once on a bounded pool of worker threads.
+
+    A failure on one file is recorded in the report and never stops the other transfers.
+    Files are submitted in the order given by priority, see scheduler.py for the policies.
+    showProgress draws rich progress bars, and onResult(direction, result, done, total)
+    is called from the coordinating thread as each file finishes.
+    """
+
+    def __init__(
+        self,
+        token: str,
+        uid: str,
+        offlineFolder: str,
+        maxConcurrent: int = DEFAULT_MAX_CONCURRENT_TRANSFERS,
+        priority: str = DEFAULT_TRANSFER_PRIORITY,
+        priorityPatterns: list[str] | None = None,
+        showProgress: bool = True,
+        onResult=None,
+    ):
+        self.token = token
+        self.uid = uid
+        self.offlineFolder = offlineFolder
+        self.maxConcurrent = max(1, int(maxConcurrent))
+        self.priority = priority
+        self.priorityPatterns = priorityPatterns or []
+        self.showProgress = showProgress
+        self.onResult = onResult
+
+    def downloadAll(self, objects: list[FileObject]) -> TransferReport:
+        if len(objects) == 0:
+            return TransferReport()
+        objects = orderDownloads(objects, self.priority, self.priorityPatterns)
+
+        logging.info(
+            "Downloading %d files with %s workers", len(objects), self.maxConcurrent
+        )
+        return self.downloadStream(
+            (
+                objects[start : start + PRESIGN_BATCH_SIZE]
+                for start in range(0, len(objects), PRESIGN_BATCH_SIZE)
+            ),
+            len(objects),
+        )
+
+    def downloadStream(self, batches, total: int | None = None) -> TransferReport:
+        """
+        Downloads batches of objects as they arrive, each batch is presigned with one request.
+
+        Only a couple of downloads per worker are handed to the pool at a time. The rest
+        wait in a heap ordered by the priority policy, so what arrives later, like the
+        rest of a streaming listing, still goes first when it ranks higher.
+        An empty batch only reports the downloads finished so far, so a producer that
+        has nothing new yet can keep progress moving. total is passed to onResult if
+        known, otherwise the number of files submitted so far.
+        """
+
+        report = TransferReport()
+        started = time.perf_counter()
+        submitted = 0
+        totalBytes = 0
+
+        progress = rich.progress.Progress(
+            "[progress.description]{task.description}",
+            "[progress.percentage]{task.percentage:>3.0f}%",
+            rich.progress.BarColumn(bar_width=None),
+            rich.progress.DownloadColumn(),
+            rich.progress.TransferSpeedColumn(),
+            console=Console(quiet=not self.showProgress),
+            disable=not self.showProgress,
+        )
+        overall = progress.add_task("Total", total=0)
+
+        futures = {}
+        sortKey = downloadKey(self.priority, self.priorityPatterns)
+        waiting: list[tuple] = []  # (priority, arrival, object)
+        window = self.maxConcurrent * 2
+
+        def collect(done):
+            for future in done:
+                object = futures.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logging.error("Failed to download %s: %s", object.Key, e)
+                    result = TransferResult(object.Key, object.Size or 0, False, str(e))
+
+                report.results.append(result)
+                progress.advance(overall, object.Size or 0)
+                if self.onResult is not None:
+                    self.onResult("down", result, len(report.results), total or submitted)
+
+        with ThreadPoolExecutor(max_workers=self.maxConcurrent) as executor:
+
+            def submit():
+                while len(waiting) > 0 and len(futures) < window:
+                    object = heapq.heappop(waiting)[2]
+                    futures[executor.submit(self._download, object, progress)] = object
+
+            for batch in batches:
+                if len(batch) > 0:
+                    if submitted == 0:
+                        progress.start()
+                    submitted += len(batch)
+                    totalBytes += sum(object.Size or 0 for object in batch)
+                    progress.update(overall, total=totalBytes)
+
+                    # presign the batch ahead of the workers, they pick the urls up from the cache.
+                    # without the batch endpoint the workers presign in parallel themselves
+                    try:
+                        with metrics.timer("phase_seconds", phase="presign"):
+                            getDownloadUrls(
+                                self.token,
+                                self.uid,
+                                [object.Key for object in batch],
+                                fallback=False,
+                            )
+                    except Exception as e:
+                        logging.error("Failed to presign batch: %s", e)
+                    for arrival, object in enumerate(batch, start=submitted - len(batch)):
+                        priority = 0 if sortKey is None else sortKey(object)
+                        heapq.heappush(waiting, (priority, arrival, object))
+
+                collect([future for future in futures if future.done()])
+                submit()
+            while len(futures) > 0:
+                done, _ = wait(list(futures), return_when=FIRST_COMPLETED)
+                collect(done)
+                submit()
+        progress.stop()
+
+        if submitted == 0:
+            return report
+        self._record("down", report, time.perf_counter() - started)
+        self._journal("down", report)
+        logging.info("Download report: %s", report)
+        return report
+
+    def _download(self, object: FileObject, progress) -> TransferResult:
+        down_url = getDownloadUrl(self.token, self.uid, object.Key)
+        if down_url is None or len(down_url) == 0:
+            return TransferResult(
+                object.Key, object.Size or 0, False, "No download url returned"
+            )
+
+        if not downloadUrlToFile(
+            down_url, object.Key, self.offlineFolder, object, progress=progress
+        ):
+            # the url may have been revoked, don't hand it to a retry
+            presignedUrlCache.invalidate(toServerKey(object.Key))
+            return TransferResult(object.Key, object.Size or 0, False, "Download failed")
+
+        return TransferResult(object.Key, object.Size or 0, True)
+
+    def uploadAll(self, localFiles: list[LocalFile]) -> TransferReport:
+        report = TransferReport()
+        if len(localFiles) == 0:
+            return report
+        localFiles = orderUploads(localFiles, self.priority, self.priorityPatterns)
+        started = time.perf_counter()
+
+        logging.info(
+            "Uploading %d files with %s workers", len(localFiles), self.maxConcurrent
+        )
+
+        uploader = MultipartUploader(self.token, self.uid, self.maxConcurrent)
+        with rich.progress.Progress(
+            "[progress.description]{task.description}",
+            "[progress.percentage]{task.percentage:>3.0f}%",
+            rich.progress.BarColumn(bar_width=None),
+            rich.progress.DownloadColumn(),
+            rich.progress.TransferSpeedColumn(),
+            console=Console(quiet=not self.showProgress),
+            disable=not self.showProgress,
+        ) as progress:
+            overall = progress.add_task(
+                "Total", total=sum(local.size for local in localFiles)
+            )
+
+            def onProgress(bytes):
+                progress.advance(overall, bytes)
+
+            with ThreadPoolExecutor(max_workers=self.maxConcurrent) as executor:
+                futures = {
+                    executor.submit(self._upload, uploader, local, onProgress): local
+                    for local in localFiles
+                }
+                for future in as_completed(futures):
+                    local = futures[future]
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        logging.error("Failed to upload %s: %s", local.relPath, e)
+                        result = TransferResult(local.relPath, local.size, False, str(e))
+
+                    report.results.append(result)
+                    if self.onResult is not None:
+                        self.onResult(
+                            "up", result, len(report.results), len(localFiles)
+                        )
+        uploader.close()
+
+        self._record("up", report, time.perf_counter() - started)
+        self._journal("up", report)
+        logging.info("Upload report: %s", report)
+        return report
+
+    def _record(self, direction: str, report: TransferReport, seconds: float):
+        phase = "download" if direction == "down" else "upload"
+        metrics.observe("phase_seconds", seconds, phase=phase)
+        metrics.increment(
+            "transfer_bytes_total", report.bytesTransferred, direction=direction
+        )
+        metrics.increment(
+            "transfer_files_total",
+            len(report.succeeded),
+            direction=direction,
+            result="done",
+        )
+        metrics.increment(
+            "transfer_files_total",
+            len(report.failed),
+            direction=direction,
+            result="failed",
+        )
+        if seconds > 0:
+            metrics.set(
+                "transfer_files_per_second",
+                len(report.succeeded) / seconds,
+                direction=direction,
+            )
+            metrics.set(
+                "transfer_bytes_per_second",
+                report.bytesTransferred / seconds,
+                direction=direction,
+            )
+
+    def _journal(self, direction: str, report: TransferReport):
+        try:
+            getStateStore().journalTransfers(
+                [
+                    (
+                        direction,
+                        result.key,
+                        "done" if result.success else "failed",
+                        result.size,
+                        result.error,
+                    )
+                    for result in report.results
+                ]
+            )
+        except Exception as e:
+            logging.error("Failed to write transfer journal: %s", e)
+
+    def reuseAll(
+        self,
+        copies: list[tuple[FileObject, str]],
+        moves: list[tuple[FileObject, LocalFile]],
+        mode: str = REUSE_REFLINK,
+    ) -> TransferReport:
+        """
+        Creates downloads from local content, see planner.planLocalReuse.
+        Copies run before moves, since a moved file can also be the source of copies.
+        """
+
+        report = TransferReport()
+        if len(copies) + len(moves) == 0:
+            return report
+
+        logging.info("Reusing local content for %s files", len(copies) + len(moves))
+        for object, source in copies:
+            copied = cloneLocalFile(source, object.Key, self.offlineFolder, object, mode)
+            report.results.append(
+                TransferResult(
+                    object.Key,
+                    object.Size or 0,
+                    copied,
+                    None if copied else "Copy failed",
+                )
+            )
+
+        for object, local in moves:
+            report.results.append(self._move(object, local))
+
+        metrics.increment("reused_bytes_total", report.bytesTransferred, mode=mode)
+        metrics.increment("reused_files_total", len(report.succeeded), mode=mode)
+        self._journal("reuse", report)
+        logging.info("Reuse report: %s", report)
+        return report
+
+    def deleteLocalAll(self, localFiles: list[LocalFile]) -> TransferReport:
+        """
+        Deletes local files, a file that is already gone counts as deleted
+        """
+
+        report = TransferReport()
+        if len(localFiles) == 0:
+            return report
+
+        logging.info("Deleting %d local files", len(localFiles))
+        for local in localFiles:
+            try:
+                os.remove(local.absPath)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logging.error("Failed to delete %s: %s", local.absPath, e)
+                report.results.append(
+                    TransferResult(local.relPath, local.size, False, str(e))
+                )
+                continue
+            report.results.append(TransferResult(local.relPath, local.size, True))
+
+        self._recordDeletes("local", report)
+        return report
+
+    def deleteRemoteAll(self, objects: list[FileObject]) -> TransferReport:
+        """
+        Deletes server files, DELETE_BATCH_SIZE keys per request, one folder after the other
+        """
+
+        report = TransferReport()
+        if len(objects) == 0:
+            return report
+
+        logging.info("Deleting %d server files", len(objects))
+        objects = sorted(objects, key=lambda object: normalizePath(object.Key))
+        for start in range(0, len(objects), DELETE_BATCH_SIZE):
+            batch = objects[start : start + DELETE_BATCH_SIZE]
+            try:
+                deleted = deleteFiles(self.token, self.uid, [object.Key for object in batch])
+                error = "Delete failed"
+            except Exception as e:
+                logging.error("Failed to delete batch: %s", e)
+                deleted = set()
+                error = str(e)
+            for object in batch:
+                success = object.Key in deleted
+                report.results.append(
+                    TransferResult(
+                        object.Key, object.Size or 0, success, None if success else error
+                    )
+                )
+
+        self._recordDeletes("remote", report)
+        return report
+
+    def _recordDeletes(self, side: str, report: TransferReport):
+        metrics.increment("deleted_files_total", len(report.succeeded), side=side)
+        metrics.increment("deleted_bytes_total", report.bytesTransferred, side=side)
+        self._journal("delete-" + side, report)
+        logging.info("Delete report (%s): %s", side, report)
+
+    def _move(self, object: FileObject, local: LocalFile) -> TransferResult:
+        finalPath = os.path.join(self.offlineFolder, object.Key)
+        try:
+            os.makedirs(os.path.dirname(finalPath), exist_ok=True)
+            os.replace(local.absPath, finalPath)
+        except OSError as e:
+            logging.error("Failed to move %s to %s: %s", local.absPath, finalPath, e)
+            return TransferResult(object.Key, object.Size or 0, False, str(e))
+
+        return TransferResult(object.Key, object.Size or 0, True)
+
+    def _upload(self, uploader: MultipartUploader, local: LocalFile, onProgress):
+        etag = uploader.uploadFile(toServerKey(local.relPath), local.absPath, onProgress)
+        if etag is None:
+            return TransferResult(local.relPath, local.size, False, "Upload failed")
+
+        return TransferResult(local.relPath, local.size, True, etag=etag)
@@ -0,0 +1,114 @@
+import atexit
+import logging
+import threading
+import time
+from typing import TYPE_CHECKING
+
+from constants import (
+    HTTP_CONNECT_TIMEOUT_SECONDS,
+    HTTP_KEEPALIVE_EXPIRY_SECONDS,
+    HTTP_MAX_CONNECTIONS,
+    HTTP_MAX_KEEPALIVE_CONNECTIONS,
+    HTTP_READ_TIMEOUT_SECONDS,
+)
+from metrics import endpointLabel, metrics
+
+if TYPE_CHECKING:
+    import httpx
+
+"""
+The single HTTP stack of the tool. Every request, to the backend, to presigned object
+urls and to GitHub, goes through the client returned by getClient(), so connections
+are pooled and kept alive per host and multiplexed over HTTP/2 where the server allows.
+The client's event hooks record every request in metrics, timed up to the response headers.
+Its connection limit and read timeout follow the sync settings through configs.py.
+httpx itself is only imported when the first client is created, it is slow to import.
+"""
+
+_client: "httpx.Client | None" = None
+_limits: dict = {}  # keyword arguments for _createClient, see configureTransport
+_lock = threading.Lock()
+
+
+def _http2Available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        logging.warning("h2 is not installed, using HTTP/1.1")
+        return False
+    return True
+
+
+def _startTimer(request: "httpx.Request"):
+    request.extensions["metricsStart"] = time.perf_counter()
+
+
+def _recordResponse(response: "httpx.Response"):
+    endpoint = endpointLabel(response.request.url)
+    start = response.request.extensions.get("metricsStart")
+    if start is not None:
+        metrics.observe(
+            "http_request_seconds", time.perf_counter() - start, endpoint=endpoint
+        )
+    metrics.increment(
+        "http_requests_total", endpoint=endpoint, status=response.status_code
+    )
+
+
+def _createClient(
+    maxConnections: int = HTTP_MAX_CONNECTIONS,
+    maxKeepaliveConnections: int = HTTP_MAX_KEEPALIVE_CONNECTIONS,
+    keepaliveExpiry: float = HTTP_KEEPALIVE_EXPIRY_SECONDS,
+    connectTimeout: float = HTTP_CONNECT_TIMEOUT_SECONDS,
+    readTimeout: float = HTTP_READ_TIMEOUT_SECONDS,
+) -> "httpx.Client":
+    import httpx
+
+    return httpx.Client(
+        http2=_http2Available(),
+        limits=httpx.Limits(
+            max_connections=maxConnections,
+            max_keepalive_connections=maxKeepaliveConnections,
+            keepalive_expiry=keepaliveExpiry,
+        ),
+        timeout=httpx.Timeout(readTimeout, connect=connectTimeout),
+        headers={"User-Agent": "blazedcloud-sync"},
+        event_hooks={"request": [_startTimer], "response": [_recordResponse]},
+    )
+
+
+def getClient() -> "httpx.Client":
+    """
+    Returns the shared client, creating it on first use
+    """
+
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = _createClient(**_limits)
+    return _client
+
+
+def configureTransport(**limits):
+    """
+    Sets the limits of the shared client, see _createClient for the names. A client that
+    exists already is replaced if they changed, requests running on it finish on it.
+    """
+
+    global _client, _limits
+    with _lock:
+        if limits == _limits:
+            return
+        _limits = limits
+        if _client is not None:
+            _client = _createClient(**limits)
+
+
+@atexit.register
+def closeTransport():
+    global _client
+    with _lock:
+        if _client is not None:
+            _client.close()
+            _client = None
@@ -0,0 +1,141 @@
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import api_service
+from api_service import (
+    abortMultipartUpload,
+    completeMultipartUpload,
+    getUploadPartUrl,
+    getUploadUrl,
+    startMultipartUpload,
+    uploadPartToUrl,
+    uploadToUrl,
+)
+from constants import (
+    DEFAULT_MAX_CONCURRENT_TRANSFERS,
+    MAX_PART_RETRIES,
+    MULTIPART_PART_SIZE,
+    MULTIPART_THRESHOLD,
+)
+from metrics import metrics
+
+
+class MultipartUploader:
+    """
+    Uploads files below the threshold with a single PUT, and larger files as parts
+    that are uploaded concurrently against presigned part urls, retried on failure
+    and committed at the end. A backend without multipart endpoints gets a single PUT.
+    """
+
+    def __init__(
+        self,
+        token: str,
+        uid: str,
+        maxConcurrentParts: int = DEFAULT_MAX_CONCURRENT_TRANSFERS,
+        threshold: int = MULTIPART_THRESHOLD,
+        partSize: int = MULTIPART_PART_SIZE,
+        maxRetries: int = MAX_PART_RETRIES,
+    ):
+        self.token = token
+        self.uid = uid
+        self.threshold = threshold
+        self.partSize = partSize
+        self.maxRetries = maxRetries
+        self.partPool = ThreadPoolExecutor(max_workers=max(1, int(maxConcurrentParts)))
+
+    def close(self):
+        self.partPool.shutdown()
+
+    def uploadFile(self, key: str, absPath: str, onProgress=None) -> str | None:
+        """
+        Uploads absPath to key, which uses / as separator.
+
+        Returns the etag of the uploaded object without quotes, empty if the backend didn't
+        send one, or None if the upload failed
+        """
+
+        size = os.path.getsize(absPath)
+        if size < self.threshold or not api_service.multipartUploadSupported:
+            return self._uploadSingle(key, absPath, size, onProgress)
+        return self._uploadMultipart(key, absPath, size, onProgress)
+
+    def _uploadSingle(self, key, absPath, size, onProgress) -> str | None:
+        up_url = getUploadUrl(key, self.token, self.uid)
+        response = uploadToUrl(up_url, absPath)
+        if response is None or response.status_code != 200:
+            logging.error("Failed to upload %s", key)
+            return None
+
+        if onProgress is not None:
+            onProgress(size)
+        return (response.headers.get("ETag") or "").strip('"')
+
+    def _uploadMultipart(self, key, absPath, size, onProgress) -> str | None:
+        uploadId = startMultipartUpload(self.token, self.uid, key, size, self.partSize)
+        if uploadId is None:
+            if not api_service.multipartUploadSupported:
+                return self._uploadSingle(key, absPath, size, onProgress)
+            return None
+
+        partCount = (size + self.partSize - 1) // self.partSize
+        logging.info("Uploading %s in %d parts", key, partCount)
+
+        futures = [
+            self.partPool.submit(
+                self._uploadPart, key, absPath, uploadId, number, onProgress
+            )
+            for number in range(1, partCount + 1)
+        ]
+        parts: list[tuple[int, str]] = []
+        for number, future in enumerate(futures, start=1):
+            try:
+                etag = future.result()
+            except Exception as e:
+                logging.error("Part %d of %s failed: %s", number, key, e)
+                etag = None
+            if etag is None:
+                # let the rest finish before aborting
+                for other in futures:
+                    other.exception()
+                logging.error("Part %d of %s failed, aborting upload", number, key)
+                abortMultipartUpload(self.token, self.uid, key, uploadId)
+                return None
+            parts.append((number, etag))
+
+        etag = completeMultipartUpload(self.token, self.uid, key, uploadId, parts)
+        if etag is None:
+            abortMultipartUpload(self.token, self.uid, key, uploadId)
+            return None
+        return etag.strip('"')
+
+    def _uploadPart(self, key, absPath, uploadId, number, onProgress) -> str | None:
+        try:
+            with open(absPath, "rb") as f:
+                f.seek((number - 1) * self.partSize)
+                data = f.read(self.partSize)
+        except OSError as e:
+            logging.error("Failed to read part %d of %s: %s", number, key, e)
+            return None
+
+        for attempt in range(1, self.maxRetries + 1):
+            try:
+                # part urls can expire between attempts, so always ask for a fresh one
+                part_url = getUploadPartUrl(self.token, self.uid, key, uploadId, number)
+                if part_url is not None:
+                    etag = uploadPartToUrl(part_url, data)
+                    if etag is not None:
+                        if onProgress is not None:
+                            onProgress(len(data))
+                        return etag
+            except Exception as e:
+                logging.warning(
+                    "Part %d of %s failed on attempt %d: %s", number, key, attempt, e
+                )
+
+            if attempt < self.maxRetries:
+                metrics.increment("retries_total", operation="upload_part")
+                time.sleep(0.5 * 2**attempt)
+
+        return None
@@ -1,69 +1,132 @@
-import asyncio
-import datetime
 import logging
 import os
 import sys
-import zipfile
-from io import BytesIO
-from tkinter.filedialog import askdirectory
+import threading
+import time
 
-import requests
-from rich.console import Console
-from rich.panel import Panel
-
-from constants import TOOL_VERSION
+from constants import TOOL_VERSION, UPDATE_CHECK_TTL_SECONDS
 from models.fileObject import FileObject
 
-console = Console()
+# heavy modules (tkinter, rich, httpx) are imported inside the functions that need them,
+# so starting the tool and the headless cli stay fast
 
 isUpdateAvailable = False
 
+UPDATE_CHECK_KEY = "updateCheck"
+
 
 def promptUserForOfflineFolder():
     """
     Simply gets a user selected folder and returns it.
 
     Use updateOfflineFolder() to call this function and save the result to the database
+
+    Hosts without Tk or without a display are asked for the path in the terminal instead
     """
 
     logging.info("Prompting user for offline folder...")
-    return askdirectory(
-        mustexist=True
-    )  # show an "Open" dialog box and return the path to the selected file
+    if os.name == "nt" or os.environ.get("DISPLAY") or os.environ.get("WAYLAND_DISPLAY"):
+        try:
+            from tkinter.filedialog import askdirectory
+
+            return askdirectory(
+                mustexist=True
+            )  # show an "Open" dialog box and return the path to the selected file
+        except Exception as e:
+            logging.warning("Folder dialog unavailable: %s", e)
+
+    from rich.prompt import Prompt
+
+    folder = Prompt.ask("Offline folder")
+    if not os.path.isdir(folder):
+        logging.error("%s is not a folder", folder)
+        return None
+    return os.path.abspath(folder)
+
+
+def _isNewerVersion(latest: str) -> bool:
+    # replace "." with "" to get the version number as an int
+    latestCode = latest.replace(".", "")
+    currentCode = TOOL_VERSION.replace(".", "")
+
+    return int(latestCode) > int(currentCode)
 
 
-def checkIfUpdateAvailable():
+def checkIfUpdateAvailable(allowNetwork: bool = True, announce: bool = True) -> bool:
     """
     Display a message if there is an update available
+
+    The latest version is cached in the state store for UPDATE_CHECK_TTL_SECONDS, so GitHub
+    is asked at most once per TTL. Without allowNetwork only the cache is used, even if stale.
     """
-    from api_service import get_latest_version
+    from stateStore import getStateStore
 
     global isUpdateAvailable
 
-    try:
-        loop = asyncio.get_event_loop()
-        latest = loop.run_until_complete(get_latest_version())
+    store = getStateStore()
+    cached = store.getSetting(UPDATE_CHECK_KEY) or {}
+    latest = cached.get("latest")
+    stale = time.time() - cached.get("checkedAt", 0) > UPDATE_CHECK_TTL_SECONDS
+
+    if stale and allowNetwork:
+        from api_service import get_latest_version
+
+        try:
+            latest = get_latest_version()
+        except Exception as e:
+            logging.error("Failed to check for update: %s", e)
+            return isUpdateAvailable
         if latest is None:
-            return
-    except Exception as e:
-        logging.error(f"Failed to check for update: {e}")
-        return
+            return isUpdateAvailable
+        store.setSetting(UPDATE_CHECK_KEY, {"latest": latest, "checkedAt": time.time()})
 
-    # replace "." with "" to get the version number as an int
-    latestCode = latest.replace(".", "")
-    currentCode = TOOL_VERSION.replace(".", "")
+    if latest is None:
+        return isUpdateAvailable
+
+    try:
+        isUpdateAvailable = _isNewerVersion(latest)
+    except ValueError:
+        logging.error("Unexpected version %s", latest)
+        return isUpdateAvailable
 
-    if int(latestCode) > int(currentCode):
-        console.print(
+    if isUpdateAvailable and announce:
+        from rich.console import Console
+        from rich.panel import Panel
+
+        Console().print(
             Panel.fit(
                 f"Current version: {TOOL_VERSION}\nLatest version: {latest}",
                 title="Update Available",
             )
         )
-        isUpdateAvailable = True
+    return isUpdateAvailable
+
+
+def startBackgroundUpdateCheck() -> threading.Thread:
+    """
+    Cleans up old release executables and refreshes the update check off the main thread.
+    The result shows up in isUpdateAvailable, nothing is printed
+    """
+
+    def run():
+        try:
+            deleteOtherReleaseExecutables()
+        except Exception as e:
+            logging.error("Failed to delete other release executables: %s", e)
+        checkIfUpdateAvailable(announce=False)
+
+    thread = threading.Thread(target=run, name="update-check", daemon=True)
+    thread.start()
+    return thread
 
 
 def runUpdate():
+    import zipfile
+    from io import BytesIO
+
+    from rich.console import Console
+
+    console = Console()
     if not isUpdateAvailable:
         console.print("[red]No update available")
         return
@@ -72,12 +135,11 @@ def runUpdate():
     try:
         from api_service import get_latest_version
 
-        loop = asyncio.get_event_loop()
-        latest = loop.run_until_complete(get_latest_version())
+        latest = get_latest_version()
         if latest is None:
             return
     except Exception as e:
-        logging.error(f"Failed to check for update: {e}")
+        logging.error("Failed to check for update: %s", e)
         return
 
     if latest is None:
@@ -90,8 +152,10 @@ def runUpdate():
     )
     print(releases_url)
 
+    from transport import getClient
+
     # Make a request to get the latest release information
-    response = requests.get(releases_url)
+    response = getClient().get(releases_url, follow_redirects=True)
     release_data = response.json()
     print(release_data)
 
@@ -100,7 +164,7 @@ def runUpdate():
     print(download_url)
 
     # Download the ZIP file containing the executable
-    zip_content = requests.get(download_url).content
+    zip_content = getClient().get(download_url, follow_redirects=True).content
 
     # Extract the contents of the ZIP file
     print("Extracting release to", os.getcwd())
@@ -155,100 +219,274 @@ def deleteOtherReleaseExecutables():
             os.remove(file)
 
 
+PARTIAL_SUFFIX = ".tmp"
+PARTIAL_META_SUFFIX = ".tmp.meta"
+
+
+def isPartialDownload(name: str) -> bool:
+    """
+    Checks if a file name belongs to an unfinished download or its sidecar
+    """
+
+    return name.endswith(PARTIAL_SUFFIX) or name.endswith(PARTIAL_META_SUFFIX)
+
+
+def removeOrphanedPartials(folder: str, names) -> bool:
+    """
+    Deletes partial downloads without a sidecar, and sidecars without a partial download.
+    Pairs are kept so the next download can resume them.
+
+    Returns True if anything was deleted
+    """
+
+    names = set(names)
+    removed = False
+    for name in names:
+        if name.endswith(PARTIAL_SUFFIX):
+            orphaned = name + ".meta" not in names
+        elif name.endswith(PARTIAL_META_SUFFIX):
+            orphaned = name[: -len(".meta")] not in names
+        else:
+            continue
+
+        if orphaned:
+            os.remove(os.path.join(folder, name))
+            removed = True
+    return removed
+
+
 def getAllFilesFromFolder(folder):
     """
     Returns [0] the relative paths of all files in the folder, and [1] the absolute paths of all files in the folder
     """
-    import os
+    from scanner import scanFolder
 
     relativePaths: list[str] = []
     absolutePaths: list[str] = []
-    for root, dirs, files in os.walk(folder):
-        for file in files:
-            # if file ends with .tmp, delete it and move on
-            if file.endswith(".tmp"):
-                os.remove(os.path.join(root, file))
-                continue
-
-            absolutePaths.append(os.path.join(root, file))
-
-            # remove offline folder from path and first slash
-            file = os.path.join(root, file)
-            file = file.replace(folder, "")
-            if file.startswith("\\"):
-                file = file[1:]
-
-            relativePaths.append(file)
+    for record in scanFolder(folder):
+        relativePaths.append(record.relPath)
+        absolutePaths.append(os.path.join(folder, record.relPath))
     return relativePaths, absolutePaths
 
 
+def readPartialDownload(filePath: str, object: FileObject) -> int:
+    """
+    Returns how many bytes of filePath + ".tmp" can be kept when downloading object,
+    which is 0 unless its sidecar shows it was started for the same etag and size
+    """
+    import json
+
+    tmpPath = filePath + PARTIAL_SUFFIX
+    metaPath = filePath + PARTIAL_META_SUFFIX
+    if not os.path.exists(tmpPath) or not os.path.exists(metaPath):
+        return 0
+
+    try:
+        with open(metaPath, "r") as f:
+            meta = json.load(f)
+    except Exception as e:
+        logging.warning("Unreadable sidecar for %s: %s", filePath, e)
+        return 0
+
+    if meta.get("etag") != object.ETag or meta.get("size") != object.Size:
+        logging.info("%s changed on the server, restarting download", filePath)
+        return 0
+
+    return min(os.path.getsize(tmpPath), object.Size or 0)
+
+
+def writePartialDownloadMeta(filePath: str, object: FileObject):
+    import json
+
+    with open(filePath + PARTIAL_META_SUFFIX, "w") as f:
+        json.dump({"etag": object.ETag, "size": object.Size}, f)
+
+
 def downloadUrlToFile(
-    url: str, file: str, offlineFolder: str, object: FileObject
-):  # example file: "vcx33oy8b86eg02/folder1/unnamed.jpg"
+    url: str, file: str, offlineFolder: str, object: FileObject, progress=None
+) -> bool:  # example file: "vcx33oy8b86eg02/folder1/unnamed.jpg"
     """
     Downloads a file from a url to a file path
 
     remote object is need to set the modified date to match the server
+
+    pass a shared rich progress to report into it instead of opening a new live display,
+    which is required when downloading from several threads at once
+
+    An interrupted download leaves <file>.tmp and a <file>.tmp.meta sidecar behind.
+    The next attempt resumes it with a Range request guarded by If-Range on the etag,
+    so the server sends the whole object again if it changed in the meantime.
+
+    Returns True if the file was downloaded, False if not
     """
 
     # create folder for each string before the last /
     import os
 
-    import httpx
     import rich.progress
 
+    from metrics import metrics
+    from scheduler import bandwidthLimiter
+    from transport import getClient
+
     # create folder
     folder = os.path.join(offlineFolder, os.path.dirname(file))
     os.makedirs(folder, exist_ok=True)
 
     # file path
-    filePath = os.path.join(offlineFolder, file + ".tmp")
+    finalPath = os.path.join(offlineFolder, file)
+    filePath = finalPath + PARTIAL_SUFFIX
 
     # Create the parent folder if it doesn't exist
     parent_folder = os.path.dirname(filePath)
     if not os.path.exists(parent_folder):
         os.makedirs(parent_folder)
 
+    offset = readPartialDownload(finalPath, object)
+    writePartialDownloadMeta(finalPath, object)
+
     # download file
-    with open(filePath, "wb") as out_file:
-        with httpx.stream("GET", url) as response:
-            total = int(response.headers["Content-Length"])
-            if response.status_code != 200:
-                logging.error(f"Failed to download file: {response.reason_phrase}")
-                return
-
-            with rich.progress.Progress(
-                "[progress.percentage]{task.percentage:>3.0f}%",
-                rich.progress.BarColumn(bar_width=None),
-                rich.progress.DownloadColumn(),
-                rich.progress.TransferSpeedColumn(),
-            ) as progress:
-                download_task = progress.add_task("Download", total=total)
-                for chunk in response.iter_bytes():
-                    out_file.write(chunk)
-                    progress.update(
-                        download_task, completed=response.num_bytes_downloaded
+    if offset == 0 or offset < object.Size:
+        headers = {}
+        if offset > 0:
+            logging.info("Resuming %s from byte %d", file, offset)
+            metrics.increment("retries_total", operation="download_resume")
+            headers["Range"] = f"bytes={offset}-"
+            headers["If-Range"] = f'"{object.ETag}"'
+
+        with getClient().stream("GET", url, headers=headers) as response:
+            if response.status_code == 206:
+                mode = "ab"
+            elif response.status_code == 200:
+                # full body, either fresh or the object changed since the partial download
+                offset = 0
+                mode = "wb"
+            else:
+                logging.error(
+                    "Failed to download %s: %s", file, response.reason_phrase
+                )
+                return False
+            total = object.Size or int(response.headers.get("Content-Length", 0))
+
+            with open(filePath, mode) as out_file:
+                if progress is None:
+                    with rich.progress.Progress(
+                        "[progress.percentage]{task.percentage:>3.0f}%",
+                        rich.progress.BarColumn(bar_width=None),
+                        rich.progress.DownloadColumn(),
+                        rich.progress.TransferSpeedColumn(),
+                    ) as progress:
+                        download_task = progress.add_task(
+                            "Download", total=total, completed=offset
+                        )
+                        for chunk in response.iter_bytes():
+                            bandwidthLimiter.download.consume(len(chunk))
+                            out_file.write(chunk)
+                            progress.update(
+                                download_task,
+                                completed=offset + response.num_bytes_downloaded,
+                            )
+                else:
+                    download_task = progress.add_task(
+                        file, total=total, completed=offset
                     )
+                    for chunk in response.iter_bytes():
+                        bandwidthLimiter.download.consume(len(chunk))
+                        out_file.write(chunk)
+                        progress.update(
+                            download_task,
+                            completed=offset + response.num_bytes_downloaded,
+                        )
+                    progress.remove_task(download_task)
 
     # rename file
     try:
-        os.rename(
-            os.path.join(offlineFolder, file + ".tmp"),
-            os.path.join(offlineFolder, file),
-        )
+        os.replace(filePath, finalPath)
     except Exception as e:
-        logging.error("failed to rename file: " + str(e))
-        if os.path.exists(os.path.join(offlineFolder, file + ".tmp")):
-            os.remove(os.path.join(offlineFolder, file + ".tmp"))
+        logging.error("Failed to rename %s: %s", filePath, e)
+        if os.path.exists(filePath):
+            os.remove(filePath)
+        os.remove(finalPath + PARTIAL_META_SUFFIX)
+        return False
+    os.remove(finalPath + PARTIAL_META_SUFFIX)
 
     # set modified date
-    remote_timestamp = datetime.datetime.strptime(
-        object.LastModified, "%Y-%m-%dT%H:%M:%S.%fZ"
-    ).timestamp()
-    os.utime(os.path.join(offlineFolder, file), (remote_timestamp, remote_timestamp))
+    os.utime(
+        finalPath,
+        ns=(object.LastModifiedNs, object.LastModifiedNs),
+    )
+
+    return True
+
+
+REUSE_REFLINK = "reflink"
+REUSE_COPY = "copy"
+REUSE_HARDLINK = "hardlink"
+REUSE_OFF = "off"
+
+# ioctl that clones a whole file, see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+
+def _reflink(source: str, dest: str) -> bool:
+    """
+    Shares the blocks of source with dest copy-on-write, False where unsupported
+    """
 
-    del response
-    del out_file
+    if not sys.platform.startswith("linux"):
+        return False
+
+    import fcntl
+
+    try:
+        with open(source, "rb") as src, open(dest, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    except OSError:
+        return False
+    return True
+
+
+def cloneLocalFile(
+    source: str,
+    file: str,
+    offlineFolder: str,
+    object: FileObject,
+    mode: str = REUSE_REFLINK,
+) -> bool:
+    """
+    Creates a file from a local file with the same content instead of downloading it
+
+    reflink shares the blocks where the filesystem supports it (btrfs, xfs) and copies
+    otherwise, copy always copies, and hardlink links both paths to one file, so an edit
+    to either changes both. The clone gets the server's modified date, except hardlinks,
+    which would move the date of the source too.
+
+    Returns True if the file was created, False if not
+    """
+
+    import shutil
+
+    finalPath = os.path.join(offlineFolder, file)
+    tempPath = finalPath + PARTIAL_SUFFIX
+    os.makedirs(os.path.dirname(finalPath), exist_ok=True)
+
+    try:
+        if os.path.exists(tempPath):
+            os.remove(tempPath)
+        if mode == REUSE_HARDLINK:
+            os.link(source, tempPath)
+        elif not (mode == REUSE_REFLINK and _reflink(source, tempPath)):
+            shutil.copyfile(source, tempPath)
+        os.replace(tempPath, finalPath)
+    except OSError as e:
+        logging.error("Failed to copy %s to %s: %s", source, finalPath, e)
+        if os.path.exists(tempPath):
+            os.remove(tempPath)
+        return False
+
+    if mode != REUSE_HARDLINK:
+        os.utime(finalPath, ns=(object.LastModifiedNs, object.LastModifiedNs))
+    return True
 
 
 def isLocalSame(filepath, object):
@@ -269,23 +507,20 @@ def isLocalSame(filepath, object):
     return False
 
 
-def isLocalNewer(filepath: str, object: FileObject):
+def isLocalNewer(filepath: str, object: FileObject, mtime_ns: int | None = None):
     """
-    Checks if the local file is newer than the server file by checking the last modified date
+    Checks if the local file is newer than the server file by checking the last modified date,
+    pass mtime_ns when it is already known to skip the stat
 
     Returns True if the local file is newer, False if not
     """
-    import datetime
     import os
 
     # get local file info
-    local_timestamp = os.path.getmtime(filepath)  # unix timestamp
-    remote_timestamp = datetime.datetime.strptime(
-        object.LastModified, "%Y-%m-%dT%H:%M:%S.%fZ"
-    ).timestamp()
+    local_timestamp = mtime_ns if mtime_ns is not None else os.stat(filepath).st_mtime_ns
 
     # compare
-    if local_timestamp > remote_timestamp:
+    if local_timestamp > object.LastModifiedNs:
         return True
 
     return False
@@ -341,7 +576,7 @@ def createShortcutToApp():
         shortcut.SetDescription(app_name)
         shortcut.SetIconLocation(sys.executable, 0)
     except Exception as e:
-        logging.error(f"Error creating shortcut: {e}")
+        logging.error("Error creating shortcut: %s", e)
 
 
 def deleteShortcutInStartFolder():
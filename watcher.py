@@ -0,0 +1,208 @@
+import ctypes
+import ctypes.util
+import functools
+import logging
+import os
+import select
+import struct
+import sys
+import time
+
+from constants import (
+    WATCH_DEBOUNCE_SECONDS,
+    WATCH_MAX_DELAY_SECONDS,
+    WATCH_REMOTE_POLL_SECONDS,
+)
+from utils import isPartialDownload
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (
+    IN_CLOSE_WRITE
+    | IN_ATTRIB
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+)
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class InotifyWatcher:
+    """
+    Recursive inotify watch over a folder, reporting changed paths relative to it
+    """
+
+    def __init__(self, folder: str):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._addWatch = libc.inotify_add_watch
+        self._addWatch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+
+        self.folder = folder
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self.watches: dict[int, str] = {}  # watch descriptor -> relative directory
+        self.overflowed = False
+        self.watchTree("")
+
+    def close(self):
+        os.close(self.fd)
+
+    def watchTree(self, relDir: str):
+        for root, dirs, _ in os.walk(os.path.join(self.folder, relDir)):
+            wd = self._addWatch(self.fd, os.fsencode(root), WATCH_MASK)
+            if wd < 0:
+                error = os.strerror(ctypes.get_errno())
+                logging.warning("Failed to watch %s: %s", root, error)
+                continue
+            relRoot = os.path.relpath(root, self.folder)
+            self.watches[wd] = "" if relRoot == "." else relRoot
+
+    def read(self, timeout: float) -> set[str]:
+        """
+        Waits up to timeout seconds and returns the relative paths that changed
+        """
+
+        changed: set[str] = set()
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return changed
+
+        try:
+            buffer = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return changed
+
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(buffer):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(buffer, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(buffer[offset : offset + length].rstrip(b"\0"))
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                self.overflowed = True
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+
+            relDir = self.watches.get(wd)
+            if relDir is None or isPartialDownload(name):
+                continue
+
+            relPath = os.path.join(relDir, name) if relDir else name
+            changed.add(relPath if name else relDir)
+
+            # new directories need watches of their own
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self.watchTree(relPath)
+
+        return changed
+
+
+def watch(
+    debounce: float = WATCH_DEBOUNCE_SECONDS,
+    maxDelay: float = WATCH_MAX_DELAY_SECONDS,
+    remotePoll: float = WATCH_REMOTE_POLL_SECONDS,
+    headless: bool = False,
+):
+    """
+    Keeps the offline folder in sync until interrupted.
+
+    Bursts of local changes are coalesced until no event arrived for debounce seconds
+    (or maxDelay passed since the first one) and only those paths are synced.
+    The server is polled with a full sync every remotePoll seconds.
+    headless syncs without printing anything, see Sync.
+    """
+
+    from configs import getOfflineFolder
+    from sync import Sync
+
+    Sync = functools.partial(Sync, headless=headless)
+
+    folder = getOfflineFolder()
+    if folder is None or len(folder) == 0:
+        logging.error("Offline folder not set")
+        return
+
+    if not sys.platform.startswith("linux"):
+        logging.warning("Filesystem events need Linux, polling instead")
+        _pollOnly(remotePoll, headless)
+        return
+
+    watcher = InotifyWatcher(folder)
+    logging.info("Watching %s (%d directories)", folder, len(watcher.watches))
+
+    # start from a known state, then only react to changes
+    Sync(assumeYes=True)
+    lastRemotePoll = time.monotonic()
+
+    pending: set[str] = set()
+    firstEvent = lastEvent = 0.0
+    try:
+        while True:
+            now = time.monotonic()
+            timeout = remotePoll - (now - lastRemotePoll)
+            if len(pending) > 0:
+                timeout = min(
+                    timeout,
+                    debounce - (now - lastEvent),
+                    maxDelay - (now - firstEvent),
+                )
+
+            changed = watcher.read(max(0.0, timeout))
+            now = time.monotonic()
+            if len(changed) > 0:
+                if len(pending) == 0:
+                    firstEvent = now
+                lastEvent = now
+                pending.update(changed)
+
+            if watcher.overflowed:
+                logging.warning("Too many filesystem events, running a full sync")
+                watcher.overflowed = False
+                pending.clear()
+                Sync(assumeYes=True)
+                lastRemotePoll = time.monotonic()
+            elif len(pending) > 0 and (
+                now - lastEvent >= debounce or now - firstEvent >= maxDelay
+            ):
+                logging.info("Syncing %d changed paths", len(pending))
+                paths = pending
+                pending = set()
+                Sync(assumeYes=True, paths=paths)
+            elif now - lastRemotePoll >= remotePoll:
+                Sync(assumeYes=True)
+                lastRemotePoll = time.monotonic()
+    except KeyboardInterrupt:
+        logging.info("Stopped watching")
+    finally:
+        watcher.close()
+
+
+def _pollOnly(interval: float, headless: bool = False):
+    from sync import Sync
+
+    try:
+        while True:
+            Sync(assumeYes=True, headless=headless)
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        logging.info("Stopped watching")